@@ -2,15 +2,24 @@
 #       - searches the pdb for all structures associated with each gene name (in Homo Sapiens)
 #       - outputs a csv file called 00_search_overview_PDBids.csv containing all gene names and corresponding PDB structure id's if available
 #       - outputs a csv file called 00_search_overview_availability.csv containing a boolean value for each gene to indicate whether there are any structures available or not
+#         and the number of available structures per gene (with --counts_only True, only this file is written and no PDB ids are retrieved)
 # ----------------------------------------------------------------------------------------------------------------------------------
 # Set up workspace
 import os
 from os.path import exists
 import pandas as pd
+import ast
 import sys
 import argparse
+import json
 import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 from datetime import datetime
+# functions to cache responses from the APIs on disk (shared by all MutaPipe scripts which get data from an API)
+from mutapipe_cache import read_cache, write_cache, evict_cache
 
 # get this script's name:
 script_name = os.path.basename(__file__)
@@ -38,6 +47,17 @@ create_search_log = False      # will create a file called search_log.txt with c
                                             # prints to console if set to False.
 web_run = True # indicate whether MutaPipe is run via the webserver; if true certain outputs/structure files will be stored in the background for future webserver runs
 mutafy_directory = f'{target_directory}/mutafy' # set path to mutafy folder (where structures and combined outputs of previous webserver runs will be/are stored)
+use_cache = True # store responses from the APIs on disk and reuse them in later runs (True) or always get data from the network (False)
+cache_dir = f'{os.path.expanduser("~")}/.cache/MutaPipe' # set path to directory where responses from the APIs are cached
+max_cache_size = 1024 # maximum size of the cache directory in MB (least recently used responses are removed first)
+n_workers = 8 # maximum number of search requests sent to the PDB API at the same time
+rate_limit = 5 # maximum number of requests per second sent to the same host (0 = no limit)
+max_retries = 3 # number of times a failed search request is retried (with exponential backoff)
+batch_search = False # search the PDB for many genes with one request (True) or send one request per gene (False)
+batch_size = 100 # number of genes per search request in batch mode
+counts_only = False # only get the number of available structures per gene (True) or all pdb ids (False); fast check which genes have structures
+incremental_search = True # for webserver runs, only search for structures released since the last search for a gene (True) or always search for all structures (False)
+max_mark_age = 28 # maximum number of days since the last search for all structures of a gene before we search for all structures again in an incremental search (0 = no maximum)
                                             
 # ----------------------------------------------------------------------------------------------------------------------------------
 
@@ -57,7 +77,8 @@ def str2bool(v):
 ap = argparse.ArgumentParser(description="""****   This script takes a list of genes in txt. format as input and performs the following:
 1. searches the pdb for all structures associated with each gene name (in Homo Sapiens)
 2. outputs a csv file called 00_search_overview_PDBids.csv containing all gene names and corresponding PDB structure id's if available
-3. outputs a csv file called 00_search_overview_availability.csv containing a boolean value for each gene to indicate whether there are any structures available or not   ***""")
+3. outputs a csv file called 00_search_overview_availability.csv containing a boolean value for each gene to indicate whether there are any structures available or not (and the number of available structures)
+(use --counts_only True to only count the available structures per gene, in this case only 00_search_overview_availability.csv is written)   ***""")
 
 ap.add_argument('-g','--genes', nargs='+', required=False, help=f'Specify genes for which to search pdb structures, default = {gene_list}; to pass a file containing all genes use -g $(cat filename)')
 ap.add_argument("-o", "--organism", required = False, help=f'Specify species for which to search pdb structures, default = {species_name}')
@@ -66,6 +87,17 @@ ap.add_argument("-t", "--target", required = False, help=f'Specify target direct
 ap.add_argument("-a", "--all", type=str2bool, required = False, help=f'Retrieve all (True) vs max. 10 pdb IDs per gene (False), default = {str(all_hits)}')
 ap.add_argument("-w", "--web_run", type=str2bool, required = False, help=f'Indicate whether MutaPipe is run via a webserver (True) or not (False), default = {str(mutafy_directory)}')
 ap.add_argument("-m", "--mutafy", required = False, help=f'set path to mutafy directory where information from previous runs is stored, default = {mutafy_directory}')
+ap.add_argument("-wk", "--workers", type=int, required = False, help=f'Specify maximum number of search requests sent to the PDB at the same time, default = {str(n_workers)}')
+ap.add_argument("-rl", "--rate_limit", type=float, required = False, help=f'Specify maximum number of requests per second sent to the PDB (0 = no limit), default = {str(rate_limit)}')
+ap.add_argument("-rt", "--retries", type=int, required = False, help=f'Specify number of times a failed search request is retried, default = {str(max_retries)}')
+ap.add_argument("-bt", "--batch", type=str2bool, required = False, help=f'Search the PDB for many genes with one request (True) or send one request per gene (False), default = {str(batch_search)}')
+ap.add_argument("-bs", "--batch_size", type=int, required = False, help=f'Specify number of genes per search request in batch mode, default = {str(batch_size)}')
+ap.add_argument("-co", "--counts_only", type=str2bool, required = False, help=f'Only get the number of available structures per gene and write 00_search_overview_availability.csv (True) or get all PDB IDs (False), default = {str(counts_only)}')
+ap.add_argument("-i", "--incremental", type=str2bool, required = False, help=f'For webserver runs, only search for structures released since the last search for a gene (True) or always search for all structures (False), default = {str(incremental_search)}')
+ap.add_argument("-ma", "--max_mark_age", type=int, required = False, help=f'Specify maximum number of days since the last search for all structures of a gene before all structures are searched again in an incremental search, so obsolete entries are removed (0 = no maximum), default = {str(max_mark_age)}')
+ap.add_argument("-ca", "--cache", type=str2bool, required = False, help=f'Specify whether to cache responses from the APIs on disk (True) or not (False), default = {str(use_cache)}')
+ap.add_argument("-cd", "--cache_dir", required = False, help=f'Set path to directory where responses from the APIs are cached, default = {cache_dir}')
+ap.add_argument("-cs", "--cache_size", type=int, required = False, help=f'Specify maximum size of the cache directory in MB, default = {str(max_cache_size)}')
 
 args = vars(ap.parse_args())
 
@@ -78,6 +110,20 @@ target_directory  = target_directory if args["target"]   == None else args["targ
 all_hits = all_hits if args["all"] == None else args["all"]
 web_run = web_run if args["web_run"] == None else args["web_run"]
 mutafy_directory = mutafy_directory if args["mutafy"] == None else args["mutafy"]
+n_workers = n_workers if args["workers"] == None else args["workers"]
+rate_limit = rate_limit if args["rate_limit"] == None else args["rate_limit"]
+max_retries = max_retries if args["retries"] == None else args["retries"]
+batch_search = batch_search if args["batch"] == None else args["batch"]
+batch_size = batch_size if args["batch_size"] == None else args["batch_size"]
+counts_only = counts_only if args["counts_only"] == None else args["counts_only"]
+incremental_search = incremental_search if args["incremental"] == None else args["incremental"]
+max_mark_age = max_mark_age if args["max_mark_age"] == None else args["max_mark_age"]
+use_cache = use_cache if args["cache"] == None else args["cache"]
+cache_dir = cache_dir if args["cache_dir"] == None else os.path.abspath(args["cache_dir"])
+max_cache_size = max_cache_size if args["cache_size"] == None else args["cache_size"]
+# if responses should not be cached, we don't use a cache directory at all
+if not use_cache:
+    cache_dir = None
 
 # ----------------------------------------------------------------------------------------------------------------------------------
 
@@ -121,46 +167,111 @@ print(f'start: {start_time}\n')
 # set up search request
 base_url = "https://search.rcsb.org/rcsbsearch/v2/query" # old url doesn't work anymore since July 2022 "https://search.rcsb.org/rcsbsearch/v1/query"
 
+# status codes for which it is worth trying the same request again (rate limited or temporary server problems)
+retry_status_codes = [429, 500, 502, 503, 504]
+
+# we keep one requests session per worker thread, so every worker can reuse its (keep-alive) connection to the PDB API
+thread_data = threading.local()
+
+def get_session():
+    if not hasattr(thread_data, 'session'):
+        thread_data.session = requests.Session()
+    return thread_data.session
+
+# to make sure we don't flood the PDB API when searching many genes at once, we use a token bucket per host:
+# every request takes one token from the bucket, and the bucket is refilled with rate_limit tokens per second
+token_buckets = {}
+token_bucket_lock = threading.Lock()
+
+def wait_for_token(url):
+    """
+    This function will block until a request to the host of the
+    given url is allowed according to the per-host rate limit
+    
+    :param url: string
+    :return: None
+    """
+    # a rate limit of 0 (or less) means we don't limit the number of requests per second
+    if rate_limit <= 0:
+        return
+    host = urlparse(url).netloc
+    while True:
+        with token_bucket_lock:
+            now = time.monotonic()
+            # the bucket for a new host starts full, so the first requests can be sent straight away
+            tokens, last_refill = token_buckets.get(host, (max(rate_limit, 1), now))
+            tokens = min(max(rate_limit, 1), tokens + (now - last_refill) * rate_limit)
+            if tokens >= 1:
+                token_buckets[host] = (tokens - 1, now)
+                return
+            token_buckets[host] = (tokens, now)
+            # time until the next token will be available
+            wait_time = (1 - tokens) / rate_limit
+        time.sleep(wait_time)
 
 # define search function to get data from API
-def search_pdb(query_url):
+def search_pdb(query_url, gene_name, query_json=None):
     """
     This function will make a GET call to the PDB API
-    using the defined query url
+    using the defined query url (or a POST call if a json query is given);
+    if the request fails with a temporary error it will be retried with exponential backoff
     
     :param query_url: string
-    :return: Dict or None
+    :param gene_name: string (only used for console output)
+    :param query_json: Dict or None
+    :return: Dict (empty if there are no results) or None (if the request failed)
     """
-    # Make a GET call to the API URL
-    get_request = requests.get(url=query_url)
-    
-    if get_request.status_code == 200:
-        # If there is data returned (with HTML status code 200)
-        # then return the data in JSON format
-        return get_request.json()
-    else:
-        # If there is no data, print status code and response, return None
-        print(f'            No data retrieved for {gene_name}; status code: {get_request.status_code} {get_request.text}\n')
-        return None
-
-# ----------------------------------------------------------------------------------------------------------------------------------
-
-# change to results directory:
-os.chdir(results_dir)
-
-# Initiate loop over all genes in gene_list to find all PDB id's of available structures
-gene_counter = 1
-n_genes = len(gene_list)
-n_pdbs_all_genes = 0
-genes_data_available = []
-genes_no_data_available = []
-search_overview = pd.DataFrame(columns=['gene_name', 'n_available_structures', 'available_structures'])
-
-print(f'\n======================== Searching PDB IDs for {n_genes} inputted genes ========================\n')
-
-for gene in gene_list:
-    gene_name = gene
-    
+    # if we have sent the same request in a previous run, we use the cached response instead
+    # (we check the cache before waiting for the rate limit, as cached responses don't go to the network)
+    method = 'GET' if query_json is None else 'POST'
+    cached_response = read_cache(cache_dir, method, query_url, query_json)
+    if cached_response is not None:
+        if cached_response['status_code'] == 200:
+            return json.loads(cached_response['text'])
+        # status code 204 means the search was successful, but there are no structures
+        return {}
+    for attempt in range(max_retries + 1):
+        # wait until we are allowed to send another request to the PDB API
+        wait_for_token(query_url)
+        try:
+            if query_json is None:
+                # Make a GET call to the API URL
+                get_request = get_session().get(url=query_url, timeout=60)
+            else:
+                # Make a POST call to the API URL with the query in the request body
+                get_request = get_session().post(url=query_url, json=query_json, timeout=60)
+        except requests.exceptions.RequestException as error:
+            # connection problems / timeouts are treated like a temporary error
+            status = f'request failed ({error})'
+        else:
+            # we store successful responses in the cache (204 = no structures found for this search)
+            if get_request.status_code in [200, 204]:
+                write_cache(cache_dir, method, query_url, query_json, get_request.status_code, get_request.text)
+            if get_request.status_code == 200:
+                # If there is data returned (with HTML status code 200)
+                # then return the data in JSON format
+                return get_request.json()
+            status = f'{get_request.status_code} {get_request.text}'
+            # status code 204 means the search was successful, but there are no structures
+            # (we return an empty dict, so we can tell this apart from a failed search)
+            if get_request.status_code == 204:
+                print(f'            No data retrieved for {gene_name}; status code: {status}\n')
+                return {}
+            # there is no point in sending the same request again if the error is not a temporary one
+            # (e.g. status code 400 means the query is invalid)
+            if get_request.status_code not in retry_status_codes:
+                break
+        # wait before we try again, doubling the waiting time with every attempt (1s, 2s, 4s, ...)
+        if attempt < max_retries:
+            time.sleep(2 ** attempt)
+    # If there is no data, print status code and response, return None
+    print(f'            No data retrieved for {gene_name}; status code: {status}\n')
+    return None
+
+# define a function to build the query url for a given gene
+# if a release date is given, we only search for entries released on or after this date (incremental search)
+# if counts is True, we only ask for the number of entries instead of all pdb ids
+def build_query_url(gene_name, release_date=None, counts=False):
     # Required arguments for all nodes in search sent to pdb 
     query_type1 = "group"     # "terminal" or " group"
     
@@ -193,7 +304,16 @@ for gene in gene_list:
     # query_string_replace2 = query_string_replace1.replace("}", "%7D")
     # then I have manually inserted the variables into query_string_replace2 (that's why only certain parameters are adjustable in this script atm)
     #  query_string_with_vars = f"""%7B"query":%7B"type":"{query_type1}","logical_operator":"{log_operator}","nodes":[%7B"type":"{query_type2}","service":"{query_service2}","parameters":%7B"operator":"{parameter_operator2}","value":"{parameter_value2}","attribute":"{parameter_attribute2}"%7D%7D,%7B"type":"{query_type3}","service":"{query_service3}","parameters":%7B"operator":"{parameter_operator3}","value":"{parameter_value3}","attribute":"{parameter_attribute3}"%7D%7D]%7D,"request_options":%7B"return_all_hits":{all_hits}%7D,"return_type":"{return_type}"%7D"""
-    query_string_with_vars = f"""%7B"query":%7B"type":"{query_type1}","logical_operator":"{log_operator}","nodes":[%7B"type":"{query_type2}","service":"{query_service2}","parameters":%7B"operator":"{parameter_operator2}","value":"{parameter_value2}","attribute":"{parameter_attribute2}"%7D%7D,%7B"type":"{query_type3}","service":"{query_service3}","parameters":%7B"operator":"{parameter_operator3}","value":"{parameter_value3}","attribute":"{parameter_attribute3}"%7D%7D]%7D,"request_options":%7B"return_all_hits":{str(all_hits).lower()}%7D,"return_type":"{return_type}"%7D"""
+    # for an incremental search, we add a fourth node to the query to only get entries released on or after release_date
+    release_date_node = ''
+    if release_date is not None:
+        release_date_node = f""",%7B"type":"terminal","service":"text","parameters":%7B"operator":"greater_or_equal","value":"{release_date}","attribute":"rcsb_accession_info.initial_release_date"%7D%7D"""
+    # to only get the number of entries, we replace return_all_hits with return_counts in the request options
+    if counts:
+        request_options = '"return_counts":true'
+    else:
+        request_options = f'"return_all_hits":{str(all_hits).lower()}'
+    query_string_with_vars = f"""%7B"query":%7B"type":"{query_type1}","logical_operator":"{log_operator}","nodes":[%7B"type":"{query_type2}","service":"{query_service2}","parameters":%7B"operator":"{parameter_operator2}","value":"{parameter_value2}","attribute":"{parameter_attribute2}"%7D%7D,%7B"type":"{query_type3}","service":"{query_service3}","parameters":%7B"operator":"{parameter_operator3}","value":"{parameter_value3}","attribute":"{parameter_attribute3}"%7D%7D{release_date_node}]%7D,"request_options":%7B{request_options}%7D,"return_type":"{return_type}"%7D"""
     # now we can go on and replace " and square brackets from the query string with url-code
     query_string_replace3 = query_string_with_vars.replace('"', '%22')
     query_string_replace4 = query_string_replace3.replace("[", "%5B")
@@ -204,14 +324,285 @@ for gene in gene_list:
     query_url = base_url + "?json=" + query_string
     # https://search.rcsb.org/rcsbsearch/v1/query?json={search-request}
     # the curly brackets around the search-request are defined in the query_string
+    return query_url
+
+# define a function to build one search query for a batch of genes
+# the query looks for all entries associated with ANY of the genes in the batch (OR) and the species (AND)
+# we send this query as json in the body of a POST request, so the url doesn't get too long for many genes
+def build_batch_query(gene_names, release_date=None):
+    gene_nodes = [{"type": "terminal",
+                   "service": "text",
+                   "parameters": {"operator": "exact_match",
+                                  "value": gene_name,
+                                  "attribute": "rcsb_entity_source_organism.rcsb_gene_name.value"}} for gene_name in gene_names]
+    species_node = {"type": "terminal",
+                    "service": "text",
+                    "parameters": {"operator": "exact_match",
+                                   "value": species_name,
+                                   "attribute": "rcsb_entity_source_organism.taxonomy_lineage.name"}}
+    query_nodes = [{"type": "group", "logical_operator": "or", "nodes": gene_nodes}, species_node]
+    # for an incremental search, we only get entries released on or after release_date
+    if release_date is not None:
+        query_nodes.append({"type": "terminal",
+                            "service": "text",
+                            "parameters": {"operator": "greater_or_equal",
+                                           "value": release_date,
+                                           "attribute": "rcsb_accession_info.initial_release_date"}})
+    # we always ask for all hits here, as the max. 10 hits per gene (if all_hits is False) can only be selected
+    # once the hits have been split back per gene
+    query_json = {"query": {"type": "group",
+                            "logical_operator": log_operator,
+                            "nodes": query_nodes},
+                  "request_options": {"return_all_hits": True},
+                  "return_type": "entry"}
+    return query_json
+
+# define a function to build one query which only counts the entries for each gene in a batch
+# we use a facet on the gene name attribute, which returns the number of entries for every gene name in the results,
+# and we don't ask for any pdb ids (0 rows)
+def build_batch_count_query(gene_names):
+    query_json = build_batch_query(gene_names)
+    query_json['request_options'] = {"paginate": {"start": 0, "rows": 0},
+                                     "facets": [{"name": "entries_per_gene",
+                                                 "aggregation_type": "terms",
+                                                 "attribute": "rcsb_entity_source_organism.rcsb_gene_name.value",
+                                                 "min_interval_population": 1}]}
+    return query_json
+
+# define a function to get the (upper case) gene names and number of entries from the facets of a batch count query
+def get_counts_per_gene(batch_data):
+    counts_per_gene = {}
+    if not batch_data:
+        return counts_per_gene
+    for facet in batch_data.get('facets', []):
+        for term in facet.get('terms', []):
+            counts_per_gene[str(term['label']).upper()] = term['population']
+    return counts_per_gene
+
+# the search results of a batch query don't tell us which gene each entry was found for,
+# so we get the gene names of all polymer entities of the found entries with one bulk request to the PDB Data API (GraphQL)
+graphql_url = 'https://data.rcsb.org/graphql'
+graphql_query = """query($ids: [String!]!) {
+  entries(entry_ids: $ids) {
+    rcsb_id
+    polymer_entities {
+      rcsb_entity_source_organism {
+        rcsb_gene_name {
+          value
+        }
+      }
+    }
+  }
+}"""
+
+# for the incremental search, we get the initial release date of the found entries with bulk requests to the Data API as well
+release_date_query = """query($ids: [String!]!) {
+  entries(entry_ids: $ids) {
+    rcsb_id
+    rcsb_accession_info {
+      initial_release_date
+    }
+  }
+}"""
+
+# define a function to get the initial release date (YYYY-MM-DD) for each entry from the response of the Data API
+def get_release_date_per_entry(graphql_data):
+    release_date_per_entry = {}
+    # if the request failed, there is no data and we return an empty dictionary
+    if not graphql_data or not graphql_data.get('data') or not graphql_data['data'].get('entries'):
+        return release_date_per_entry
+    for entry in graphql_data['data']['entries']:
+        if entry is None or not (entry.get('rcsb_accession_info') or {}).get('initial_release_date'):
+            continue
+        release_date_per_entry[entry['rcsb_id'].lower()] = entry['rcsb_accession_info']['initial_release_date'][:10]
+    return release_date_per_entry
+
+# define a function to get the (upper case) gene names for each entry from the response of the Data API
+def get_gene_names_per_entry(graphql_data):
+    gene_names_per_entry = {}
+    # if the request failed, there is no data and we return an empty dictionary
+    if not graphql_data or not graphql_data.get('data') or not graphql_data['data'].get('entries'):
+        return gene_names_per_entry
+    for entry in graphql_data['data']['entries']:
+        if entry is None:
+            continue
+        gene_names = set()
+        # not all entities have a source organism and not all source organisms have gene names, so we use 'or []'
+        for entity in entry.get('polymer_entities') or []:
+            for organism in entity.get('rcsb_entity_source_organism') or []:
+                for gene_name in organism.get('rcsb_gene_name') or []:
+                    gene_names.add(gene_name['value'].upper())
+        gene_names_per_entry[entry['rcsb_id'].upper()] = gene_names
+    return gene_names_per_entry
+
+# ----------------------------------------------------------------------------------------------------------------------------------
+
+# change to results directory:
+os.chdir(results_dir)
+
+# Initiate loop over all genes in gene_list to find all PDB id's of available structures
+gene_counter = 1
+n_genes = len(gene_list)
+n_pdbs_all_genes = 0
+genes_data_available = []
+genes_no_data_available = []
+n_structures_per_gene = {}
+search_overview = pd.DataFrame(columns=['gene_name', 'n_available_structures', 'available_structures'])
+
+print(f'\n======================== Searching PDB IDs for {n_genes} inputted genes ========================\n')
+print(f'Sending up to {n_workers} search requests at the same time (max. {rate_limit} requests per second)\n')
+
+# INCREMENTAL SEARCH (webserver runs only)
+# for genes which have already been searched in a previous webserver run, we only ask the PDB for entries released since then
+# and merge them with the PDB ids found before. The latest initial release date of all entries found for each gene is stored
+# in the mutafy directory and used as the high-water mark (we search from this date on, inclusive, so we never miss entries
+# released on the same day). Entries are never removed in an incremental search, so if the last search for all structures
+# of a gene is more than max_mark_age days ago, we search for all structures again (this removes obsolete entries and
+# entries which are no longer associated with the gene)
+# this only works if we retrieve all pdb ids per gene (we can't merge the max. 10 hits per gene)
+incremental_file = f'{mutafy_directory}/00_search_high_water_marks_mutafy.csv'
+high_water_mark_columns = ['gene_name', 'species', 'last_release_date', 'last_full_search_date', 'available_structures']
+use_incremental_search = web_run and incremental_search and all_hits and log_operator == 'and' and not counts_only
+search_date = datetime.utcnow().strftime('%Y-%m-%d')
+previous_searches = {}
+if use_incremental_search and exists(incremental_file):
+    high_water_marks = pd.read_csv(incremental_file, keep_default_na=False)
+    # (files written by older versions don't have the date of the last full search, so we search for all structures again)
+    if set(high_water_mark_columns).issubset(high_water_marks.columns):
+        for index, row in high_water_marks[high_water_marks.species == species_name].iterrows():
+            if not row.last_release_date or not row.last_full_search_date:
+                continue
+            mark_age = (datetime.strptime(search_date, '%Y-%m-%d') - datetime.strptime(row.last_full_search_date, '%Y-%m-%d')).days
+            if max_mark_age > 0 and mark_age > max_mark_age:
+                continue
+            previous_searches[row.gene_name] = (row.last_release_date, row.last_full_search_date, ast.literal_eval(row.available_structures))
+    n_incremental = len([gene for gene in gene_list if gene in previous_searches])
+    print(f'{n_incremental} of {n_genes} genes have been searched before, only searching for structures released since the last search for these genes\n')
+# get the release date from which on we search for each gene (None = get all entries)
+release_dates = [previous_searches[gene][0] if gene in previous_searches else None for gene in gene_list]
+
+# perfom search
+# we send the search requests for all genes at the same time (max. n_workers requests in flight)
+# executor.map returns the results in the same order as the input genes, so the output files stay in the input gene order
+if batch_search == False:
+    query_urls = [build_query_url(gene, release_date, counts_only) for gene, release_date in zip(gene_list, release_dates)]
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        all_pdb_data = list(executor.map(search_pdb, query_urls, gene_list))
+
+# if we only want the number of structures per gene in batch mode, we get them from the facets of one query per batch
+# (we put the counts in the same format as the result of a single gene count query: {'total_count': n})
+elif counts_only:
+    gene_batches = [gene_list[i:i + max(batch_size, 1)] for i in range(0, n_genes, max(batch_size, 1))]
+    print(f'Counting PDB structures for {n_genes} genes in {len(gene_batches)} batch(es) of up to {batch_size} genes\n')
+    batch_queries = [build_batch_count_query(gene_batch) for gene_batch in gene_batches]
+    batch_names = [f'batch {i + 1} of {len(gene_batches)}' for i in range(len(gene_batches))]
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        batch_results = list(executor.map(search_pdb, [base_url] * len(gene_batches), batch_names, batch_queries))
+    pdb_data_per_gene = {}
+    for gene_batch, batch_data in zip(gene_batches, batch_results):
+        counts_per_gene = get_counts_per_gene(batch_data)
+        for gene in gene_batch:
+            if batch_data is None:
+                pdb_data_per_gene[gene] = None
+            elif counts_per_gene.get(gene.upper(), 0) > 0:
+                pdb_data_per_gene[gene] = {'total_count': counts_per_gene[gene.upper()]}
+            else:
+                pdb_data_per_gene[gene] = {}
+    all_pdb_data = [pdb_data_per_gene[gene] for gene in gene_list]
+        
+# in batch mode, we search for batch_size genes with one request and split the hits back per gene afterwards
+else:
+    # genes can only be searched in the same batch if we search from the same release date on,
+    # so we first group the genes by release date and then make batches of each group
+    genes_per_release_date = {}
+    for gene, release_date in zip(gene_list, release_dates):
+        genes_per_release_date.setdefault(release_date, []).append(gene)
+    gene_batches = []
+    batch_release_dates = []
+    for release_date, genes_this_release_date in genes_per_release_date.items():
+        for i in range(0, len(genes_this_release_date), max(batch_size, 1)):
+            gene_batches.append(genes_this_release_date[i:i + max(batch_size, 1)])
+            batch_release_dates.append(release_date)
+    print(f'Searching the PDB for {n_genes} genes in {len(gene_batches)} batch(es) of up to {batch_size} genes\n')
+    batch_queries = [build_batch_query(gene_batch, release_date) for gene_batch, release_date in zip(gene_batches, batch_release_dates)]
+    batch_names = [f'batch {i + 1} of {len(gene_batches)}' for i in range(len(gene_batches))]
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        batch_results = list(executor.map(search_pdb, [base_url] * len(gene_batches), batch_names, batch_queries))
     
-    # ----------------------------------------------------------------------------------------------------------------------------------
-    # perfom search
+        # get a list of all pdb ids found for each batch (in the order returned by the PDB API)
+        batch_pdb_ids = []
+        for batch_data in batch_results:
+            try:
+                batch_pdb_ids.append([entry['identifier'].upper() for entry in batch_data['result_set']])
+            except (TypeError, KeyError):
+                batch_pdb_ids.append([])
+        
+        # now we get the gene names for all found entries with bulk requests to the Data API (max. 500 entries per request)
+        all_batch_pdb_ids = sorted(set(pdb_id for pdb_ids in batch_pdb_ids for pdb_id in pdb_ids))
+        id_chunks = [all_batch_pdb_ids[i:i + 500] for i in range(0, len(all_batch_pdb_ids), 500)]
+        graphql_queries = [{'query': graphql_query, 'variables': {'ids': id_chunk}} for id_chunk in id_chunks]
+        chunk_names = [f'metadata request {i + 1} of {len(id_chunks)}' for i in range(len(id_chunks))]
+        graphql_results = list(executor.map(search_pdb, [graphql_url] * len(id_chunks), chunk_names, graphql_queries))
+    
+    gene_names_per_entry = {}
+    for graphql_data in graphql_results:
+        gene_names_per_entry.update(get_gene_names_per_entry(graphql_data))
+    
+    # finally we split the hits of each batch back per gene and put them in the same format as the results of a single gene search,
+    # so the rest of the script works the same way for both modes
+    # (None = the search failed, {} = no structures found for this gene)
+    pdb_data_per_gene = {}
+    for gene_batch, batch_data, pdb_ids in zip(gene_batches, batch_results, batch_pdb_ids):
+        # if the search for this batch failed or we couldn't get the gene names for all of its entries, the search failed for all genes in the batch
+        batch_failed = batch_data is None or any(pdb_id not in gene_names_per_entry for pdb_id in pdb_ids)
+        for gene in gene_batch:
+            found_for_gene = [pdb_id for pdb_id in pdb_ids if gene.upper() in gene_names_per_entry.get(pdb_id, set())]
+            # if we only want max. 10 pdb ids per gene, we take the first 10 (the hits are sorted by score by the PDB API)
+            if all_hits == False:
+                found_for_gene = found_for_gene[:10]
+            if batch_failed:
+                pdb_data_per_gene[gene] = None
+            elif found_for_gene:
+                pdb_data_per_gene[gene] = {'result_set': [{'identifier': pdb_id} for pdb_id in found_for_gene]}
+            else:
+                pdb_data_per_gene[gene] = {}
+    all_pdb_data = [pdb_data_per_gene[gene] for gene in gene_list]
+
+# we keep track of which searches were successful, so we only update the high-water mark for these genes
+search_succeeded = [pdb_data is not None for pdb_data in all_pdb_data]
+
+# for genes searched incrementally, we merge the new entries with the pdb ids found in previous searches
+for i, gene in enumerate(gene_list):
+    if gene not in previous_searches:
+        continue
+    last_release_date, last_full_search_date, previous_pdb_ids = previous_searches[gene]
+    if all_pdb_data[i] is None:
+        # if the search failed, we use the pdb ids from the previous search
+        print(f'            Incremental search failed for {gene}, using the {len(previous_pdb_ids)} PDB IDs found in the previous search\n')
+        new_pdb_ids = []
+    else:
+        new_pdb_ids = [entry['identifier'].lower() for entry in all_pdb_data[i].get('result_set', [])]
+    merged_pdb_ids = sorted(set(previous_pdb_ids) | set(new_pdb_ids))
+    all_pdb_data[i] = {'result_set': [{'identifier': pdb_id} for pdb_id in merged_pdb_ids]} if merged_pdb_ids else {}
+
+for gene, pdb_data in zip(gene_list, all_pdb_data):
+    gene_name = gene
        
-    print(f">>> Searching the PDB for gene {gene_counter} of {n_genes}:             {gene_name}")
+    print(f">>> Searched the PDB for gene {gene_counter} of {n_genes}:             {gene_name}")
     print(f'            Search terms:                            "{gene_name}" {log_operator.upper()} "{species_name}"')
     
-    pdb_data = search_pdb(query_url)
+    # if we only asked for the number of structures, we don't get any pdb ids, just the total count
+    if counts_only:
+        if pdb_data and pdb_data.get('total_count', 0) > 0:
+            genes_data_available.append(gene_name)
+            n_structures_per_gene[gene_name] = pdb_data['total_count']
+            n_pdbs_all_genes += pdb_data['total_count']
+            print(f'            Number of structures available :         {pdb_data["total_count"]} \n')
+        else:
+            genes_no_data_available.append(gene_name)
+        gene_counter += 1
+        continue
+    
     # this is actual data coming from the PDB API
     # as this contains information we don't need (metadata etc.), we isolate the results
     # and then create a list containing all pdb ids ("identifiers")
@@ -234,13 +625,59 @@ for gene in gene_list:
     print(f'            Number of PDB IDs retrieved :            {len(found_pdbs)} \n')
     # add number of found pdb ID's to counter n_pdbs_all_genes
     n_pdbs_all_genes += len(found_pdbs)
+    n_structures_per_gene[gene_name] = len(found_pdbs)
     # append information to search_overview df to later write to file
     # in order to add a new row to the bottom of the df, we use .loc and specify the index as the current df lenght!
     search_overview.loc[len(search_overview)] = [gene, len(found_pdbs), found_pdbs]
     gene_counter += 1
 
 # write search_overview to csv file 
-search_overview.to_csv(f'{results_dir}/00_search_overview_PDBids.csv', index = False)
+# (if we only counted the structures, we don't have any pdb ids and only write the availability file below)
+if not counts_only:
+    search_overview.to_csv(f'{results_dir}/00_search_overview_PDBids.csv', index = False)
+
+# for the incremental search in the next webserver run, we store the latest initial release date of all entries found
+# for each gene (high-water mark), the date of the last search for all structures and all pdb ids found for each gene
+# in the mutafy directory (only for genes for which the search was successful)
+if use_incremental_search:
+    found_pdbs_per_gene = dict(zip(search_overview.gene_name, search_overview.available_structures))
+    searched_genes = [gene for gene, succeeded in zip(gene_list, search_succeeded) if succeeded]
+    # we only need the release dates of the entries which are new since the previous search
+    new_pdbs_per_gene = {gene: sorted(set(found_pdbs_per_gene.get(gene, [])) - set(previous_searches[gene][2] if gene in previous_searches else [])) for gene in searched_genes}
+    new_pdb_ids = sorted(set(pdb_id for pdb_ids in new_pdbs_per_gene.values() for pdb_id in pdb_ids))
+    id_chunks = [new_pdb_ids[i:i + 500] for i in range(0, len(new_pdb_ids), 500)]
+    graphql_queries = [{'query': release_date_query, 'variables': {'ids': id_chunk}} for id_chunk in id_chunks]
+    chunk_names = [f'release date request {i + 1} of {len(id_chunks)}' for i in range(len(id_chunks))]
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        graphql_results = list(executor.map(search_pdb, [graphql_url] * len(id_chunks), chunk_names, graphql_queries))
+    release_date_per_entry = {}
+    for graphql_data in graphql_results:
+        release_date_per_entry.update(get_release_date_per_entry(graphql_data))
+    last_release_dates = []
+    last_full_search_dates = []
+    for gene in searched_genes:
+        last_release_date, last_full_search_date = previous_searches[gene][:2] if gene in previous_searches else ('', search_date)
+        new_release_dates = [release_date_per_entry.get(pdb_id) for pdb_id in new_pdbs_per_gene[gene]]
+        # if we couldn't get the release date of all new entries, we keep the previous high-water mark
+        # (after a search for all structures or if no structures were found, there is no mark, so we search for all structures again next time)
+        if None not in new_release_dates:
+            last_release_date = max([last_release_date] + new_release_dates)
+        last_release_dates.append(last_release_date)
+        last_full_search_dates.append(last_full_search_date)
+    updated_high_water_marks = pd.DataFrame({'gene_name': searched_genes})
+    updated_high_water_marks['species'] = species_name
+    updated_high_water_marks['last_release_date'] = last_release_dates
+    updated_high_water_marks['last_full_search_date'] = last_full_search_dates
+    updated_high_water_marks['available_structures'] = [str(found_pdbs_per_gene.get(gene, [])) for gene in searched_genes]
+    if exists(incremental_file):
+        # we keep the rows of all other genes/species from previous runs and replace the rows of the genes searched now
+        # (rows written by older versions get empty dates, so these genes are searched for all structures next time)
+        high_water_marks = pd.read_csv(incremental_file, keep_default_na=False)
+        high_water_marks = high_water_marks[~((high_water_marks.species == species_name) & (high_water_marks.gene_name.isin(updated_high_water_marks.gene_name)))]
+        high_water_marks = high_water_marks.reindex(columns=high_water_mark_columns, fill_value='')
+        updated_high_water_marks = pd.concat([high_water_marks, updated_high_water_marks], ignore_index=True)
+    updated_high_water_marks.sort_values(by=['gene_name', 'species'], inplace=True)
+    updated_high_water_marks.to_csv(incremental_file, index=False)
 # if we run MutaPipe via webserver, we also write the output in the mutafy directory:
 
 # HOOOKAAAY, SO THINK ABOUT THIS AGAIN (everything below added for the webserver)
@@ -282,30 +719,40 @@ search_overview.to_csv(f'{results_dir}/00_search_overview_PDBids.csv', index = F
 
 
 # write a csv file that contains a boolean value for each gene to indicate whether there are any structures available or not
+# and the number of available structures for each gene
 # create an empty dataframe
-df = pd.DataFrame(columns=['gene_name', 'data_available'])
+df = pd.DataFrame(columns=['gene_name', 'data_available', 'n_available_structures'])
 # populate df with information on availability
 for gene in gene_list:
     if gene in genes_data_available:
-        df.loc[len(df)] = [gene, True]
+        df.loc[len(df)] = [gene, True, n_structures_per_gene[gene]]
     elif gene in genes_no_data_available:
-        df.loc[len(df)] = [gene, False]
+        df.loc[len(df)] = [gene, False, 0]
     else:
-        df.loc[len(df)] = [gene, np.nan]
+        df.loc[len(df)] = [gene, np.nan, np.nan]
         
 df.to_csv(f'{results_dir}/00_search_overview_availability.csv', index = False)
 
+# remove the least recently used responses from the cache if it has grown too large
+evict_cache(cache_dir, max_cache_size)
+
 # change back to target directory
 os.chdir(target_directory)
 
 print('\n============================== Summary ================================================\n')
-print(f'    o      A total of {n_pdbs_all_genes} PDB IDs have been found for the inputted gene list.')
+if counts_only:
+    print(f'    o      A total of {n_pdbs_all_genes} PDB structures are available for the inputted gene list (only counted, no PDB IDs retrieved).')
+else:
+    print(f'    o      A total of {n_pdbs_all_genes} PDB IDs have been found for the inputted gene list.')
 print(f'    o      PDB IDs have been found for {len(genes_data_available)} out of {n_genes} gene(s) on your list.')
 print(f'    o      No PDB IDs have been found for {len(genes_no_data_available)} gene(s).\n')
 
 print('The following files have been created:')
 print('   o      00_search_overview_availability.csv      (contains information on which genes have available structures)')
-print('   o      00_search_overview_PDBids.csv            (contains information on which PDB IDs are available per structures)\n\n')
+if counts_only:
+    print('\n')
+else:
+    print('   o      00_search_overview_PDBids.csv            (contains information on which PDB IDs are available per structures)\n\n')
 
 # print script name to console/log file
 print(f'end of script {script_name}')
@@ -9,12 +9,21 @@ import pandas as pd
 import ast
 import requests
 import os
+import hashlib
+import tempfile
+from Bio.PDB.MMCIF2Dict import MMCIF2Dict
 from os import listdir
-from os.path import isfile, join
-from Bio.PDB import *
+from os.path import join
 import sys
 import argparse
 from datetime import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+# functions to read the structure files (shared by scripts 01, 02 and 03)
+from mutapipe_structure_files import open_structure_file, read_cif_category
+# functions to cache responses from the APIs on disk (shared by all MutaPipe scripts which get data from an API)
+from mutapipe_cache import cached_request, evict_cache
 
 # get this script's name:
 script_name = os.path.basename(__file__)
@@ -38,17 +47,46 @@ def str2bool(v):
 
 create_search_log = False     # will create a file called search_log.txt with console output if set to True,
                                             # prints to console if set to False.
-download_format =  'cif pdb fasta'      # specify which file formats to download from the PDB for the input data
+download_format =  'cif fasta'      # specify which file formats to download from the PDB for the input data
                                             # use the following abbreviations 
                                                 # for mmCif files (.cif) use 'cif'
+                                                # for BinaryCIF files (.bcif, smaller and faster to parse than mmCIF files, needs msgpack in scripts 02 and 03) use 'bcif'
                                                 # for pdb files (.pdb) use 'pdb'
                                                 # for fasta files (.fasta) use 'fasta'
 
+top_k_structures = 0 # specify number of structures with the best resolution to be downloaded per sequence (0 = download all structures)
+                                            # should be the same as (or larger than) n_best_structures in script 07
+                                            # and larger if script 07 excludes unsolved mismatches (-e True), e.g. twice n_best_structures
+
+plan_downloads = False # specify if only the file formats which are needed by the following scripts should be downloaded (True) or all specified formats (False)
+
+downstream_stages = '02 03 04' # specify which of the scripts parsing the downloaded files will be run after this one (used to plan the downloads)
+
 target_directory = os.getcwd()    # set target directory (where Results folder is located)
 
 web_run = True # specify if pdb mmcif and fasta files should be stored in separate directory
 
 mutafy_directory = f'{target_directory}/mutafy' # set path to folder where structures will be/are stored
+
+n_workers = 8 # maximum number of files downloaded from the PDB at the same time
+
+max_retries = 3 # number of times a failed download is retried (with exponential backoff)
+
+compress_files = False # specify if mmCIF and pdb files should be stored gzip compressed (.cif.gz, .pdb.gz) as served by the PDB (True) or uncompressed (False)
+
+use_store = False # specify if files should be stored only once in a shared structure store and linked into the gene folders (True) or downloaded into every gene folder (False)
+
+store_directory = f'{target_directory}/structure_store' # set path to shared structure store (one folder per pdb id and revision)
+
+pdb_mirror = None # set path to a local wwPDB mirror (e.g. rsync'd nightly) which is used instead of downloading files from the PDB if specified
+
+local_fasta = False # specify if fasta files should be generated from the mmCIF files (True) instead of downloading them from the PDB (False)
+
+use_cache = True # store responses from the PDB GraphQL API on disk and reuse them in later runs (True) or always get data from the network (False)
+
+cache_dir = f'{os.path.expanduser("~")}/.cache/MutaPipe' # set path to directory where responses from the APIs are cached
+
+max_cache_size = 1024 # maximum size of the cache directory in MB (least recently used responses are removed first)
                                             
                                             
 # Now we create an argument parser called ap to which we can add the arguments we want to have in the terminal
@@ -58,21 +96,54 @@ ap = argparse.ArgumentParser(description="""****    This script takes a csv file
 3. outputs a csv file called 01_search_overview_folders listing all the the newly created folders and their contents 
 4. outputs a csv file called 01_search_overview_n_structures.csv listing the number of structures retrieved per gene    ***""")
 
-ap.add_argument('-f','--format', nargs='+', required=False, help=f"Specify file format to be downloaded. For mmCif files (.cif) use 'cif' ; for pdb files (.pdb) use 'pdb' ; for fasta files (.fasta) use 'fasta' ; default = {download_format}")
+ap.add_argument('-f','--format', nargs='+', required=False, help=f"Specify file format to be downloaded. For mmCif files (.cif) use 'cif' ; for BinaryCIF files (.bcif) use 'bcif' ; for pdb files (.pdb) use 'pdb' ; for fasta files (.fasta) use 'fasta' ; default = {download_format}")
+ap.add_argument("-k", "--top_k", type=int, required = False, help=f'Specify number of structures with the best resolution to be downloaded for every distinct sequence of a gene (should be at least n_best_structures of script 07, larger if script 07 is run with -e True, as it can only list downloaded structures; the wildtype structures listed by script 07 are then also only the downloaded ones; 0 = download all structures), default = {str(top_k_structures)}')
+ap.add_argument("-pl", "--plan", type=str2bool, required = False, help=f'Specify whether to only download the file formats needed by the following scripts (True) or all specified formats (False), default = {str(plan_downloads)}')
+ap.add_argument("-st", "--stages", nargs='+', required = False, help=f"Specify which of the scripts parsing the downloaded files will be run after this one (used to plan the downloads). For 02_parse_cif_files use '02' ; for 03_parse_pdb_files_extract_unsolved_residues use '03' ; for 04_parse_fasta_files use '04' ; default = {downstream_stages}")
 ap.add_argument("-l", "--log", type=str2bool, required = False, help=f'write output to .log file in current directory if set to True, default = {str(create_search_log)}')
 ap.add_argument("-t", "--target", required = False, help=f'specify target directory, default = {target_directory}')
 ap.add_argument("-w", "--web_run", type=str2bool, required = False, help=f'Indicate whether MutaPipe is run via a webserver (True) or not (False), default = {str(mutafy_directory)}')
 ap.add_argument("-m", "--mutafy", required = False, help=f'set path to mutafy directory where information from previous runs is stored, default = {mutafy_directory}')
+ap.add_argument("-wk", "--workers", type=int, required = False, help=f'Specify maximum number of files downloaded from the PDB at the same time, default = {str(n_workers)}')
+ap.add_argument("-rt", "--retries", type=int, required = False, help=f'Specify number of times a failed download is retried, default = {str(max_retries)}')
+ap.add_argument("-gz", "--gzip", type=str2bool, required = False, help=f'Specify whether to store mmCIF and pdb files gzip compressed (True) or uncompressed (False), default = {str(compress_files)}')
+ap.add_argument("-ss", "--shared_store", type=str2bool, required = False, help=f'Specify whether to store every file only once in a shared structure store and link it into the gene folders (True) or download it into every gene folder (False), default = {str(use_store)}')
+ap.add_argument("-sd", "--store_dir", required = False, help=f'Set path to shared structure store, default = {store_directory}')
+ap.add_argument("-mr", "--mirror", required = False, help=f'Set path to a local wwPDB mirror with the standard divided layout (data/structures/divided/mmCIF/xy/1xyz.cif.gz); files which are not in the mirror are downloaded, default = {str(pdb_mirror)}')
+ap.add_argument("-lf", "--local_fasta", type=str2bool, required = False, help=f'Specify whether to generate fasta files from the downloaded mmCIF files (True) or download them from the PDB (False), default = {str(local_fasta)}')
+ap.add_argument("-ca", "--cache", type=str2bool, required = False, help=f'Specify whether to cache responses from the APIs on disk (True) or not (False), default = {str(use_cache)}')
+ap.add_argument("-cd", "--cache_dir", required = False, help=f'Set path to directory where responses from the APIs are cached, default = {cache_dir}')
+ap.add_argument("-cs", "--cache_size", type=int, required = False, help=f'Specify maximum size of the cache directory in MB, default = {str(max_cache_size)}')
 
 args = vars(ap.parse_args())
 
 # Now, in case an argument is used via the terminal, this input has to overwrite the default option we set above
 # So we update our variables whenever there is a user input via the terminal:
 download_format = download_format if args["format"] == None else args["format"]
+top_k_structures = top_k_structures if args["top_k"] == None else args["top_k"]
+plan_downloads = plan_downloads if args["plan"] == None else args["plan"]
+downstream_stages = downstream_stages if args["stages"] == None else args["stages"]
 create_search_log  = create_search_log  if args["log"]   == None else args["log"]
 target_directory  = target_directory if args["target"]   == None else args["target"]
 web_run = web_run if args["web_run"] == None else args["web_run"]
 mutafy_directory = mutafy_directory if args["mutafy"] == None else args["mutafy"]
+n_workers = n_workers if args["workers"] == None else args["workers"]
+max_retries = max_retries if args["retries"] == None else args["retries"]
+compress_files = compress_files if args["gzip"] == None else args["gzip"]
+use_store = use_store if args["shared_store"] == None else args["shared_store"]
+store_directory = store_directory if args["store_dir"] == None else os.path.abspath(args["store_dir"])
+pdb_mirror = pdb_mirror if args["mirror"] == None else os.path.abspath(args["mirror"])
+local_fasta = local_fasta if args["local_fasta"] == None else args["local_fasta"]
+# the formats and stages can be given as one string (e.g. 'cif fasta') or as a list (e.g. ['cif', 'fasta'] or ['cif fasta']),
+# so we split them into a list with one entry per format/stage (otherwise 'cif' in 'bcif fasta' would be True)
+download_format = download_format.split() if isinstance(download_format, str) else [f for formats in download_format for f in formats.split()]
+downstream_stages = downstream_stages.split() if isinstance(downstream_stages, str) else [s for stages in downstream_stages for s in stages.split()]
+use_cache = use_cache if args["cache"] == None else args["cache"]
+cache_dir = cache_dir if args["cache_dir"] == None else os.path.abspath(args["cache_dir"])
+max_cache_size = max_cache_size if args["cache_size"] == None else args["cache_size"]
+# if responses should not be cached, we don't use a cache directory at all
+if not use_cache:
+    cache_dir = None
 
 
 # ----------------------------------------------------------------------------------------------------------------------------------
@@ -86,6 +157,387 @@ if web_run:
     if not os.path.exists(mutafy_directory):
         os.mkdir(mutafy_directory)
 # ----------------------------------------------------------------------------------------------------------------------------------
+# set up downloads
+
+# urls to download the files for a pdb id in each of the formats
+download_urls = {'cif': 'https://files.rcsb.org/download/{}.cif',
+                 'bcif': 'https://models.rcsb.org/{}.bcif',
+                 'pdb': 'https://files.rcsb.org/download/{}.pdb',
+                 'fasta': 'https://www.rcsb.org/fasta/entry/{}'}
+
+# status codes for which it is worth trying the same download again (rate limited or temporary server problems)
+retry_status_codes = [429, 500, 502, 503, 504]
+
+# we keep one requests session per worker thread, so every worker can reuse its (keep-alive) connection to the PDB
+thread_data = threading.local()
+
+def get_session():
+    if not hasattr(thread_data, 'session'):
+        thread_data.session = requests.Session()
+    return thread_data.session
+
+# define a function to get the filename for a pdb id in a given format
+# (if specified, mmCIF and pdb files are stored gzip compressed, exactly as they are served by the PDB;
+# BinaryCIF files are always stored as they are, because they are already compressed)
+def get_filename(pdb_id, file_format):
+    if compress_files == True and file_format in ['cif', 'pdb']:
+        return f'{pdb_id}.{file_format}.gz'
+    return f'{pdb_id}.{file_format}'
+
+# every gene folder (and every folder in the shared structure store) has a manifest listing all files which have been downloaded
+# completely, so a rerun only downloads missing or corrupt files (e.g. after an interrupted run or after files have been deleted by scripts 02-04)
+manifest_filename = '01_download_manifest.csv'
+manifest_columns = ['pdb_id', 'file_format', 'filename', 'size', 'mtime', 'checksum', 'revision']
+
+# create an empty dictionary to populate with the manifests of all folders in the format {folder_name: {(pdb_id, file_format): entry}}
+manifests = {}
+
+# files are first written to a temporary file in the same folder and then renamed, so we never have partially written files
+# (temporary files left behind by an interrupted run start with this prefix and are removed on the next run)
+temp_file_prefix = '.download_'
+
+# define a function to remove the temporary files left behind by an interrupted run from a folder
+# (folders in the shared structure store can be used by several runs at the same time, so there we only remove temporary files
+# which haven't been written to for at least min_age seconds and can't belong to a download which is still in progress)
+def remove_temp_files(folder_name, min_age=0):
+    for f in listdir(folder_name):
+        if f.startswith(temp_file_prefix):
+            try:
+                if time.time() - os.path.getmtime(join(folder_name, f)) >= min_age:
+                    os.remove(join(folder_name, f))
+            except OSError:
+                pass
+
+# define a function to calculate the checksum of a file
+def get_checksum(filename):
+    checksum = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+# define a function to get the modification time of a file (in nanoseconds, as a string like all columns of the manifest)
+def get_mtime(filename):
+    return str(os.stat(filename).st_mtime_ns)
+
+# define a function to get the manifest of a folder
+def get_manifest(folder_name):
+    """
+    This function will read the manifest of a folder (if it hasn't been read yet)
+    and only keep the entries for files which still exist and have the recorded size and checksum
+    (the checksum is only calculated again if the size or modification time of a file has changed since it was recorded)
+    
+    :param folder_name: string
+    :return: Dict {(pdb_id, file_format): entry}
+    """
+    if folder_name not in manifests:
+        manifest = {}
+        manifest_file = f'{folder_name}/{manifest_filename}'
+        if os.path.exists(manifest_file):
+            # (we read all columns as strings, as pdb ids like '1e10' would otherwise be read as numbers)
+            # if a file is listed more than once, the last entry is the current one
+            for entry in pd.read_csv(manifest_file, dtype=str, keep_default_na=False).to_dict('records'):
+                manifest[(entry['pdb_id'], entry['file_format'])] = entry
+        for key, entry in list(manifest.items()):
+            filename = f'{folder_name}/{entry["filename"]}'
+            if not os.path.exists(filename) or str(os.path.getsize(filename)) != entry['size']:
+                del manifest[key]
+            elif get_mtime(filename) != entry.get('mtime'):
+                # (manifests written by older versions have no modification times, so all files are checked once)
+                if get_checksum(filename) != entry['checksum']:
+                    del manifest[key]
+                else:
+                    entry['mtime'] = get_mtime(filename)
+        manifests[folder_name] = manifest
+    return manifests[folder_name]
+
+# define a function to add a file to the manifest of a folder
+def add_to_manifest(folder_name, pdb_id, file_format, filename, size, checksum, revision):
+    entry = {'pdb_id': pdb_id, 'file_format': file_format, 'filename': filename, 'size': str(size), 'mtime': get_mtime(f'{folder_name}/{filename}'), 'checksum': checksum, 'revision': revision}
+    get_manifest(folder_name)[(pdb_id, file_format)] = entry
+    # we append the entry to the manifest file straight away, so it's not lost if the script is interrupted
+    manifest_file = f'{folder_name}/{manifest_filename}'
+    pd.DataFrame([entry], columns=manifest_columns).to_csv(manifest_file, mode='a', header=not os.path.exists(manifest_file), index=False)
+
+# define a function to write the manifest of a folder (only one entry per file)
+def write_manifest(folder_name):
+    manifest = pd.DataFrame(list(get_manifest(folder_name).values()), columns=manifest_columns).sort_values(by=['pdb_id', 'file_format'])
+    temp_file = f'{folder_name}/{temp_file_prefix}{manifest_filename}'
+    manifest.to_csv(temp_file, index=False)
+    os.replace(temp_file, f'{folder_name}/{manifest_filename}')
+
+# define a function to download one file (task = (gene, pdb_id, file_format, folder_name))
+def download_file(task):
+    """
+    This function will download the file for one pdb id in the given format
+    and store it as {pdb_id}.{file_format} (or {pdb_id}.{file_format}.gz) in the gene folder;
+    the file is written to a temporary file first, which is renamed once the download is complete;
+    if the download fails with a temporary error it will be retried with exponential backoff
+    
+    :param task: Tuple (gene, pdb_id, file_format, folder_name)
+    :return: Tuple (task, status, file_info) with status = 200 and file_info = Dict (filename, size, checksum, last_modified) if the file has been downloaded
+    """
+    gene, pdb_id, file_format, folder_name = task
+    filename = get_filename(pdb_id, file_format)
+    url = download_urls[file_format].format(pdb_id.upper())
+    if filename.endswith('.gz'):
+        url += '.gz'
+    for attempt in range(max_retries + 1):
+        temp_file = None
+        try:
+            with get_session().get(url, timeout=120, stream=True) as response:
+                if response.status_code == 200:
+                    # we calculate size and checksum while writing the file
+                    checksum = hashlib.sha256()
+                    size = 0
+                    file_descriptor, temp_file = tempfile.mkstemp(dir=folder_name, prefix=temp_file_prefix)
+                    with os.fdopen(file_descriptor, 'wb') as file:
+                        for chunk in response.iter_content(chunk_size=1024 * 1024):
+                            file.write(chunk)
+                            checksum.update(chunk)
+                            size += len(chunk)
+                    os.replace(temp_file, f'{folder_name}/{filename}')
+                    file_info = {'filename': filename, 'size': size, 'checksum': checksum.hexdigest(), 'last_modified': response.headers.get('Last-Modified', '')}
+                    return task, 200, file_info
+                status = response.status_code
+        except (requests.exceptions.RequestException, OSError) as error:
+            # connection problems / timeouts are treated like a temporary error
+            status = f'request failed ({error})'
+            if temp_file is not None and os.path.exists(temp_file):
+                os.remove(temp_file)
+        else:
+            # there is no point in trying again if the error is not a temporary one
+            # (e.g. status code 404 means there is no file in this format, like pdb files for very large structures)
+            if status not in retry_status_codes:
+                break
+        # wait before we try again, doubling the waiting time with every attempt (1s, 2s, 4s, ...)
+        if attempt < max_retries:
+            time.sleep(2 ** attempt)
+    return task, status, None
+
+# we get metadata for many pdb ids at once from the PDB GraphQL API
+graphql_url = 'https://data.rcsb.org/graphql'
+
+# define a function to get metadata for a list of pdb ids
+def get_entry_metadata(graphql_query, pdb_ids):
+    """
+    This function will send the given GraphQL query for all given pdb ids
+    to the PDB GraphQL API (500 pdb ids per request) or get the responses from the cache;
+    if a request fails with a temporary error it will be retried with exponential backoff
+    
+    :param graphql_query: string (query with the variable $ids for the list of pdb ids)
+    :param pdb_ids: List
+    :return: Dict {pdb_id: entry} (pdb ids for which no metadata could be retrieved are missing)
+    """
+    entries = {}
+    for i in range(0, len(pdb_ids), 500):
+        query_json = {'query': graphql_query, 'variables': {'ids': [pdb_id.upper() for pdb_id in pdb_ids[i:i+500]]}}
+        retrieved = False
+        for attempt in range(max_retries + 1):
+            response = cached_request(cache_dir, 'POST', graphql_url, query_json, session=get_session())
+            if response.status_code == 200:
+                for entry in (response.json().get('data') or {}).get('entries') or []:
+                    entries[entry['rcsb_id'].lower()] = entry
+                retrieved = True
+                break
+            # (if the request failed or timed out, status_code is None and we try again)
+            status = response.status_code if response.status_code is not None else response.text
+            if response.status_code is not None and response.status_code not in retry_status_codes:
+                break
+            if attempt < max_retries:
+                time.sleep(2 ** attempt)
+        if retrieved == False:
+            print(f'Could not retrieve metadata for {len(pdb_ids[i:i+500])} pdb ids; status code: {status}')
+    return entries
+
+# to store every entry only once in the shared structure store, we need to know its current revision
+# (if an entry is revised, the new revision is downloaded into a new folder in the store once the cached response
+# from the GraphQL API has expired, see cache_ttls in mutapipe_cache.py)
+revision_query = """query($ids: [String!]!) {
+  entries(entry_ids: $ids) {
+    rcsb_id
+    rcsb_accession_info { major_revision minor_revision }
+  }
+}"""
+
+# define a function to get the current revision for a list of pdb ids
+def get_revisions(pdb_ids):
+    """
+    This function will get the current revision (e.g. '1.3') for all given pdb ids
+    
+    :param pdb_ids: List
+    :return: Dict {pdb_id: revision} (pdb ids for which no revision could be retrieved are missing)
+    """
+    revisions = {}
+    for pdb_id, entry in get_entry_metadata(revision_query, pdb_ids).items():
+        accession_info = entry.get('rcsb_accession_info') or {}
+        if accession_info.get('major_revision') is not None:
+            revisions[pdb_id] = f"{accession_info['major_revision']}.{accession_info.get('minor_revision') or 0}"
+    return revisions
+
+# to only download the structures which could be among the n best structures (best resolution) listed by script 07,
+# we get resolution, method and sequences of all structures before downloading any of them
+top_k_query = """query($ids: [String!]!) {
+  entries(entry_ids: $ids) {
+    rcsb_id
+    rcsb_entry_info { experimental_method }
+    refine { ls_d_res_high }
+    refine_hist { d_res_high }
+    em3d_reconstruction { resolution }
+    polymer_entities {
+      entity_poly { pdbx_seq_one_letter_code_can }
+      rcsb_entity_source_organism { rcsb_gene_name { value } }
+    }
+  }
+}"""
+
+# define a function to get the resolution of an entry from its metadata
+# (script 07 ranks the structures by the resolution script 02 reads from the mmCIF header, so we use the same items in the same order:
+# _refine.ls_d_res_high, _refine_hist.d_res_high, _em_3d_reconstruction.resolution;
+# not all structures have resolutions, as in script 02 we replace missing values with 999)
+def get_resolution(entry):
+    for category, item in [('refine', 'ls_d_res_high'), ('refine_hist', 'd_res_high'), ('em3d_reconstruction', 'resolution')]:
+        rows = entry.get(category) or []
+        if len(rows) > 0 and rows[0].get(item) is not None:
+            return rows[0][item]
+    return 999
+
+# define a function to select the structures to be downloaded for a gene
+def select_top_k_structures(gene, pdb_ids_this_gene, metadata):
+    """
+    This function will select the top_k structures with the best resolution (and all structures with the same resolution as the k-th one)
+    for every distinct sequence of this gene: script 07 lists the n best structures for every variant (or combination of variants)
+    and all structures with the same sequence have the same variants, so with top_k >= n_best_structures all structures listed by script 07 are selected;
+    only if script 07 excludes structures where the mismatch is not solved (-e True), it may need structures beyond the top_k
+    (structures without metadata are always selected)
+    
+    :param gene: string
+    :param pdb_ids_this_gene: List
+    :param metadata: Dict {pdb_id: entry}
+    :return: List of selected pdb ids (in the same order as pdb_ids_this_gene)
+    """
+    selected = set()
+    # group all structures by the sequences of their polymer entities for this gene, in the format {sequence: [(resolution, pdb_id), ...]}
+    sequence_groups = {}
+    for pdb_id in pdb_ids_this_gene:
+        entry = metadata.get(pdb_id)
+        if entry is None:
+            selected.add(pdb_id)
+            continue
+        all_sequences = []
+        gene_sequences = []
+        for entity in entry.get('polymer_entities') or []:
+            sequence = (entity.get('entity_poly') or {}).get('pdbx_seq_one_letter_code_can') or ''
+            gene_names = [gene_name['value'].upper() for organism in entity.get('rcsb_entity_source_organism') or [] for gene_name in organism.get('rcsb_gene_name') or []]
+            all_sequences.append(sequence)
+            if gene.upper() in gene_names:
+                gene_sequences.append(sequence)
+        # if none of the entities is annotated with the gene name, we use all sequences of this structure
+        for sequence in set(gene_sequences or all_sequences):
+            sequence_groups.setdefault(sequence, []).append((get_resolution(entry), pdb_id))
+    for structures in sequence_groups.values():
+        structures.sort()
+        # structures with the same resolution as the k-th structure are selected as well, as script 07 could pick any of them
+        cutoff_resolution = structures[min(top_k_structures, len(structures)) - 1][0]
+        selected.update(pdb_id for resolution, pdb_id in structures if resolution <= cutoff_resolution)
+    return [pdb_id for pdb_id in pdb_ids_this_gene if pdb_id in selected]
+
+# define a function to link a file from the shared structure store (or the local PDB mirror) into a gene folder
+def link_file(store_file, gene_file, symlink=False):
+    # we use a hardlink, so the file stays available in the gene folder even if the store is moved
+    # (if the store is on a different file system, hardlinks are not possible and we use a symlink instead)
+    # files from the local PDB mirror are always linked with a symlink, so we always read the current file of the mirror
+    # the link is created with a temporary name and then renamed, so it replaces any incomplete file in the gene folder
+    temp_file = join(os.path.dirname(gene_file), temp_file_prefix + os.path.basename(gene_file))
+    if os.path.lexists(temp_file):
+        os.remove(temp_file)
+    try:
+        if symlink == True:
+            os.symlink(store_file, temp_file)
+        else:
+            os.link(store_file, temp_file)
+    except OSError:
+        os.symlink(store_file, temp_file)
+    os.replace(temp_file, gene_file)
+
+# paths of the mmCIF and pdb files in a local wwPDB mirror (divided layout, e.g. data/structures/divided/mmCIF/xy/1xyz.cif.gz)
+mirror_paths = {'cif': 'data/structures/divided/mmCIF/{}/{}.cif.gz',
+                'pdb': 'data/structures/divided/pdb/{}/pdb{}.ent.gz'}
+
+# define a function to get the path of a file in the local PDB mirror (None if the file is not in the mirror)
+def get_mirror_file(pdb_id, file_format):
+    if pdb_mirror is None or file_format not in mirror_paths:
+        return None
+    mirror_file = f'{pdb_mirror}/{mirror_paths[file_format].format(pdb_id[1:3], pdb_id)}'
+    return mirror_file if os.path.exists(mirror_file) else None
+
+# define a function to get the current revision of an entry (e.g. '1.3') from its mmCIF file in the local PDB mirror
+# (None if the file is not in the mirror or has no revision history), so we don't have to ask the PDB API for it
+def get_mirror_revision(pdb_id):
+    mirror_file = get_mirror_file(pdb_id, 'cif')
+    if mirror_file is None:
+        return None
+    try:
+        revision_history = read_cif_category(mirror_file, 'pdbx_audit_revision_history')
+        revision_numbers = [(int(major), int(minor)) for major, minor in zip(revision_history.get('_pdbx_audit_revision_history.major_revision', []),
+                                                                             revision_history.get('_pdbx_audit_revision_history.minor_revision', []))]
+    except (OSError, EOFError, ValueError):
+        return None
+    if not revision_numbers:
+        return None
+    # every revision of the entry is listed, the current revision is the latest one
+    major, minor = max(revision_numbers)
+    return f'{major}.{minor}'
+
+# define a function to get all values for a key from a dictionary created with MMCIF2Dict
+def get_cif_values(mmcif_dict, key):
+    # depending on the BioPython version, a key with only one value is stored as a string instead of a list
+    values = mmcif_dict.get(key, [])
+    return [values] if isinstance(values, str) else values
+
+# define a function to generate a fasta file from an mmCIF file
+def write_fasta_from_cif(cif_file, fasta_file):
+    """
+    This function will create a fasta file in the same format as the fasta files
+    downloaded from the PDB (one record per polymer entity), e.g.
+        >6KJ2_1|Chain A|RNA-binding protein FUS|Homo sapiens (9606)
+    using the entity_poly, entity and entity_src_gen (or entity_src_nat / pdbx_entity_src_syn) categories of the mmCIF file
+    
+    :param cif_file: string (path to mmCIF file, can be gzip compressed)
+    :param fasta_file: string (path to fasta file to be created)
+    """
+    with open_structure_file(cif_file) as handle:
+        mmcif_dict = MMCIF2Dict(handle)
+    entry_id = get_cif_values(mmcif_dict, '_entry.id')[0]
+    # description of each entity
+    descriptions = dict(zip(get_cif_values(mmcif_dict, '_entity.id'), get_cif_values(mmcif_dict, '_entity.pdbx_description')))
+    # organism of each entity, depending on the source of the entity it is stored in different categories
+    organisms = {}
+    for category, name_key, taxonomy_key in [('_entity_src_gen', 'pdbx_gene_src_scientific_name', 'pdbx_gene_src_ncbi_taxonomy_id'),
+                                             ('_entity_src_nat', 'pdbx_organism_scientific', 'pdbx_ncbi_taxonomy_id'),
+                                             ('_pdbx_entity_src_syn', 'organism_scientific', 'ncbi_taxonomy_id')]:
+        for entity_id, name, taxonomy_id in zip(get_cif_values(mmcif_dict, f'{category}.entity_id'),
+                                                get_cif_values(mmcif_dict, f'{category}.{name_key}'),
+                                                get_cif_values(mmcif_dict, f'{category}.{taxonomy_key}')):
+            if entity_id not in organisms and name not in ['?', '.']:
+                organisms[entity_id] = name if taxonomy_id in ['?', '.'] else f'{name} ({taxonomy_id})'
+    # chains of each entity: the PDB lists the label chain ids and adds the author chain id if it is different, e.g. 'Chains A, B[auth C]'
+    auth_chains = dict(zip(get_cif_values(mmcif_dict, '_pdbx_poly_seq_scheme.asym_id'), get_cif_values(mmcif_dict, '_pdbx_poly_seq_scheme.pdb_strand_id')))
+    chains_per_entity = {}
+    for asym_id, entity_id in zip(get_cif_values(mmcif_dict, '_struct_asym.id'), get_cif_values(mmcif_dict, '_struct_asym.entity_id')):
+        if asym_id in auth_chains:
+            chain = asym_id if auth_chains[asym_id] == asym_id else f'{asym_id}[auth {auth_chains[asym_id]}]'
+            chains_per_entity.setdefault(entity_id, []).append(chain)
+    with open(fasta_file, 'w') as fasta:
+        for entity_id, strand_ids, sequence in zip(get_cif_values(mmcif_dict, '_entity_poly.entity_id'),
+                                                   get_cif_values(mmcif_dict, '_entity_poly.pdbx_strand_id'),
+                                                   get_cif_values(mmcif_dict, '_entity_poly.pdbx_seq_one_letter_code_can')):
+            # if there is no _pdbx_poly_seq_scheme in the file, we use the author chain ids listed for the entity
+            chains = chains_per_entity.get(entity_id, strand_ids.split(','))
+            chain_name = f'Chain {chains[0]}' if len(chains) == 1 else f'Chains {", ".join(chains)}'
+            sequence = sequence.replace('\n', '').replace(' ', '')
+            fasta.write(f'>{entry_id}_{entity_id}|{chain_name}|{descriptions.get(entity_id, "")}|{organisms.get(entity_id, "")}\n{sequence}\n')
+# ----------------------------------------------------------------------------------------------------------------------------------
 
 #  create log file for console output:
 if create_search_log == True:
@@ -106,6 +558,31 @@ start_time = datetime.now()
 print(f'start: {start_time}\n')
 # ----------------------------------------------------------------------------------------------------------------------------------
 
+# if specified, we work out which file formats are actually needed by the scripts which will be run after this one
+# and only download those (out of the specified formats)
+if plan_downloads == True:
+    needed_formats = []
+    # scripts 02 and 03 can use the BinaryCIF files instead of the mmCIF files, so if BinaryCIF files are specified, we download them instead
+    structure_format = 'bcif' if 'bcif' in download_format else 'cif'
+    # script 02 parses the mmCIF files
+    if '02' in downstream_stages:
+        needed_formats.append(structure_format)
+    # if fasta files are generated locally, this is done from the mmCIF files
+    if '04' in downstream_stages and (local_fasta == True or pdb_mirror is not None):
+        needed_formats.append('cif')
+    # script 03 gets the unsolved residues from the mmCIF files (or from the pdb files, if there is no mmCIF file for a structure)
+    # so we only need the pdb files if we don't download the mmCIF files
+    if '03' in downstream_stages:
+        needed_formats.append(structure_format if structure_format in download_format else 'pdb')
+    # script 04 parses the fasta files
+    if '04' in downstream_stages:
+        needed_formats.append('fasta')
+    skipped_formats = [file_format for file_format in ['cif', 'bcif', 'pdb', 'fasta'] if file_format in download_format and file_format not in needed_formats]
+    download_format = [file_format for file_format in ['cif', 'bcif', 'pdb', 'fasta'] if file_format in download_format and file_format in needed_formats]
+    print(f'Download plan for scripts {downstream_stages}:')
+    print(f'    formats to be downloaded:        {download_format}')
+    print(f'    formats not needed (skipped):    {skipped_formats}\n')
+
 # if there is no data in the PDB for any of the input genes, we don't have to run this script (or any of the
 # following scripts in the pipeline, apart from the AlphaFold one)
 # so we read in the file 00_search_overview_availability.csv from the results_dir to check if we have to run the script
@@ -130,9 +607,23 @@ if web_run == True:
         mutafy_pdb_ids = pd.DataFrame(columns=['gene_name', 'available_structures'])
         mutafy_pdb_ids.set_index('gene_name', inplace=True)
 
+# if specified, we get the metadata of all structures of all genes (so we can select the structures to be downloaded for each gene)
+if top_k_structures > 0:
+    all_pdb_ids = sorted(set(pdb_id for structures in pdb_ids.available_structures for pdb_id in ast.literal_eval(structures)))
+    print(f'>>> Getting resolution, method and sequences for {len(all_pdb_ids)} structures to select the {top_k_structures} best structures per sequence\n')
+    top_k_metadata = get_entry_metadata(top_k_query, all_pdb_ids)
+    # create empty df to populate with all structures and whether they have been selected for download
+    df_top_k = pd.DataFrame(columns=['gene_name', 'structure_id', 'resolution', 'structure_method', 'selected'])
+
 # create an empty list to populate with folder names of all created folders:
 created_folders = []
 
+# create an empty list to populate with all files to be downloaded: (gene, pdb_id, file_format, folder_name)
+download_tasks = []
+
+# create an empty list to populate with all fasta files to be generated from mmCIF files (only used if local_fasta == True)
+local_fasta_tasks = []
+
 # set variable n_genes: number of genes with available structures to be downloaded
 n_genes = len(pdb_ids)
 # mutafy_n_genes = (len(mutafy_pdb_ids))
@@ -157,6 +648,15 @@ for gene, structures in pdb_ids.iterrows():
     for structure in structures:                                   # there is only one entry per structures, it's a list representation in string format
         found_pdbs = ast.literal_eval(structure)           # use ast.literal_eval to convert the string into a list
     
+    # if specified, we only keep the structures which could be among the best structures for any sequence of this gene
+    if top_k_structures > 0:
+        selected_pdbs = select_top_k_structures(gene, found_pdbs, top_k_metadata)
+        for pdb_id in found_pdbs:
+            entry = top_k_metadata.get(pdb_id, {})
+            df_top_k.loc[len(df_top_k)] = [gene, pdb_id, get_resolution(entry), (entry.get('rcsb_entry_info') or {}).get('experimental_method'), pdb_id in selected_pdbs]
+        print(f'>>> Selected {len(selected_pdbs)} of {len(found_pdbs)} structures for gene {gene} (the {top_k_structures} best structures for every sequence)')
+        found_pdbs = selected_pdbs
+    
     # update total number of structures
     n_structures += len(found_pdbs)
     
@@ -224,152 +724,185 @@ for gene, structures in pdb_ids.iterrows():
     os.chdir(folder_name)
     created_folders.append(folder_name)
      
-    # now we download the files - if this is a webserver run, we only download the new ones 
-    # download all mmCIF files to newly created folder
-    # if-statement added, so mmCif files are only downloaded if specified (default)
-    if 'cif' in download_format:
-        if web_run == True:
-            # check if there are any new structures to be downloaded for this gene
-            if n_new_structures >= 1:
-                print(f'\n>>> Initiating download of mmCIF files for {n_new_structures} structures for gene {gene_counter} of {n_genes}: {gene}')
-                # we create a PDBList object to download the files with BioPython
-                # for mmCIF files
-                cifl = PDBList()
-                cifl.download_pdb_files(pdb_ids_to_download, file_format='mmCif', pdir=folder_name)
-            elif n_new_structures == 0:
-                print(f'No new mmCIF structures to be dowloaded for gene {gene}')
-        elif web_run == False:                
-            print(f'\n>>> Initiating download of mmCIF files for {len(found_pdbs)} structures for gene {gene_counter} of {n_genes}: {gene}')
-            # we create a PDBList object to download the files with BioPython
-            # for mmCIF files
-            cifl = PDBList()
-            cifl.download_pdb_files(found_pdbs, file_format='mmCif', pdir=folder_name)
-            
-    # for PDB files
-    # if-statement added, so pdb files are only downloaded if specified (default)
-    if 'pdb' in download_format:
-        if web_run == True:
-            if n_new_structures >= 1:
-                print(f'\n>>> Initiating download for pdb files for {n_new_structures} structures for gene {gene_counter} of {n_genes}: {gene}')
-                # we create a PDBList object to download the files with BioPython
-                pdbl = PDBList()
-                pdbl.download_pdb_files(pdb_ids_to_download, file_format='pdb', pdir=folder_name)
-                # currently all pdb files have a name like 'pdb4uxy.ent'
-                # so in order to rename the files to pdb_id.pdb (e.g. 4uxy.pdb), we do the following:
-                # First, we get a list of all pdb files stored in this folder
-                files = [f for f in listdir(folder_name) if isfile(join(folder_name, f))]
-                pdb_files = [f for f in files if '.ent' in f]
-                for file in pdb_files:
-                    # the pdb id is the last four letters of the first element of the split
-                    pdb_id = file.split('.')[0][-4:]
-                    os.rename(file, pdb_id+'.pdb')
-            elif n_new_structures == 0:
-                print(f'No new pdb structures to be dowloaded for gene {gene}')
-        elif web_run == False: 
-            print(f'\n>>> Initiating download for pdb files for {len(found_pdbs)} structures for gene {gene_counter} of {n_genes}: {gene}')
-            # first we check which pdb files are available (if any) in this folder, so we don't download the same files again:
-            # create list with filenames of all pdb files in this folder
-            files = [f for f in listdir(folder_name) if isfile(join(folder_name, f))]
-            pdb_files = [file for file in files if ('.pdb' in file)]
-            # in order to check if we have downloaded the same structures again, we need to reconvert the name
-            # of these files to their original name, which is in the format 'pdb4uxy.ent'
-            # (they are currently in the format ''4uxy.pdb')
-            for file in pdb_files:
-                orig_name = 'pdb' + file[:4] + '.ent'
-                os.rename(file, orig_name)
-            
-            # now we can download the structures and will automatically
-            # get a warning if the structure is already available in our directory as we do for the mmCif files
-            # (this doesn't work for the fasta files as I don't use BioPython for it, so I implemented it manually, see further below)
-            # we create a PDBList object to download the files with BioPython        
-            pdbl = PDBList()
-            pdbl.download_pdb_files(found_pdbs, file_format='pdb', pdir=folder_name)
-        
-            # currently all pdb files have a name like 'pdb4uxy.ent'
-            # so in order to rename the files to pdb_id.pdb (e.g. 4uxy.pdb), we do the following:
-            # First, we get a list of all pdb files stored in this folder
-            files = [f for f in listdir(folder_name) if isfile(join(folder_name, f))]
-            pdb_files = [f for f in files if '.ent' in f]
-            for file in pdb_files:
-                # the pdb id is the last four letters of the first element of the split
-                pdb_id = file.split('.')[0][-4:]
-                os.rename(file, pdb_id+'.pdb')
-
-    # now we download the fasta file for this structure
-    # if-statement added, so fasta files are only downloaded if specified (default)
-    if 'fasta' in download_format:
-        if web_run == True:
-            if n_new_structures >= 1:
-                print(f'\n>>> Initiating download for fasta files for {n_new_structures} structures for gene {gene_counter} of {n_genes}: {gene}')
-                # in the else statement (when it's not a webserver run), we also have additional code which deals with already existing fasta files to ensure
-                # anything that has been downloaded already isn't downloaded again. This is not necessary in the section of code here (for the webserver run)
-                # because we only download the NEW pdb ids anyway
-                for pdb_id in pdb_ids_to_download:
-                    fasta_filename = f'{pdb_id}.fasta'
-                    fasta_url = f'https://www.rcsb.org/fasta/entry/{pdb_id.upper()}'
-                    response = requests.get(fasta_url)
-                    if response.status_code == 200:
-                        print(f'Downloading fasta file for {pdb_id}...')
-                        with open(fasta_filename, 'w') as fasta:
-                            fasta.write(response.text)
-                    else:
-                        # If there is no data, print status code and response
-                        print(response.status_code, response.text)
-                        print(f'No fasta file retrieved for {pdb_id}\n')        
-                
-            elif n_new_structures == 0:
-                print(f'No new fasta files to be dowloaded for gene {gene}')
-            
-        elif web_run == False:
-            print(f'\n>>> Initiating download for fasta files for {len(found_pdbs)} structures for gene {gene_counter} of {n_genes}: {gene}')
-            # first we check which fasta files are available (if any) in this folder, so we don't download the same files again:
-            # create list with filenames of all fasta files in this folder
-            files = [f for f in listdir(folder_name) if isfile(join(folder_name, f))]
-            fasta_files = [file for file in files if ('.fasta' in file)]
-            
-            # we loop over the pdb ids and check if each fasta file exists or not
-            for pdb_id in found_pdbs:
-                fasta_filename = f'{pdb_id}.fasta'
-                if fasta_filename in fasta_files:
-                    print(f'Fasta file exists: {os.getcwd()}/{fasta_filename}')
+    # now we add the files for this gene to the list of download tasks - if this is a webserver run, we only download the new ones
+    # (the files for all genes are downloaded together further below, so we don't have to wait for one gene to finish before we start the next one)
+    if web_run == True:
+        pdb_ids_this_gene = pdb_ids_to_download
+    else:
+        pdb_ids_this_gene = found_pdbs
+    # we check which files have already been downloaded completely (if any) into this folder, so we don't download the same files again
+    # (files which are missing or corrupt are not listed in the manifest and will be downloaded again)
+    manifest = get_manifest(folder_name)
+    # temporary files left behind by an interrupted run can be removed
+    remove_temp_files(folder_name)
+    n_tasks_this_gene = 0
+    # if-statement added, so files are only downloaded in the specified formats (default: cif and fasta)
+    for file_format in ['cif', 'bcif', 'pdb', 'fasta']:
+        if file_format in download_format:
+            for pdb_id in pdb_ids_this_gene:
+                # (compressed and uncompressed files count as the same file)
+                if (pdb_id, file_format) in manifest:
                     continue
-                else:                                    
-                    fasta_url = f'https://www.rcsb.org/fasta/entry/{pdb_id.upper()}'
-                    response = requests.get(fasta_url)
-                    if response.status_code == 200:
-                        print(f'Downloading fasta file for {pdb_id}...')
-                        with open(fasta_filename, 'w') as fasta:
-                            fasta.write(response.text)
-                    else:
-                        # If there is no data, print status code and response
-                        print(response.status_code, response.text)
-                        print(f'No fasta file retrieved for {pdb_id}\n')        
-                    
-    print(f'Complete!\n    All corresponding files (format: {download_format}) for {gene} are stored in: \n    {folder_name}\n')
-    # remove created folder 'obsolete' (obsolete structure would be stored here if we set obsolete=True for the pdb/cif file download)
-    try:
-        os.rmdir(folder_name + '/obsolete')
-    except:
-        continue
+                # if specified, we generate the fasta files from the mmCIF files once all files have been downloaded
+                # (there are no fasta files in the local PDB mirror, so we also generate them if we use the mirror)
+                if file_format == 'fasta' and (local_fasta == True or pdb_mirror is not None):
+                    local_fasta_tasks.append((gene, pdb_id, file_format, folder_name))
+                    continue
+                download_tasks.append((gene, pdb_id, file_format, folder_name))
+                n_tasks_this_gene += 1
+    if n_tasks_this_gene == 0:
+        print(f'No new files to be dowloaded for gene {gene_counter} of {n_genes}: {gene}')
+    else:
+        print(f'>>> {n_tasks_this_gene} files queued for download for gene {gene_counter} of {n_genes}: {gene}')
     # change directory back to results to create next gene folder there
     os.chdir(results_dir) 
     
+# if specified, we take the mmCIF and pdb files from the local PDB mirror instead of downloading them
+# the files are linked into the gene folders with a symlink (and not copied), so scripts 02 and 03 read them straight from the mirror
+if pdb_mirror is not None and len(download_tasks) > 0:
+    print(f'\n>>> Looking up {len(download_tasks)} files in the local PDB mirror: {pdb_mirror}')
+    remaining_download_tasks = []
+    for task in download_tasks:
+        gene, pdb_id, file_format, folder_name = task
+        mirror_file = get_mirror_file(pdb_id, file_format)
+        if mirror_file is None:
+            remaining_download_tasks.append(task)
+            continue
+        # files in the mirror are always gzip compressed
+        link_file(mirror_file, f'{folder_name}/{pdb_id}.{file_format}.gz', symlink=True)
+        add_to_manifest(folder_name, pdb_id, file_format, f'{pdb_id}.{file_format}.gz', os.path.getsize(mirror_file), get_checksum(mirror_file), 'local PDB mirror')
+    print(f'{len(download_tasks) - len(remaining_download_tasks)} files linked from the local PDB mirror, {len(remaining_download_tasks)} files are not in the mirror and have to be downloaded')
+    download_tasks = remaining_download_tasks
+
+# if specified, every file is only downloaded once into the shared structure store (one folder per pdb id and revision)
+# and then linked into all gene folders which need it (e.g. a complex which shows up under several genes)
+# (we keep the tasks for the gene folders, so we can link the files into the gene folders after the download)
+gene_folder_tasks = download_tasks + local_fasta_tasks
+revisions = {}
+if use_store == True and len(gene_folder_tasks) > 0:
+    store_pdb_ids = sorted(set(pdb_id for gene, pdb_id, file_format, folder_name in gene_folder_tasks))
+    print(f'\n>>> Getting current revisions for {len(store_pdb_ids)} structures to look them up in the shared structure store: {store_directory}')
+    # if the mmCIF file of a structure is in the local PDB mirror, we take the revision from this file
+    # and only ask the PDB API for the revisions of all other structures
+    for pdb_id in store_pdb_ids:
+        mirror_revision = get_mirror_revision(pdb_id)
+        if mirror_revision is not None:
+            revisions[pdb_id] = mirror_revision
+    api_pdb_ids = [pdb_id for pdb_id in store_pdb_ids if pdb_id not in revisions]
+    if len(api_pdb_ids) > 0:
+        revisions.update(get_revisions(api_pdb_ids))
+    store_download_tasks = {}
+    store_local_fasta_tasks = {}
+    cleaned_store_folders = set()
+    for task_list, store_tasks in [(download_tasks, store_download_tasks), (local_fasta_tasks, store_local_fasta_tasks)]:
+        for gene, pdb_id, file_format, folder_name in task_list:
+            # if we can't get the revision of an entry, we store it in the folder 'unknown_revision'
+            store_folder = f'{store_directory}/{pdb_id}/{revisions.get(pdb_id, "unknown_revision")}'
+            if not os.path.exists(store_folder):
+                os.makedirs(store_folder)
+            # temporary files left behind by an interrupted run are removed once per store folder (if they are older than an hour)
+            if store_folder not in cleaned_store_folders:
+                remove_temp_files(store_folder, min_age=3600)
+                cleaned_store_folders.add(store_folder)
+            if (pdb_id, file_format) in get_manifest(store_folder):
+                continue
+            # every file only has to be downloaded once, however many genes point at it
+            store_tasks.setdefault((pdb_id, file_format), (gene, pdb_id, file_format, store_folder))
+    download_tasks = list(store_download_tasks.values())
+    local_fasta_tasks = list(store_local_fasta_tasks.values())
+    print(f'{len(gene_folder_tasks) - len(download_tasks) - len(local_fasta_tasks)} of {len(gene_folder_tasks)} files are already available in the shared structure store or needed for several genes')
+
+# now we download the files for all genes at the same time (max. n_workers downloads in flight)
+n_tasks = len(download_tasks)
+print(f'\n>>> Initiating download of {n_tasks} files for {n_genes} genes ({n_workers} downloads at the same time)\n')
+failed_downloads = []
+with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+    futures = [executor.submit(download_file, task) for task in download_tasks]
+    # we report the progress across all genes whenever one of the downloads is finished
+    for task_counter, future in enumerate(as_completed(futures), start=1):
+        (gene, pdb_id, file_format, folder_name), status, file_info = future.result()
+        if status == 200:
+            add_to_manifest(folder_name, pdb_id, file_format, file_info['filename'], file_info['size'], file_info['checksum'], revisions.get(pdb_id, file_info['last_modified']))
+            print(f'[{task_counter}/{n_tasks}] Downloaded {file_format} file for {pdb_id} ({gene})')
+        else:
+            failed_downloads.append((gene, pdb_id, file_format))
+            print(f'[{task_counter}/{n_tasks}] No {file_format} file retrieved for {pdb_id} ({gene}); status code: {status}')
+
+# now we generate the fasta files from the mmCIF files (if specified)
+# if there is no mmCIF file for a structure (e.g. if mmCIF files are not downloaded), we download the fasta file from the PDB instead
+if len(local_fasta_tasks) > 0:
+    print(f'\n>>> Generating fasta files from mmCIF files for {len(local_fasta_tasks)} structures\n')
+    fasta_download_tasks = []
+    for task in local_fasta_tasks:
+        gene, pdb_id, file_format, folder_name = task
+        # we only use mmCIF files which have been downloaded completely (listed in the manifest) or mmCIF files from the local PDB mirror
+        cif_entry = get_manifest(folder_name).get((pdb_id, 'cif'))
+        if cif_entry is not None:
+            cif_file = f'{folder_name}/{cif_entry["filename"]}'
+            revision = cif_entry['revision']
+        elif get_mirror_file(pdb_id, 'cif') is not None:
+            cif_file = get_mirror_file(pdb_id, 'cif')
+            revision = 'local PDB mirror'
+        else:
+            fasta_download_tasks.append(task)
+            continue
+        try:
+            # the fasta file is written to a temporary file first and then renamed, just like the downloaded files
+            temp_file = f'{folder_name}/{temp_file_prefix}{pdb_id}.fasta'
+            write_fasta_from_cif(cif_file, temp_file)
+            os.replace(temp_file, f'{folder_name}/{pdb_id}.fasta')
+            add_to_manifest(folder_name, pdb_id, file_format, f'{pdb_id}.fasta', os.path.getsize(f'{folder_name}/{pdb_id}.fasta'), get_checksum(f'{folder_name}/{pdb_id}.fasta'), revision)
+            print(f'Generated fasta file for {pdb_id} ({gene})')
+        except Exception as error:
+            print(f'Could not generate fasta file for {pdb_id} ({gene}) from mmCIF file ({error})')
+            fasta_download_tasks.append(task)
+    if len(fasta_download_tasks) > 0:
+        print(f'\n>>> Initiating download of {len(fasta_download_tasks)} fasta files which could not be generated from mmCIF files\n')
+        with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+            for (gene, pdb_id, file_format, folder_name), status, file_info in executor.map(download_file, fasta_download_tasks):
+                if status == 200:
+                    add_to_manifest(folder_name, pdb_id, file_format, file_info['filename'], file_info['size'], file_info['checksum'], revisions.get(pdb_id, file_info['last_modified']))
+                    print(f'Downloaded fasta file for {pdb_id} ({gene})')
+                else:
+                    failed_downloads.append((gene, pdb_id, file_format))
+                    print(f'No fasta file retrieved for {pdb_id} ({gene}); status code: {status}')
+
+# now we link the files from the shared structure store into the gene folders
+if use_store == True and len(gene_folder_tasks) > 0:
+    print(f'\n>>> Linking {len(gene_folder_tasks)} files from the shared structure store into the gene folders\n')
+    for gene, pdb_id, file_format, folder_name in gene_folder_tasks:
+        store_folder = f'{store_directory}/{pdb_id}/{revisions.get(pdb_id, "unknown_revision")}'
+        store_entry = get_manifest(store_folder).get((pdb_id, file_format))
+        # if the download failed, there is nothing to be linked
+        if store_entry is not None:
+            link_file(f'{store_folder}/{store_entry["filename"]}', f'{folder_name}/{store_entry["filename"]}')
+            add_to_manifest(folder_name, pdb_id, file_format, store_entry['filename'], store_entry['size'], store_entry['checksum'], store_entry['revision'])
+
+for folder_name in created_folders:
+    print(f'Complete!\n    All corresponding files (format: {download_format}) are stored in: \n    {folder_name}')
+if len(failed_downloads) > 0:
+    print(f'\nWARNING: {len(failed_downloads)} files could not be downloaded (see above)')
+
+# now we rewrite the manifests of all folders, so every file is only listed once
+for folder_name in manifests:
+    write_manifest(folder_name)
+    
 # change back to results directory
 os.chdir(results_dir)    
 
 # create df with information on folder and contents
 df_folders = pd.DataFrame(columns=['gene_name', 'folder_name', 'full_path', 'n_mmCIF', 'n_pdb', 'n_fasta', 'mmCIF_ids', 'pdb_ids', 'fasta_ids'])
 
-# create lists with filenames of all mmCIF and fasta files in this folder
+# create lists with filenames of all mmCIF, pdb and fasta files in this folder (from the manifest of this folder)
 for folder in created_folders:
     if web_run == True:
         gene_name = folder.replace((mutafy_directory+'/'), '').split('_')[0] #this is the name of the gene
     else:
         gene_name = folder.replace((results_dir+'/'), '').split('_')[0] #this is the name of the gene
-    files = [f for f in listdir(folder) if isfile(join(folder, f))]
-    cif_files = [f for f in files if '.cif' in f]
-    pdb_files = [f for f in files if '.pdb' in f]
-    fasta_files = [f for f in files if '.fasta' in f]
+    manifest = get_manifest(folder)
+    cif_files = [entry['filename'] for entry in manifest.values() if entry['file_format'] in ['cif', 'bcif']]
+    pdb_files = [entry['filename'] for entry in manifest.values() if entry['file_format'] == 'pdb']
+    fasta_files = [entry['filename'] for entry in manifest.values() if entry['file_format'] == 'fasta']
     # sort lists
     cif_files.sort()
     pdb_files.sort()
@@ -386,6 +919,12 @@ df_folders.to_csv('01_search_overview_folders.csv', index = False)
 
 df_n_structures.to_csv('01_search_overview_n_structures.csv', index= False)
 
+if top_k_structures > 0:
+    df_top_k.to_csv('01_search_overview_top_k.csv', index=False)
+# we remove the file of an earlier run with --top_k, so script 05 doesn't treat the structures listed there as skipped in this run
+elif os.path.exists('01_search_overview_top_k.csv'):
+    os.remove('01_search_overview_top_k.csv')
+
 # if this is a webrun, we need to write the df_new_structures_mutafy to a file
 # or update the file if it already exists
 if web_run:
@@ -408,7 +947,10 @@ else:
 
 print('\nThe following files have been created:')
 print('   o      01_search_overview_folders.csv              (lists all the the created/updated folders and their contents)')
-print('   o      01_search_overview_n_structures.csv          (lists number of structures retrieved per gene)\n\n')
+print('   o      01_search_overview_n_structures.csv          (lists number of structures retrieved per gene)')
+if top_k_structures > 0:
+    print('   o      01_search_overview_top_k.csv                 (lists resolution and method of all structures and whether they have been downloaded)')
+print('\n')
 
 
 # print script name to console/log file
@@ -420,6 +962,9 @@ print(f'start: {start_time}')
 print(f'end: {end_time}\n\n')
 print('........................................................................................................................................................\n\n\n')
 
+# remove the least recently used responses from the cache if it has grown too large
+evict_cache(cache_dir, max_cache_size)
+
 # close search log
 if create_search_log == True:
     sys.stdout.close()
\ No newline at end of file
@@ -1,5 +1,5 @@
 # This script takes a csv file (01_search_overview_folders.csv) containing information on the folders where the mmCIF files are stored as input and will:
-#      - extract information from each mmCIF file, incl.:
+#      - extract information from each mmCIF file (or BinaryCIF file, if there is no mmCIF file for a structure), incl.:
 #                - resolution
 #                - experimental methods (currently not; maybe add!?)
 #                - polypetide sequences (corresponds to chains as shown in PyMOL, e.g. there are missing residues which haven't been solved in the crystal structure)
@@ -16,19 +16,42 @@
    
 # Set up
 import pandas as pd
+import numpy as np
 import os
 import ast
+import gzip
+import hashlib
+import json
+import io
+import re
+import mmap
+import warnings
 from os import listdir
 from os.path import isfile, join
 from os.path import exists
 import sys
 import argparse
 from datetime import datetime
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import Bio
 from Bio import SeqIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from Bio.Data.PDBData import protein_letters_3to1_extended
 from Bio.PDB import *
 from Bio.PDB.MMCIFParser import MMCIFParser
-from Bio.PDB.Polypeptide import PPBuilder
+from Bio.PDB.mmcifio import MMCIFIO
+from Bio.PDB.MMCIF2Dict import MMCIF2Dict
+from Bio.PDB.PDBExceptions import PDBConstructionWarning
+from Bio.PDB.Polypeptide import PPBuilder, Polypeptide, is_aa
+# functions to read the structure files (shared by scripts 01, 02 and 03)
+from mutapipe_structure_files import open_structure_file, get_shared_file_key, get_structure_file, cif_file_extensions
+from mutapipe_structure_files import bcif_supported, read_bcif_file, backbone_atoms, atom_site_key_columns, get_backbone_rows
+from mutapipe_structure_files import get_cif_category, parse_cif_categories
+# function to remove the least recently used files from the cache directory (shared by all MutaPipe scripts which cache data on disk)
+from mutapipe_cache import evict_cache
 
 # get this script's name:
 script_name = os.path.basename(__file__)
@@ -58,6 +81,12 @@ delete_files= False                  # specify whether to delete cif files after
 # download_files_to_separate_directory = True # specify if pdb mmcif and fasta files should be stored in separate directory
 web_run = True # specify if pdb mmcif and fasta files should be stored in separate directory
 mutafy_directory = f'{target_directory}/mutafy' # set path to folder where structures will be/are stored
+n_workers = 1 # number of processes used to parse the mmCIF files at the same time
+use_cache = None # store the parsed data of every mmCIF file on disk and reuse it in later runs (True) or always parse all files (False) (None = only if web_run is False)
+cache_dir = f'{os.path.expanduser("~")}/.cache/MutaPipe' # set path to directory where the parsed data is cached (in the folder parsed_mmcif)
+max_cache_size = 1024 # maximum size of the cache directory in MB (least recently used files are removed first; to clear the cache, delete the cache directory)
+max_memory = 4096 # memory budget per worker in MB: structures which would need more memory to be parsed completely are parsed in low-memory mode (0 = always use low-memory mode)
+fast_pp = True # build the polypeptides with a vectorised check of all peptide bonds of a chain (True) or with Biopython's PPBuilder (False)
                                             
                                             
 # Now we create an argument parser called ap to which we can add the arguments we want to have in the terminal
@@ -79,6 +108,12 @@ ap.add_argument("-del", "--delete_files", type=str2bool, required = False, help=
 # ap.add_argument("-s", "--sep_dir", type=str2bool, required = False, help=f'specify if pdb mmcif and fasta files should be stored in separate directory (True) or not (False), default = {str(download_files_to_separate_directory)}')
 ap.add_argument("-w", "--web_run", type=str2bool, required = False, help=f'Indicate whether MutaPipe is run via a webserver (True) or not (False), default = {str(mutafy_directory)}')
 ap.add_argument("-m", "--mutafy", required = False, help=f'set path to mutafy directory where information from previous runs is stored, default = {mutafy_directory}')
+ap.add_argument("-wk", "--workers", type=int, required = False, help=f'Specify number of processes used to parse the mmCIF files at the same time, default = {str(n_workers)}')
+ap.add_argument("-ca", "--cache", type=str2bool, required = False, help=f'Specify whether to cache the parsed data of every mmCIF file on disk and only parse new or changed files in later runs (True) or always parse all files (False), default = True if web_run is False, otherwise False')
+ap.add_argument("-cd", "--cache_dir", required = False, help=f'Set path to directory where the parsed data is cached, default = {cache_dir}')
+ap.add_argument("-cs", "--cache_size", type=int, required = False, help=f'Specify maximum size of the cache directory in MB, default = {str(max_cache_size)}')
+ap.add_argument("-fp", "--fast_polypeptides", type=str2bool, required = False, help=f'Specify whether to build the polypeptides with a vectorised check of all peptide bonds of a chain (True) or with Biopython\'s PPBuilder (False), both give the same polypeptides, default = {str(fast_pp)}')
+ap.add_argument("-mem", "--max_memory", type=int, required = False, help=f'Specify memory budget per worker in MB; structures which would need more memory to be parsed completely are parsed in low-memory mode, which only keeps the atoms needed for the polypeptides (0 = always use low-memory mode), default = {str(max_memory)}')
 
 args = vars(ap.parse_args())
 
@@ -91,6 +126,14 @@ delete_files = delete_files if args["delete_files"] == None else args["delete_fi
 # download_files_to_separate_directory = download_files_to_separate_directory if args["sep_dir"]   == None else args["sep_dir"]
 web_run = web_run if args["web_run"] == None else args["web_run"]
 mutafy_directory = mutafy_directory if args["mutafy"] == None else args["mutafy"]
+n_workers = n_workers if args["workers"] == None else args["workers"]
+use_cache = use_cache if args["cache"] == None else args["cache"]
+# by default the parsed data is only cached if MutaPipe is not run via the webserver
+use_cache = (web_run == False) if use_cache == None else use_cache
+cache_dir = cache_dir if args["cache_dir"] == None else os.path.abspath(args["cache_dir"])
+max_cache_size = max_cache_size if args["cache_size"] == None else args["cache_size"]
+fast_pp = fast_pp if args["fast_polypeptides"] == None else args["fast_polypeptides"]
+max_memory = max_memory if args["max_memory"] == None else args["max_memory"]
 # ----------------------------------------------------------------------------------------------------------------------------------
 # We want to write all our Output into the Results directory
 
@@ -148,10 +191,464 @@ df_all_resolutions = pd.DataFrame(columns=['gene', 'structure_id', 'resolution']
 df_all_poly_seq = pd.DataFrame(columns=['gene', 'structure_id'])
 df_all_info = pd.DataFrame(columns=['gene', 'structure_id', 'resolution', 'structure_method', 'deposition_date', 'structure_name', 'classification'])
 
-# Reading downloaded mmcif files with BioPython
-# and extracting resolution and polypeptide sequence from each mmCIF file:
+# define a function to get a field from a parsed mmCIF dictionary as a list
+# (fields of categories with a single row may be stored as a single string instead of a list)
+def get_cif_field(mmcif_dict, field):
+    values = mmcif_dict.get(field, [])
+    if not isinstance(values, list):
+        values = [values]
+    return values
+
+# define a function to create the SEQRES records (one SeqRecord per chain) from an already parsed mmCIF dictionary
+# this creates the same records as SeqIO.parse(cif_file, 'cif-seqres'), but without tokenising the whole mmCIF file a second time
+def get_seqres_records(mmcif_dict):
+    """
+    This function creates SeqRecords for all chains in the _pdbx_poly_seq_scheme of an mmCIF file
+    from the dictionary created by the MMCIFParser.
+    :param mmcif_dict: dict, parsed mmCIF file as created by MMCIF2Dict
+    :return: list of SeqRecords (sorted by chain id)
+    """
+    # get one letter amino acid codes for all residues of each chain
+    chains = {}
+    for asym_id, mon_id in zip(get_cif_field(mmcif_dict, '_pdbx_poly_seq_scheme.asym_id'), get_cif_field(mmcif_dict, '_pdbx_poly_seq_scheme.mon_id')):
+        # (residues which are not amino acids are X, like in SeqIO.parse(cif_file, 'cif-seqres'))
+        chains.setdefault(asym_id, []).append(protein_letters_3to1_extended.get(mon_id, 'X'))
+    # get the database references (e.g. UniProt accession) for the chains
+    struct_refs = {}
+    for ref_id, db_name, db_code, db_acc in zip(get_cif_field(mmcif_dict, '_struct_ref.id'),
+                                                get_cif_field(mmcif_dict, '_struct_ref.db_name'),
+                                                get_cif_field(mmcif_dict, '_struct_ref.db_code'),
+                                                get_cif_field(mmcif_dict, '_struct_ref.pdbx_db_accession')):
+        struct_refs[ref_id] = {'database': db_name, 'db_id_code': db_code, 'db_acc': db_acc}
+    metadata = {}
+    for ref_id, pdb_id, chain_id in zip(get_cif_field(mmcif_dict, '_struct_ref_seq.ref_id'),
+                                        get_cif_field(mmcif_dict, '_struct_ref_seq.pdbx_PDB_id_code'),
+                                        get_cif_field(mmcif_dict, '_struct_ref_seq.pdbx_strand_id')):
+        metadata.setdefault(chain_id, []).append(dict({'pdb_id': pdb_id}, **struct_refs[ref_id]))
+    # create the records (with the same ids and descriptions as SeqIO, e.g. '6KJ2:A UNP:P35637 FUS_HUMAN')
+    records = []
+    for chain_id, residues in sorted(chains.items()):
+        record = SeqRecord(Seq(''.join(residues)))
+        record.annotations = {'chain': chain_id, 'molecule_type': 'protein'}
+        if chain_id in metadata:
+            m = metadata[chain_id][0]
+            record.id = record.name = f"{m['pdb_id']}:{chain_id}"
+            record.description = f"{m['database']}:{m['db_acc']} {m['db_id_code']}"
+            for melem in metadata[chain_id]:
+                record.dbxrefs.extend([f"{melem['database']}:{melem['db_acc']}", f"{melem['database']}:{melem['db_id_code']}"])
+        else:
+            record.id = chain_id
+        records.append(record)
+    return records
+
+# if no polypeptides are extracted, we don't need to build the structure object with all atoms of a structure
+# instead, we only read the mmCIF categories needed for the header information and the SEQRES records:
+# the header categories are all stored before the _atom_site loop (so we only search the file up to there),
+# the _pdbx_poly_seq_scheme is stored after the _atom_site loop (so we jump over all atoms to find it)
+header_categories = ['struct', 'struct_keywords', 'pdbx_database_status', 'exptl', 'refine', 'refine_hist', 'em_3d_reconstruction', 'struct_ref', 'struct_ref_seq']
+seqres_categories = ['pdbx_poly_seq_scheme']
+
+# define a function to read only some categories from an mmCIF file
+def read_cif_categories(cif_file, categories_before_atoms, categories_after_atoms):
+    """
+    This function reads the given categories from an mmCIF file without tokenising the _atom_site loop.
+    Uncompressed files are memory mapped, gzip compressed files are decompressed into memory.
+    :param cif_file: str, filename of the mmCIF file (.cif or .cif.gz)
+    :param categories_before_atoms: list, categories which are stored before the _atom_site loop
+    :param categories_after_atoms: list, categories which are stored after the _atom_site loop
+    :return: dict, same format as MMCIF2Dict (only containing the items of the given categories)
+    """
+    with open(cif_file, 'rb') as handle:
+        if cif_file.endswith('.gz'):
+            data = gzip.GzipFile(fileobj=handle).read()
+        else:
+            data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            atom_site_start = data.find(b'\n_atom_site.')
+            if atom_site_start == -1:
+                atom_site_start = len(data)
+            category_texts = [get_cif_category(data, category, 0, atom_site_start) for category in categories_before_atoms]
+            category_texts += [get_cif_category(data, category, atom_site_start, len(data)) for category in categories_after_atoms]
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+    return parse_cif_categories(category_texts)
+
+# define a function to get the header information from a parsed mmCIF dictionary
+# (same values as the header of a structure object created with the MMCIFParser)
+def get_header_from_cif_dict(mmcif_dict):
+    """
+    This function gets the header information from a dictionary created by MMCIF2Dict or read_cif_categories.
+    :param mmcif_dict: dict, parsed mmCIF file
+    :return: dict, header with the keys name, head, deposition_date, structure_method and resolution
+    """
+    header_items = {'name': ['_struct.title'],
+                    'head': ['_struct_keywords.pdbx_keywords', '_struct_keywords.text'],
+                    'deposition_date': ['_pdbx_database_status.recvd_initial_deposition_date'],
+                    'structure_method': ['_exptl.method'],
+                    'resolution': ['_refine.ls_d_res_high', '_refine_hist.d_res_high', '_em_3d_reconstruction.resolution']}
+    header = {'name': '', 'head': '', 'deposition_date': '', 'structure_method': '', 'resolution': None}
+    for header_key, items in header_items.items():
+        for item in items:
+            values = get_cif_field(mmcif_dict, item)
+            if values and values[0] not in ['?', '.']:
+                header[header_key] = values[0]
+                break
+    if header['resolution'] is not None:
+        try:
+            header['resolution'] = float(header['resolution'])
+        except ValueError:
+            header['resolution'] = None
+    return header
+
+# the MMCIFParser has no public method to build a structure from a dictionary, so we call the same internal methods
+# as MMCIFParser.get_structure (checked with Biopython 1.88, see README); if they don't exist in the installed Biopython version,
+# we write the dictionary to an mmCIF file in memory with MMCIFIO and parse it with the public get_structure instead (slower)
+mmcif_parser_internals = ['_build_structure', '_structure_builder', '_get_header']
+use_mmcif_parser_internals = all(hasattr(MMCIFParser(QUIET=True), attribute) for attribute in mmcif_parser_internals)
+if not use_mmcif_parser_internals:
+    print(f'Warning: the MMCIFParser of Biopython {Bio.__version__} has no methods {mmcif_parser_internals}, so all mmCIF files are parsed via MMCIFIO (slower)')
+
+# define a function to create a structure object from a dictionary in the same format as MMCIF2Dict
+# (e.g. a decoded BinaryCIF file or an mmCIF file read in low-memory mode), so the structure object (and the header)
+# is created by the MMCIFParser in exactly the same way as for an mmCIF file
+def get_structure_from_cif_dict(structure_id, mmcif_dict):
+    """
+    This function creates a structure object from a parsed mmCIF dictionary with the MMCIFParser.
+    :param structure_id: str, the id of the structure
+    :param mmcif_dict: dict, same format as MMCIF2Dict
+    :return: structure object
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', PDBConstructionWarning)
+        if use_mmcif_parser_internals:
+            parser = MMCIFParser(QUIET=True)
+            parser._mmcif_dict = mmcif_dict
+            parser._build_structure(structure_id)
+            parser._structure_builder.set_header(parser._get_header())
+            return parser._structure_builder.get_structure()
+        cif_handle = io.StringIO()
+        cif_io = MMCIFIO()
+        cif_io.set_dict(mmcif_dict)
+        cif_io.save(cif_handle)
+        cif_handle.seek(0)
+        return MMCIFParser(QUIET=True).get_structure(structure_id, cif_handle)
+
+# Low-memory mode for very large structures
+# =====================================
+# to build the polypeptides, we only need the C and N atoms of every residue in the first model; all other atoms
+# are only needed to create the residues and chains in the same order as in the complete structure object
+# so in low-memory mode we only keep the first row of every residue and the rows of all C and N atoms in the _atom_site category
+# of the first model, and build the structure object with the MMCIFParser from these rows only
+# (the polypeptides of this structure object are exactly the same as the polypeptides of the complete structure object;
+# the rows are selected by get_backbone_rows, which is also used by read_bcif_file)
+
+# approximate memory needed to build the complete structure object per byte of the (uncompressed) file
+# (e.g. an mmCIF file with 20,000 atoms (4 MB) needs ~60 MB, BinaryCIF files need a lot more memory per byte)
+memory_per_file_byte = {'cif': 25, 'bcif': 150}
+
+# define a function to estimate the memory needed to parse a file completely (in MB)
+def estimate_parse_memory(cif_path):
+    file_size = os.path.getsize(cif_path)
+    if cif_path.endswith('.gz'):
+        # the last 4 bytes of a gzip file are the size of the uncompressed data (modulo 4 GB, so we assume a compression ratio of at least 5)
+        with open(cif_path, 'rb') as f:
+            f.seek(-4, 2)
+            file_size = max(int.from_bytes(f.read(4), 'little'), 5 * file_size)
+    file_format = 'bcif' if cif_path.endswith(('.bcif', '.bcif.gz')) else 'cif'
+    return file_size * memory_per_file_byte[file_format] / (1024 * 1024)
+
+# tokens in a line of an mmCIF file are separated by whitespace, quoted tokens end at a quote followed by whitespace
+cif_token_pattern = re.compile(r"""'(?:[^']|'(?=\S))*'(?=\s|$)|"(?:[^"]|"(?=\S))*"(?=\s|$)|\S+""")
+
+def split_cif_line(line):
+    tokens = cif_token_pattern.findall(line)
+    return [token[1:-1] if len(token) > 1 and token[0] in '\'"' and token[-1] == token[0] else token for token in tokens]
+
+# define a function to read an mmCIF file line by line and keep only the given categories and the rows of the
+# _atom_site category which are needed for the polypeptides (this never holds the complete file in memory)
+def read_cif_low_memory(cif_file, categories, keep_atoms=True):
+    """
+    This function reads an mmCIF file (.cif or .cif.gz) line by line.
+    :param cif_file: str, filename of the mmCIF file
+    :param categories: list, names of the categories to be read completely (e.g. 'exptl')
+    :param keep_atoms: bool, keep the rows of the _atom_site category which are needed for the polypeptides
+    :return: dict, same format as MMCIF2Dict
+    """
+    category_lines = ['data_low_memory\n']
+    atom_columns = []
+    atom_rows = []
+    row_tokens = []
+    previous_key = None
+    first_model = None
+    section = None      # 'category' while reading one of the given categories, 'atoms' while reading the _atom_site loop
+    loop_line = False
+    in_text_field = False
+    with open_structure_file(cif_file) as handle:
+        for line in handle:
+            # lines in multi-line text fields (between lines starting with ;) are only kept if they belong to one of the given categories
+            if in_text_field or line.startswith(';'):
+                if line.startswith(';'):
+                    in_text_field = not in_text_field
+                if section == 'category':
+                    category_lines.append(line)
+                continue
+            if line.startswith('loop_'):
+                loop_line = True
+                section = None
+                continue
+            if line.startswith('_'):
+                category = line.split('.', 1)[0][1:]
+                if category == 'atom_site' and loop_line and keep_atoms:
+                    section = 'atoms'
+                    atom_columns = []
+                if section == 'atoms' and category == 'atom_site':
+                    atom_columns.append(line.split()[0])
+                elif category in categories:
+                    if section != 'category' or category != current_category:
+                        category_lines.append('#\nloop_\n' if loop_line else '#\n')
+                    section = 'category'
+                    current_category = category
+                    category_lines.append(line)
+                else:
+                    section = None
+                loop_line = False
+                continue
+            if line.startswith('#') or line.startswith('data_'):
+                section = None
+                loop_line = False
+                continue
+            if section == 'category':
+                category_lines.append(line)
+            elif section == 'atoms':
+                # a row of the _atom_site loop can be split over several lines
+                row_tokens += split_cif_line(line)
+                while len(row_tokens) >= len(atom_columns):
+                    row = row_tokens[:len(atom_columns)]
+                    row_tokens = row_tokens[len(atom_columns):]
+                    values = dict(zip(atom_columns, row))
+                    model = values.get('_atom_site.pdbx_PDB_model_num')
+                    if first_model is None:
+                        first_model = model
+                    if model != first_model:
+                        continue
+                    key = tuple(values.get(f'_atom_site.{column_name}') for column_name in atom_site_key_columns[:-1])
+                    if key != previous_key or values.get('_atom_site.label_atom_id') in backbone_atoms:
+                        atom_rows.append(row)
+                    previous_key = key
+    mmcif_dict = MMCIF2Dict(io.StringIO(''.join(category_lines)))
+    for i, column_name in enumerate(atom_columns):
+        mmcif_dict[column_name] = [row[i] for row in atom_rows]
+    return mmcif_dict
+
+# define a function to check if there is a peptide bond between two atoms (C of one residue and N of the next residue)
+# in the same way as Biopython's PPBuilder does (all alternative locations of disordered atoms are tested)
+def is_peptide_bond(c_atom, n_atom, radius=1.8):
+    c_list = c_atom.disordered_get_list() if c_atom.is_disordered() else [c_atom]
+    n_list = n_atom.disordered_get_list() if n_atom.is_disordered() else [n_atom]
+    for n in n_list:
+        for c in c_list:
+            # N and C must have the same altloc identifier or one altloc blank
+            if n.get_altloc() == c.get_altloc() or n.get_altloc() == ' ' or c.get_altloc() == ' ':
+                if (c - n) < radius:
+                    return True
+    return False
+
+# define a function to get the polypeptide sequences of a structure
+# this gives the same sequences as PPBuilder().build_peptides(structure), but instead of checking the distance between
+# the C and N atoms of two residues one pair at a time, the distances for all residue pairs of a chain are computed at once
+def build_polypeptide_sequences(structure, radius=1.8):
+    """
+    This function builds the polypeptides (stretches of standard amino acids connected by peptide bonds)
+    of the first model of a structure and returns their sequences.
+    :param structure: Bio.PDB Structure object
+    :param radius: float, maximum distance between the C and N atoms of a peptide bond
+    :return: list of polypeptide sequences (str)
+    """
+    sequences = []
+    for chain in structure[0]:
+        residues = list(chain)
+        if len(residues) < 2:
+            continue
+        # only standard amino acids can be part of a polypeptide
+        accepted = np.array([is_aa(residue, standard=True) for residue in residues])
+        # get the C and N atom of every residue (None if it doesn't exist) and their coordinates (NaN if the atom doesn't exist)
+        c_atoms = [residue['C'] if residue.has_id('C') else None for residue in residues]
+        n_atoms = [residue['N'] if residue.has_id('N') else None for residue in residues]
+        c_coords = np.array([atom.coord if atom is not None else [np.nan] * 3 for atom in c_atoms], dtype=np.float32)
+        n_coords = np.array([atom.coord if atom is not None else [np.nan] * 3 for atom in n_atoms], dtype=np.float32)
+        # distance between the C atom of each residue and the N atom of the next residue (for all residue pairs at once)
+        difference = c_coords[:-1] - n_coords[1:]
+        distances = np.sqrt(np.sum(difference * difference, axis=1))
+        # two residues are connected if both are amino acids and the distance is smaller than the radius
+        # (missing atoms have a distance of NaN, so they are never connected)
+        connected = accepted[:-1] & accepted[1:] & (distances < radius)
+        # for disordered atoms or atoms with altloc identifiers, we check all alternative locations like the PPBuilder
+        for i in range(len(residues) - 1):
+            c_atom = c_atoms[i]
+            n_atom = n_atoms[i + 1]
+            if accepted[i] and accepted[i + 1] and c_atom is not None and n_atom is not None:
+                if c_atom.is_disordered() or n_atom.is_disordered() or (c_atom.get_altloc() != ' ' and n_atom.get_altloc() != ' '):
+                    connected[i] = is_peptide_bond(c_atom, n_atom, radius)
+        # each stretch of connected residue pairs is one polypeptide
+        stretch_edges = np.diff(np.concatenate(([0], connected.astype(int), [0])))
+        for start, end in zip(np.flatnonzero(stretch_edges == 1), np.flatnonzero(stretch_edges == -1)):
+            sequences.append(str(Polypeptide(residues[start:end + 1]).get_sequence()))
+    return sequences
+
+# define functions to cache the parsed data of every mmCIF file on disk
+# each file is identified by a hash of its content, so files which haven't changed since a previous run (in any gene folder)
+# are not parsed again and new or changed files (e.g. a new revision of a structure) are parsed
+# the data is stored as gzip compressed json file (one file per mmCIF file) in the folder parsed_mmcif in the cache directory
+# the way the polypeptides were built (--fast_polypeptides and low-memory mode) is part of the hash as well,
+# so data parsed in one mode is never reused in another mode
+parse_cache_version = 2 # increase if the format of the cached data changes, so data cached by older versions is parsed again
+
+def get_parse_cache_path(cif_path, low_memory):
+    file_hash = hashlib.sha256()
+    with open(cif_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    builder_mode = f'fast_pp={fast_pp} low_memory={low_memory}'
+    file_hash.update(builder_mode.encode())
+    return join(cache_dir, 'parsed_mmcif', f'{file_hash.hexdigest()}.json.gz')
+
+def read_parse_cache(cache_path):
+    """
+    This function will return the cached parsed data for an mmCIF file
+    if it exists (and contains the polypeptide sequences if we need them), otherwise None
+    
+    :param cache_path: string
+    :return: Dict or None
+    """
+    try:
+        with gzip.open(cache_path, 'rt') as f:
+            cached_data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached_data.get('version') != parse_cache_version:
+        return None
+    # update the modification time of the file, so we know it has been used recently (needed to remove least recently used files)
+    try:
+        os.utime(cache_path)
+    except OSError:
+        pass
+    if extract_pp == True and cached_data['poly_seqs'] is None:
+        return None
+    # create the SeqRecords for the FASTA file from the cached data
+    seq_records = []
+    for record_id, name, description, sequence, chain, dbxrefs in cached_data['seq_records']:
+        seq_record = SeqRecord(Seq(sequence), id=record_id, name=name, description=description, dbxrefs=dbxrefs)
+        seq_record.annotations = {'chain': chain, 'molecule_type': 'protein'}
+        seq_records.append(seq_record)
+    return {'seq_records': seq_records, 'header': cached_data['header'], 'poly_seqs': cached_data['poly_seqs'] or []}
+
+def write_parse_cache(cache_path, parsed_file):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # polypeptide sequences are stored as None if they haven't been extracted, so they are extracted if we need them in a later run
+    cached_data = {'version': parse_cache_version,
+                   'seq_records': [[r.id, r.name, r.description, str(r.seq), r.annotations['chain'], r.dbxrefs] for r in parsed_file['seq_records']],
+                   'header': parsed_file['header'],
+                   'poly_seqs': parsed_file['poly_seqs'] if extract_pp == True else None}
+    # we write to a temporary file first and then rename it, so other processes never read a half written file
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with gzip.open(tmp_path, 'wt') as f:
+        json.dump(cached_data, f)
+    os.replace(tmp_path, cache_path)
+
+# define a function to parse one mmCIF file
+# (this function is run in separate processes if --workers is set to more than 1, so it only returns the parsed data and
+# doesn't print anything or write any files)
+def parse_cif_file(job):
+    """
+    This function parses one mmCIF file and returns a compact record with all the data we need from it.
+    :param job: tuple, (structure_folder, cif_file, structure_id)
+    :return: dict, {'seq_records': [...], 'header': [resolution, structure_method, deposition_date, structure_name, classification], 'poly_seqs': [...], 'cached': bool, 'low_memory': bool}
+             or None if the file doesn't exist
+    """
+    structure_folder, cif_file, structure_id = job
+    cif_path = join(structure_folder, cif_file)
+    is_bcif = cif_file.endswith(('.bcif', '.bcif.gz'))
+    try:
+        # structures which would need more memory than the memory budget per worker are parsed in low-memory mode
+        low_memory = estimate_parse_memory(cif_path) > max_memory
+        # if the same file has been parsed in the same mode in a previous run, we use the cached data
+        if use_cache == True:
+            cache_path = get_parse_cache_path(cif_path, low_memory)
+            parsed_file = read_parse_cache(cache_path)
+            if parsed_file is not None:
+                parsed_file['cached'] = True
+                parsed_file['low_memory'] = False
+                return parsed_file
+        if extract_pp == True and is_bcif:
+            # BinaryCIF files are decoded into the same dictionary as mmCIF files
+            mmcif_dict = read_bcif_file(cif_path, low_memory=low_memory)
+            structure = get_structure_from_cif_dict(structure_id, mmcif_dict)
+            header = structure.header
+        elif extract_pp == True and low_memory:
+            # only the atoms needed for the polypeptides are read from the file
+            mmcif_dict = read_cif_low_memory(cif_path, header_categories + seqres_categories)
+            structure = get_structure_from_cif_dict(structure_id, mmcif_dict)
+            header = structure.header
+        elif extract_pp == True:
+            # we read the mmCIF file into a dictionary first and create the structure object from it with the MMCIFParser,
+            # so we can also create the SEQRES records from this dictionary
+            # instead of parsing the whole file a second time with SeqIO.parse(cif_file, 'cif-seqres')
+            # gzip compressed files are decompressed while reading, so we never write the uncompressed file to disk
+            with open_structure_file(cif_path) as handle:
+                mmcif_dict = MMCIF2Dict(handle)
+            structure = get_structure_from_cif_dict(structure_id, mmcif_dict)
+            header = structure.header
+        else:
+            # if we don't extract the polypeptides, we don't need the structure object and only read the header and SEQRES categories
+            if is_bcif:
+                mmcif_dict = read_bcif_file(cif_path, header_categories + seqres_categories)
+            elif low_memory and cif_path.endswith('.gz'):
+                # (gzip compressed files would be decompressed into memory completely by read_cif_categories)
+                mmcif_dict = read_cif_low_memory(cif_path, header_categories + seqres_categories, keep_atoms=False)
+            else:
+                mmcif_dict = read_cif_categories(cif_path, header_categories, seqres_categories)
+            header = get_header_from_cif_dict(mmcif_dict)
+    except FileNotFoundError:
+        return None
+    
+    # get the SEQRES records for the FASTA file extracted from the mmCIF file
+    seq_records = get_seqres_records(mmcif_dict)
+    
+    # extract header information:
+    # =====================
+    # not all structures have resolutions (depending on structure method)!
+    # as we want to sort our output later on according to resolution, we are going to
+    # replace all missing values with 999
+    resolution = header['resolution']
+    if not resolution:
+        resolution = 999
+    header_fields = [resolution, header['structure_method'], header['deposition_date'], header['name'], header['head']]
+    
+    # get polypeptide sequences for all polypeptides in current structure
+    # ==================================================
+    # The polypeptide sequences correspond to the sequence as seen in pyMOL, i.e. with gaps/missing residues
+    # we only want to do this if the argument --polypeptides is set to True
+    poly_seqs = []
+    if extract_pp == True and fast_pp == True:
+        poly_seqs = build_polypeptide_sequences(structure)
+    elif extract_pp == True:
+        PolypeptideBuilder = PPBuilder()
+        polypeptides = PolypeptideBuilder.build_peptides(structure)
+        # Sometimes the polypeptides cannot be extraced properly with the PolypeptideBuilder,
+        # (don't know why, but this happens with all the KIF5A structures, in this case polypeptides is an empty list)
+        poly_seqs = [str(pp.get_sequence()) for pp in polypeptides]
+    
+    parsed_file = {'seq_records': seq_records, 'header': header_fields, 'poly_seqs': poly_seqs}
+    if use_cache == True:
+        write_parse_cache(cache_path, parsed_file)
+    parsed_file['cached'] = False
+    parsed_file['low_memory'] = low_memory
+    return parsed_file
+
+# first we collect the mmCIF files to be parsed for each gene
 # we loop over the df containing the folder names and the full paths to each folder
-# we use this information to parse the files in each folder and extract information
+genes_to_parse = []
 folder_counter = 0
    
 for index, row in folder_info.iterrows():
@@ -166,21 +663,81 @@ for index, row in folder_info.iterrows():
         # currently this list contains pdb ids, but in order for the rest of the loop to work, we need a variable called
         # cif_files which contains mmCif filenames to be parsed (pdb.cif)
         # so we do the following:
-        cif_files = [f'{pdb_id}.cif' for pdb_id in new_structures_to_download]
+        # (if the mmCIF file has been stored gzip compressed, we parse the .cif.gz file; if there is only a BinaryCIF file, we parse the .bcif file)
+        cif_files = [get_structure_file(structure_folder, pdb_id, cif_file_extensions) for pdb_id in new_structures_to_download]
         # if there are no new structures to be parsed, we can continue to the next gene/folder
         if len(cif_files) == 0:
             print(f'\nNo new mmCif files to be parsed for {gene} (gene {folder_counter} of {n_folders})')
             continue
         
     elif web_run == False:      
-        # change to the folder containing the files to be parsed
-        os.chdir(structure_folder)              
         # create list with filenames of all pdb/mmCIF files in this folder
         files = [f for f in listdir(row.full_path) if isfile(join(row.full_path, f))]
-        cif_files = [f for f in files if '.cif' in f]
-        # sort list
-        cif_files.sort()
-        
+        # every structure is parsed only once, even if there are several files for it (e.g. pdb_id.cif and pdb_id.cif.gz);
+        # we use the same file as script 03 (gzip compressed mmCIF file, mmCIF file, BinaryCIF file)
+        structure_ids = sorted(set(f.split('.')[0] for f in files if ('.cif' in f) or ('.bcif' in f)))
+        cif_files = [get_structure_file(structure_folder, pdb_id, cif_file_extensions) for pdb_id in structure_ids]
+    
+    genes_to_parse.append((folder_counter, gene, structure_folder, cif_files))
+
+# we need msgpack to parse BinaryCIF files
+if bcif_supported == False and any(cif_file.endswith(('.bcif', '.bcif.gz')) for folder_counter, gene, structure_folder, cif_files in genes_to_parse for cif_file in cif_files):
+    print('msgpack is needed to parse BinaryCIF files (pip install msgpack)')
+    print ('Exiting Python...')
+    sys.exit('msgpack is needed to parse BinaryCIF files (pip install msgpack)')
+
+# now we create one parse job per mmCIF file
+# to parse every structure only once, files linked from the shared structure store into several gene folders
+# only get one job (identified by the device and inode number of the file), all other files get one job each
+# in the format {job key: (structure_folder, cif_file, structure_id)}
+parse_jobs = {}
+for folder_counter, gene, structure_folder, cif_files in genes_to_parse:
+    for cif_file in cif_files:
+        structure_id = cif_file.split('.')[0]          # get the PDB id for each file to be parsed
+        job_key = get_shared_file_key(join(structure_folder, cif_file)) or (structure_folder, cif_file)
+        if job_key not in parse_jobs:
+            parse_jobs[job_key] = (structure_folder, cif_file, structure_id)
+
+# Reading downloaded mmcif files with BioPython
+# and extracting resolution and polypeptide sequence from each mmCIF file:
+# the parsed data is stored in the format {job key: parsed record}
+parsed_files = {}
+n_jobs = len(parse_jobs)
+
+# the parse jobs are run in a pool of n_workers processes
+# (the processes are forked, so they know all the functions and settings of this script;
+# if forking is not possible on this system, we parse all files in this process)
+if n_workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+    print('WARNING! Parallel parsing is not supported on this system, parsing all files in one process')
+    n_workers = 1
+# define a function to get the progress message for a parsed file
+def get_parse_message(parsed_file, structure_id):
+    if parsed_file and parsed_file['cached']:
+        return f'Reused cached data for {structure_id}'
+    if parsed_file and parsed_file['low_memory']:
+        return f'Parsed {structure_id} (low-memory mode)'
+    return f'Parsed {structure_id}'
+
+if n_jobs > 0:
+    print(f'\n>>> Parsing {n_jobs} mmCIF files for {len(genes_to_parse)} genes ({n_workers} processes)\n')
+if n_workers > 1:
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = {executor.submit(parse_cif_file, job): job_key for job_key, job in parse_jobs.items()}
+        for job_counter, future in enumerate(as_completed(futures), start=1):
+            job_key = futures[future]
+            parsed_files[job_key] = future.result()
+            print(f'    [{job_counter}/{n_jobs}] {get_parse_message(parsed_files[job_key], parse_jobs[job_key][2])}')
+else:
+    for job_counter, (job_key, job) in enumerate(parse_jobs.items(), start=1):
+        parsed_files[job_key] = parse_cif_file(job)
+        print(f'    [{job_counter}/{n_jobs}] {get_parse_message(parsed_files[job_key], job[2])}')
+
+# now we merge the parsed data for each gene (in the same order as the genes and files are listed, so the output doesn't
+# depend on the order in which the parse jobs finished) and write the fasta files extracted from the mmCIF files
+# to keep track of which gene a file linked from the shared structure store has been parsed for first
+genes_parsed_for = {}
+   
+for folder_counter, gene, structure_folder, cif_files in genes_to_parse:
     print(f"""\nStarting to parse identified mmCif files for {gene} (gene {folder_counter} of {n_folders}):                   {len(cif_files)} mmCIF files""")
     
     # change to the folder containing the files to be parsed
@@ -193,83 +750,47 @@ for index, row in folder_info.iterrows():
     # create an empty dictionary for polypeptide sequences:
     all_poly_seqs = {}
         
-    # for each mmCIF file to be imported,
-    # set the filename and structure_id that BioParser needs to import mmCIF files and load structure objects       
     cif_counter = 0
     for cif_file in cif_files:
         cif_counter += 1        
-        structure_id = cif_file.replace('.cif', '')          # get the PDB id for each file to be parsed
-        # To load structures for cif files, we first create an MMCIFParser object:
-        parser = MMCIFParser(QUIET=True)
+        structure_id = cif_file.split('.')[0]          # get the PDB id for each file to be parsed
+        job_key = get_shared_file_key(join(structure_folder, cif_file)) or (structure_folder, cif_file)
+        parsed_file = parsed_files.get(job_key)
         
-        # load structure object:
-        print(f'    Getting {gene} structure object for {structure_id}                                                                ({cif_counter} of {len(cif_files)} from mmCIF files for {gene})')
-        # added try and except statement to capture cases where the cif file doesn't exist (no clue why this should be the case,
+        # added if statement to capture cases where the cif file doesn't exist (no clue why this should be the case,
         # but we will print a WARNING if that's the case)
-        try:
-            structure = parser.get_structure(structure_id, cif_file)
-        except FileNotFoundError:
+        if parsed_file is None:
             print(f'WARNING! No file {cif_file} exists')
             continue
+        
+        # if the same file has already been parsed for another gene (linked from the shared structure store), we reuse the parsed data
+        if job_key in genes_parsed_for:
+            print(f'    Reusing parsed data for {structure_id} (already parsed for {genes_parsed_for[job_key]})                                ({cif_counter} of {len(cif_files)} from mmCIF files for {gene})')
+        else:
+            genes_parsed_for[job_key] = gene
+            print(f'    Getting {gene} structure object for {structure_id}                                                                ({cif_counter} of {len(cif_files)} from mmCIF files for {gene})')
                 
         # we can also extract a FASTA file with the sequence in FASTA format:
         print(f'        >>> creating FASTA file extracted from mmCIF file for {structure_id}')
-        seq = SeqIO.parse(cif_file, 'cif-seqres')
-        SeqIO.write(seq, f'{structure_id}_ex.fasta', 'fasta')
+        SeqIO.write(parsed_file['seq_records'], f'{structure_id}_ex.fasta', 'fasta')
         
         # now that we have extracted the structure object as well as the fasta file from the cif file,
         # we can delete this cif file to save space on the disk
-        if delete_files == True:
+        # (unless there is no pdb file for this structure: then script 03 gets the unsolved residues from the mmCIF file and deletes it afterwards)
+        if delete_files == True and (exists(f'{structure_id}.pdb') or exists(f'{structure_id}.pdb.gz')):
             os.remove(cif_file)      
         
-        # extract header information:
-        # =====================
-        # extract information from created BioPython structure object
-        print(f'        >>> extracting header information mmCIF file for {structure_id}')        
-        resolution = structure.header["resolution"]
-        structure_method = structure.header['structure_method']
-        deposition_date = structure.header['deposition_date']
-        structure_name = structure.header['name']
-        classification = structure.header['head']
-        
-        # not all structures have resolutions (depending on structure method)!
-        # as we want to sort our output later on according to resolution, we are going to
-        # replace all missing values with 999
-        if not resolution:
-            resolution = 999
-        
         # create a new entry in the df_all_info,  and df_all_resolutions for this structure
         # add new row to each df
-        df_all_info.loc[len(df_all_info)] = [gene, structure_id, resolution, structure_method, deposition_date, structure_name, classification]
-        df_all_resolutions.loc[len(df_all_resolutions)] = [gene, structure_id, resolution]
-
+        df_all_info.loc[len(df_all_info)] = [gene, structure_id] + parsed_file['header']
+        df_all_resolutions.loc[len(df_all_resolutions)] = [gene, structure_id, parsed_file['header'][0]]
 
-        # get polypeptide sequences for all polypeptides in current structure
-        # ==================================================
-        # The polypeptide sequences correspond to the sequence as seen in pyMOL, i.e. with gaps/missing residues
-        # we only want to do this if the argument --polypeptides is set to True, therefore I added an if statement
+        # add the polypeptide sequences of the current structure to the all_poly_seqs dictionary in the format {pdb id:[seq1, seq2...]}
         if extract_pp == True:
-            print(f'        >>> getting polypeptides sequences from mmCIF file for {structure_id}')
-            PolypeptideBuilder = PPBuilder()
-            polypeptides = PolypeptideBuilder.build_peptides(structure)
-                
-            # Sometimes the polypeptides cannot be extraced properly with the PolypeptideBuilder,
-            # (don't know why, but this happens with all the KIF5A structures, in this case polypeptides is an empty list)
+            polypeptides = parsed_file['poly_seqs']
             if not polypeptides:
                 print(' Could not build polypeptide sequences with PPBuilder.')
-                
-            # create new dictionary entry in all_poly_seqs dictionary in the format {pdb id:[seq1, seq2...]}
-            # create entry (empty list to be populated) for key=structure_id
-            all_poly_seqs[structure_id] = []
-                
-            # add all polypeptides to list in all_poly_seqs[structure_id]
-            # if polypeptides is empty because the PPBuilder did not work properly, this code will not do anything as there are no elements in the list to loop over.
-            counter=0
-            for pp in polypeptides:
-                counter += 1
-                seq = pp.get_sequence()
-                # add sequence to all_poly_seqs dictionary:
-                all_poly_seqs[structure_id].append(seq)
+            all_poly_seqs[structure_id] = list(polypeptides)
         
     print(f'Complete!\n    All mmCIF files for {gene} have been parsed!')
                 
@@ -387,6 +908,10 @@ df_all_info.to_csv('02_structure_info.csv', index = False)
 if extract_pp == True:
     df_all_poly_seq.to_csv('02_all_poly_seq.csv', index = False)
 
+# remove the least recently used files from the cache if it has grown too large
+if use_cache == True:
+    evict_cache(cache_dir, max_cache_size)
+
 # change back to target directory
 os.chdir(target_directory)
 
@@ -1,26 +1,35 @@
 # This script takes a csv files as input, namely:
 #      - 01_search_overview_folders.csv
 # and will
-#      - search for pdb files in all folders listed in 01_search_overview_folders.csv
+#      - search for mmCIF (or pdb) files in all folders listed in 01_search_overview_folders.csv
 #      - extract info on missing residues / residues which have not been solved in the crystal structure for each pdb structure
 #      - output the following files:
 #                - a csv file called 03_unsolved_residues_per_structure.csv listing all unsolved residues in all structures for all genes
 #                  (one row for each structure)
 #                - a csv files called 03_unsolved_residues_per_chain.csv listing all unsolved residues in all chains of all structures for all genes
-#                  (one row for each chain)
+#                  (one row for each chain; the unsolved residues are stored as intervals of consecutive positions)
 #  ----------------------------------------------------------------------------------------------------------------------------------
    
 # Set up
 import pandas as pd
+import numpy as np
 import os
 from os import listdir
 from os.path import isfile, join, exists
 import ast
+import gzip
+import re
 import sys
 import argparse
 from datetime import datetime
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from Bio.PDB import *
+from Bio.PDB.MMCIF2Dict import MMCIF2Dict
+from Bio.PDB.parse_pdb_header import _parse_remark_465
+# functions to read the structure files (shared by scripts 01, 02 and 03)
+from mutapipe_structure_files import open_structure_file, get_shared_file_key, get_structure_file, bcif_supported, read_bcif_file, read_cif_category, one_letter_codes
 
 # get this script's name:
 script_name = os.path.basename(__file__)
@@ -49,12 +58,13 @@ delete_files=False                  # specify whether to delete pdb files after
 # download_files_to_separate_directory = True # specify if pdb mmcif and fasta files should be stored in separate directory
 web_run = True # specify if pdb mmcif and fasta files should be stored in separate directory
 mutafy_directory = f'{target_directory}/mutafy' # set path to folder where structures will be/are stored
+n_workers = 1 # number of processes used to extract the unsolved residues from the structure files at the same time
                                                                                         
                                             
 # Now we create an argument parser called ap to which we can add the arguments we want to have in the terminal
 ap = argparse.ArgumentParser(description="""****    This script takes a csv files as input, namely:
 01_search_overview_folders.csv and will:
-1. search for pdb files in all folders listed in 01_search_overview_folders.csv
+1. search for mmCIF (or pdb) files in all folders listed in 01_search_overview_folders.csv
 2. extract info on missing residues / residues which have not been solved in the crystal structure for each pdb structure
 4. output the following files:
 (1) a csv file called 03_unsolved_residues_per_structure.csv listing all unsolved residues in all structures for all genes (one row for each structure)
@@ -66,6 +76,7 @@ ap.add_argument("-del", "--delete_files", type=str2bool, required = False, help=
 # ap.add_argument("-s", "--sep_dir", type=str2bool, required = False, help=f'specify if pdb mmcif and fasta files should be stored in separate directory (True) or not (False), default = {str(download_files_to_separate_directory)}')
 ap.add_argument("-w", "--web_run", type=str2bool, required = False, help=f'Indicate whether MutaPipe is run via a webserver (True) or not (False), default = {str(mutafy_directory)}')
 ap.add_argument("-m", "--mutafy", required = False, help=f'set path to mutafy directory where information from previous runs is stored, default = {mutafy_directory}')
+ap.add_argument("-wk", "--workers", type=int, required = False, help=f'Specify number of processes used to extract the unsolved residues from the structure files at the same time, default = {str(n_workers)}')
 
 args = vars(ap.parse_args())
 
@@ -76,6 +87,7 @@ target_directory  = target_directory if args["target"]   == None else args["targ
 delete_files  = delete_files if args["delete_files"]   == None else args["delete_files"]
 web_run = web_run if args["web_run"] == None else args["web_run"]
 mutafy_directory = mutafy_directory if args["mutafy"] == None else args["mutafy"]
+n_workers = n_workers if args["workers"] == None else args["workers"]
 
 # ----------------------------------------------------------------------------------------------------------------------------------
 # We want to write all our Output into the Results directory
@@ -127,7 +139,8 @@ if web_run:
 unsolved = pd.DataFrame(columns=['gene', 'structure_id', 'unsolved_residues_in_structure'])
 
 # we also create a df to store similar information, but here we want one row for each chain, instead of one row for each structure
-unsolved_per_chain = pd.DataFrame(columns=['gene', 'structure_id', 'chain', 'unsolved_residues_in_chain'])
+# (the unsolved residues of each chain are stored as intervals, see encode_unsolved_residues)
+unsolved_per_chain = pd.DataFrame(columns=['gene', 'structure_id', 'chain', 'unsolved_starts', 'unsolved_ends', 'unsolved_residues', 'unsolved_other_residues'])
 
 # define variable to keep track of genes being looked at (for console output)
 previous_gene = 'no_gene'
@@ -136,6 +149,119 @@ counter = 0
 # define variable to count number of pdb files parsed overall
 pdb_total = 0
 
+# define a function to get the missing residues from an mmCIF file (or a BinaryCIF file)
+def get_missing_residues_from_cif(cif_file):
+    """
+    This function will get all unobserved polymer residues listed in the category pdbx_unobs_or_zero_occ_residues
+    of an mmCIF file (this is the same information as in REMARK 465 of the pdb file)
+    
+    :param cif_file: string
+    :return: List of dictionaries in the same format as the missing residues from parse_pdb_header
+             (keys: 'model', 'res_name', 'chain', 'ssseq', 'insertion')
+    """
+    if cif_file.endswith(('.bcif', '.bcif.gz')):
+        mmcif_dict = read_bcif_file(cif_file, ['pdbx_unobs_or_zero_occ_residues'])
+    else:
+        mmcif_dict = read_cif_category(cif_file, 'pdbx_unobs_or_zero_occ_residues')
+    # depending on the BioPython version, a key with only one value is stored as a string instead of a list
+    def get_values(key):
+        values = mmcif_dict.get(f'_pdbx_unobs_or_zero_occ_residues.{key}', [])
+        return [values] if isinstance(values, str) else values
+    missing_res = []
+    first_model = None
+    for model, polymer_flag, occupancy_flag, chain, res_name, ssseq, insertion in zip(get_values('PDB_model_num'), get_values('polymer_flag'), get_values('occupancy_flag'),
+                                                                                     get_values('auth_asym_id'), get_values('auth_comp_id'), get_values('auth_seq_id'), get_values('PDB_ins_code')):
+        # REMARK 465 only lists polymer residues which are unobserved (occupancy_flag 1, not just zero occupancy)
+        if polymer_flag != 'Y' or occupancy_flag != '1':
+            continue
+        # for structures with several models (e.g. NMR), unobserved residues are listed for every model, but we only need them once
+        if first_model is None:
+            first_model = model
+        if model != first_model:
+            continue
+        try:
+            ssseq = int(ssseq)
+        except ValueError:
+            continue
+        missing_res.append({'model': int(model) if model.isdigit() else None, 'res_name': res_name, 'chain': chain, 'ssseq': ssseq, 'insertion': None if insertion in ['?', '.'] else insertion})
+    return missing_res
+
+# define a function to get the missing residues from the header of a pdb file
+# parse_pdb_header() collects and parses all header lines, but we only need REMARK 465, so we only check which lines
+# belong to REMARK 465 and stop reading at the end of the REMARK 465 block (REMARK records are sorted by their number)
+# or at the first coordinate record (ATOM/HETATM/MODEL), where the header ends
+def get_missing_residues_from_pdb(pdb_file):
+    """
+    This function will get all missing residues listed in REMARK 465 of a pdb file
+    
+    :param pdb_file: string
+    :return: List of dictionaries in the same format as the missing residues from parse_pdb_header
+             (keys: 'model', 'res_name', 'chain', 'ssseq', 'insertion')
+    """
+    missing_res = []
+    with open_structure_file(pdb_file) as handle:
+        for line in handle:
+            if line.startswith('REMARK 465'):
+                # the lines are parsed in exactly the same way as in parse_pdb_header
+                tail = line.rstrip()[10:].strip()
+                if tail:
+                    missing_res_info = _parse_remark_465(tail)
+                    if missing_res_info:
+                        missing_res.append(missing_res_info)
+            elif missing_res or line.startswith(('ATOM  ', 'HETATM', 'MODEL ')):
+                break
+    return missing_res
+
+# define a function to get the missing residues from a structure file (mmCIF, BinaryCIF or pdb file)
+# (this function is run in separate processes if --workers is set to more than 1)
+def get_missing_residues(structure_file):
+    """
+    :param structure_file: string, full path to the structure file
+    :return: List of dictionaries (keys: 'model', 'res_name', 'chain', 'ssseq', 'insertion'), None if the file doesn't exist
+    """
+    try:
+        if structure_file.endswith(('.cif', '.cif.gz', '.bcif', '.bcif.gz')):
+            # only the category with the unobserved residues is read from the mmCIF file
+            return get_missing_residues_from_cif(structure_file)
+        # only the REMARK 465 block is read from the pdb file
+        # (gzip compressed files are decompressed while reading, so we never write the uncompressed file to disk)
+        return get_missing_residues_from_pdb(structure_file)
+    except FileNotFoundError:
+        return None
+
+# define a function to convert the unsolved residues of a chain into intervals of consecutive positions
+# instead of listing every residue (e.g. ['ASP1', 'ALA2', 'GLU3', ...]), we store the sorted start and end positions of all intervals
+# and the one letter codes of the residues in the intervals (residues which are not amino acids are stored as '?'
+# and their names are stored separately, so script 07 can list all unsolved residues with their names like before),
+# so script 07 can check if a position is unsolved with a binary search
+# (residues with insertion codes have the same position as the residue before them, so they start a new interval)
+def encode_unsolved_residues(residues):
+    """
+    :param residues: list of tuples (residue name, position), e.g. [('ASP', 1), ('ALA', 2), ...]
+    :return: tuple of strings (start positions, end positions, one letter codes of all residues in the intervals,
+             names of the residues stored as '?'), e.g. ('1 20', '16 22', 'DAEFRHDSGYEVHHQKLVF', '')
+    """
+    residues = sorted(residues, key=lambda residue: residue[1])
+    starts = []
+    ends = []
+    for name, pos in residues:
+        if ends and pos == ends[-1] + 1:
+            ends[-1] = pos
+        else:
+            starts.append(pos)
+            ends.append(pos)
+    return (' '.join(str(start) for start in starts), ' '.join(str(end) for end in ends), ''.join(one_letter_codes.get(name, '?') for name, pos in residues),
+            ' '.join(name for name, pos in residues if name not in one_letter_codes))
+
+# define a function to convert the unsolved residues of a chain from the format used by previous versions of this script
+# (a list in string format, e.g. "['ASP1', 'ALA2', ...]") into intervals
+def encode_legacy_unsolved_residues(unsolved_residues):
+    residues = [re.match(r'(.*?)(-?\d+)$', residue).groups() for residue in ast.literal_eval(unsolved_residues)]
+    return encode_unsolved_residues([(name, int(pos)) for name, pos in residues])
+
+# first we collect the structure files for each gene
+genes_to_parse = []
+
 # we loop over the folders df to check each of the listed folders for pdb files
 for index, row in folders.iterrows():
     counter += 1
@@ -151,7 +277,8 @@ for index, row in folders.iterrows():
         # currently this list contains pdb ids, but in order for the rest of the loop to work, we need a variable called
         # pdb_files which contains pdb filenames to be parsed (pdb.pdb)
         # so we do the following:
-        pdb_files = [f'{pdb_id}.pdb' for pdb_id in new_structures_to_download]
+        # (we parse the mmCIF file (.cif or .cif.gz) or the BinaryCIF file; if there is no mmCIF file, we use the pdb file)
+        pdb_files = [get_structure_file(structure_folder, pdb_id) for pdb_id in new_structures_to_download]
         # if there are no new structures to be parsed, we can continue to the next gene/folder
         if len(pdb_files) == 0:
             print(f'\nNo new pdb files to be parsed for {gene} (gene {counter} of {len(folders)})\n')
@@ -162,9 +289,9 @@ for index, row in folders.iterrows():
 #         os.chdir(structure_folder)              
         # create list with filenames of all pdb/mmCIF files in this folder
         files = [f for f in listdir(row.full_path) if isfile(join(row.full_path, f))]
-        pdb_files = [f for f in files if '.pdb' in f]
-        # sort list
-        pdb_files.sort()
+        # we use the mmCIF file of each structure and only use the pdb file if there is no mmCIF file (e.g. if script 02 has deleted it)
+        structure_ids = sorted(set(f[:4] for f in files if ('.pdb' in f) or ('.cif' in f) or ('.bcif' in f)))
+        pdb_files = [get_structure_file(structure_folder, pdb_id) for pdb_id in structure_ids]
             
     # update pdb_total
     pdb_total += len(pdb_files)
@@ -172,37 +299,77 @@ for index, row in folders.iterrows():
     # print information to console
     if gene != previous_gene:
         print(f'>>> Looping over {len(pdb_files)} pdb files for gene {gene} (gene {counter} of {len(folders)})...')
-    
-    # now that we have a list of all pdb files in the current folder, we can extract information from them and append it to our unsolved df
-    
-    # Biopython has a method to parse pdb headers
-    # The missing residues are also stored in the pdb header information
-    print('    >>> parsing pdb headers and extracting unsolved residues...\n')
+    genes_to_parse.append((gene, structure_folder, pdb_files))
+
+# BinaryCIF files can only be parsed if msgpack is installed
+if bcif_supported == False and any(pdb.endswith(('.bcif', '.bcif.gz')) for gene, structure_folder, pdb_files in genes_to_parse for pdb in pdb_files):
+    print('msgpack is needed to parse BinaryCIF files (pip install msgpack)')
+    print ('Exiting Python...')
+    sys.exit('msgpack is needed to parse BinaryCIF files (pip install msgpack)')
+
+# now we create one job per structure file
+# to parse every structure only once, files linked from the shared structure store into several gene folders
+# get the same job key (their device and inode number), all other files are identified by their path
+# the jobs are stored in the format {job key: full path of the file} and the job key of every file in the format {full path of the file: job key}
+# (the job keys are determined before any file is deleted, as deleting a linked file changes the number of links of the other files)
+parse_jobs = {}
+file_job_keys = {}
+for gene, structure_folder, pdb_files in genes_to_parse:
+    for pdb in pdb_files:
+        structure_file = join(structure_folder, pdb)
+        job_key = get_shared_file_key(structure_file) or structure_file
+        file_job_keys[structure_file] = job_key
+        if job_key not in parse_jobs:
+            parse_jobs[job_key] = structure_file
+
+# the missing residues are stored in the format {job key: missing residues}
+parsed_files = {}
+n_jobs = len(parse_jobs)
+
+# the jobs are run in a pool of n_workers processes
+# (the processes are forked, so they know all the functions and settings of this script;
+# if forking is not possible on this system, we parse all files in this process)
+# Biopython has a method to parse pdb headers, but we only read the part of each file with the missing residues
+if n_workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+    print('WARNING! Parallel parsing is not supported on this system, parsing all files in one process')
+    n_workers = 1
+if n_jobs > 0:
+    print(f'\n    >>> extracting unsolved residues from {n_jobs} files for {len(genes_to_parse)} genes ({n_workers} processes)...\n')
+if n_workers > 1:
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = {executor.submit(get_missing_residues, structure_file): job_key for job_key, structure_file in parse_jobs.items()}
+        for future in as_completed(futures):
+            parsed_files[futures[future]] = future.result()
+else:
+    for job_key, structure_file in parse_jobs.items():
+        parsed_files[job_key] = get_missing_residues(structure_file)
+
+# now we add the missing residues to the unsolved dfs for each gene (in the same order as the genes and files are listed,
+# so the output doesn't depend on the order in which the jobs finished)
+for gene, structure_folder, pdb_files in genes_to_parse:
+    os.chdir(structure_folder)
     
     # as we want to do this for all our pdb files, we initiate a for loop:
     for pdb in pdb_files:
-        # added try and except statement as sometimes the pdb files for newly available structures in a webrun
-        # are not available, e.g. no pdb file because structure is too large.
+        # sometimes the files for newly available structures in a webrun are not available, e.g. because the download failed.
         # if it's not a webrun, then this is not a problem, because we parse all pdb files in a given folder, but in case of a webrun,
         # we specifiy the new ones, so that's why.
-        try:
-            # we parse the header like so:
-            header = parse_pdb_header(pdb)
-        except FileNotFoundError:
-            print(f'No file {pdb} exists. This is likely due to the structure being too large for pdb file format.')
+        missing_res = parsed_files[file_job_keys[join(structure_folder, pdb)]]
+        if missing_res is None:
+            print(f'No file {pdb} exists. This is likely due to the structure not being downloaded.')
             # substract -1 from the pdb_total:
             pdb_total -= 1
             continue
-        # now that we have parese the header information from the pdb file, we can delete the pdb file (don't use it anymore)
+        # now that we have extracted the missing residues from the file, we can delete the file (don't use it anymore)
         if delete_files == True:
             os.remove(pdb)
-        # and we use the header to get the missing residues
-        missing_res = header['missing_residues']
         # missing_res is a list of dictionaries. For each unsolved/missing residue, there is one dictionary with the following keys:
         # 'model', 'res_name', 'chain', 'sseq', 'insertion'
         
         # create empty dictionary to store unsolved residues and positions per chain
         missing_res_dict = {}
+        # and a dictionary with the names and positions of the unsolved residues per chain (to create the intervals)
+        missing_res_positions = {}
         
         # loop over missing_res dictionary to fill missing_res_dict dictionary
         # for each residue we get the name, chain and position
@@ -216,6 +383,7 @@ for index, row in folders.iterrows():
             elif chain not in missing_res_dict.keys():
                 # if the chain is not a key, we create the key first and then add the value (in list format)
                 missing_res_dict[chain] = [f'{name}{pos}']
+            missing_res_positions.setdefault(chain, []).append((name, pos))
             
         # now that we have a dictionary with all the missing residues per chain for the current structure,
         # we can append a row to the df 'unsolved'
@@ -223,8 +391,8 @@ for index, row in folders.iterrows():
         unsolved.loc[len(unsolved)] = [gene, pdb[:4], missing_res_dict]
         
         # we also make a df containing one row per chain (insted of one row per structure), which we can later combine more easily with the info from the blastp output (which are also per chain)
-        for key, value in missing_res_dict.items():
-                unsolved_per_chain.loc[len(unsolved_per_chain)] = [gene, pdb[:4], key, value]
+        for key, value in missing_res_positions.items():
+                unsolved_per_chain.loc[len(unsolved_per_chain)] = [gene, pdb[:4], key, *encode_unsolved_residues(value)]
 
     if not web_run:
         # now that we have looped over all the pdb files in this folder and
@@ -263,7 +431,22 @@ if web_run:
         unsolved.to_csv(f'{mutafy_directory}/03_unsolved_residues_per_structure_mutafy.csv', index = False)
 
     if exists(f'{mutafy_directory}/03_unsolved_residues_per_chain_mutafy.csv'):
-        mutafy_unsolved_res_per_chain = pd.read_csv(f'{mutafy_directory}/03_unsolved_residues_per_chain_mutafy.csv')
+        # (the unsolved residues are read as strings, otherwise e.g. the residues 'NA' would be read as a missing value)
+        mutafy_unsolved_res_per_chain = pd.read_csv(f'{mutafy_directory}/03_unsolved_residues_per_chain_mutafy.csv', converters={'unsolved_starts': str, 'unsolved_ends': str, 'unsolved_residues': str, 'unsolved_other_residues': str})
+        # (rows written before the names of residues which are not amino acids were stored don't have this column)
+        if 'unsolved_other_residues' not in mutafy_unsolved_res_per_chain.columns:
+            mutafy_unsolved_res_per_chain['unsolved_other_residues'] = ''
+        # the mutafy data from previous runs may still list the unsolved residues of each chain (column unsolved_residues_in_chain),
+        # so we convert them into intervals
+        if 'unsolved_residues_in_chain' in mutafy_unsolved_res_per_chain.columns:
+            legacy_rows = mutafy_unsolved_res_per_chain.unsolved_residues_in_chain.notna()
+            for column in ['unsolved_starts', 'unsolved_ends', 'unsolved_residues']:
+                if column not in mutafy_unsolved_res_per_chain.columns:
+                    mutafy_unsolved_res_per_chain[column] = None
+            if legacy_rows.any():
+                encoded_residues = [encode_legacy_unsolved_residues(value) for value in mutafy_unsolved_res_per_chain.unsolved_residues_in_chain[legacy_rows]]
+                mutafy_unsolved_res_per_chain.loc[legacy_rows, ['unsolved_starts', 'unsolved_ends', 'unsolved_residues', 'unsolved_other_residues']] = np.array(encoded_residues, dtype=object)
+            mutafy_unsolved_res_per_chain = mutafy_unsolved_res_per_chain.drop(columns=['unsolved_residues_in_chain'])
         # we update the mutafy data, concatenate it with our df and drop potential duplicates
         # in order to do that, we convert all the values in the unsolved_per_chain df to strings
         unsolved_per_chain = unsolved_per_chain.astype('str')
@@ -149,11 +149,72 @@ fasta_ex_total = 0
 #                                  'description_code' # description code (extracted from fasta_ex file)
 #                                  'uniprot_id', # uniprot id of this sequence (extracted from fasta_ex file)
 
-# make a df to store info from all fasta files
-fasta_df = pd.DataFrame(columns=['gene_name', 'structure_id', 'record_id', 'chain_name', 'species', 'description', 'sequence'])
-
-# make a df to store info from all fasta_ex files
-fasta_ex_df = pd.DataFrame(columns=['gene_name', 'structure_id', 'record_id', 'chain_name', 'uniprot_id', 'description', 'sequence'])
+# columns of the df to store info from all fasta files
+fasta_columns = ['gene_name', 'structure_id', 'record_id', 'chain_name', 'species', 'description', 'sequence']
+
+# columns of the df to store info from all fasta_ex files
+fasta_ex_columns = ['gene_name', 'structure_id', 'record_id', 'chain_name', 'uniprot_id', 'description', 'sequence']
+
+# the dfs (including the df combining both) are created once per gene from the records of all files of the gene and stored in these lists
+# (and concatenated once all genes have been parsed)
+fasta_gene_dfs = []
+fasta_ex_gene_dfs = []
+combined_gene_dfs = []
+
+# define a function to capitalize values which are in all caps (or all lower case), e.g. 'HOMO SAPIENS (9606)' -> 'Homo sapiens (9606)'
+def capitalize_single_case(values):
+    single_case = values.str.isupper().eq(True) | values.str.islower().eq(True)
+    return values.where(~single_case, values.str.capitalize())
+
+# define a function to create the df with the information from the records of all fasta files of a gene
+# the information is extracted from the record descriptions of all records at once
+def create_fasta_df(gene, structure_ids, record_ids, descriptions, sequences):
+    """
+    :param gene: str, name of the gene
+    :param structure_ids: list of str, structure id of each record
+    :param record_ids: list of int, number of each record in its fasta file
+    :param descriptions: list of str, description of each record, e.g. '6KJ2_1|Chain A|RNA-binding protein FUS|Homo sapiens (9606)'
+    :param sequences: list of str, sequence of each record
+    :return: df with the columns in fasta_columns
+    """
+    # the record descriptions are split into their fields: [entity, chain_name, description, species]
+    fields = pd.Series(descriptions, dtype=object).str.split('|', expand=True).reindex(columns=range(4)).astype(object)
+    fasta_gene_df = pd.DataFrame({'gene_name': gene, 'structure_id': structure_ids, 'record_id': record_ids, 'chain_name': fields[1].values,
+                                  'species': fields[3].values, 'description': fields[2].values, 'sequence': sequences}, columns=fasta_columns)
+    # adjust format of description and species if it's in all caps
+    fasta_gene_df['description'] = capitalize_single_case(fasta_gene_df.description)
+    fasta_gene_df['species'] = capitalize_single_case(fasta_gene_df.species)
+    return fasta_gene_df
+
+# define a function to create the df with the information from the records of all fasta_ex files of a gene
+def create_fasta_ex_df(gene, structure_ids, record_ids, descriptions, sequences):
+    """
+    :param gene: str, name of the gene
+    :param structure_ids: list of str, structure id of each record
+    :param record_ids: list of int, number of each record in its fasta_ex file
+    :param descriptions: list of str, description of each record, e.g. '6KJ2:A UNP:P35637 FUS_HUMAN'
+    :param sequences: list of str, sequence of each record
+    :return: df with the columns in fasta_ex_columns
+    """
+    descriptions = pd.Series(descriptions, dtype=object)
+    # the record descriptions are split into their fields, e.g. ['6KJ2:A', 'UNP:P35637', 'FUS_HUMAN']
+    fields = descriptions.str.split(' ', expand=True).reindex(columns=range(3)).astype(object)
+    chain_name = fields[0].str.split(':').str[1]
+    uniprot_id = fields[1].str.split(':').str[1]
+    description = fields[2]
+    # sometimes the record.description in fasta_ex files is unknown and comes in the format
+    # A <unknown description>
+    # also, sometimes the record.description in fasta_ex files is weird and has the following format:
+    # 6G99:A PDB:6G99 6G99
+    # (in this case, the second field is the current structure id)
+    # and in case the record.description comes in another weird format which can't be parsed like this,
+    # we set the chain name, uniprot id and description to unknown
+    unknown = (descriptions.str.contains('unknown', regex=False).eq(True) | uniprot_id.str.lower().eq(pd.Series(structure_ids, dtype=object).str.lower()) |
+               chain_name.isna() | uniprot_id.isna() | description.isna())
+    fasta_ex_gene_df = pd.DataFrame({'gene_name': gene, 'structure_id': structure_ids, 'record_id': record_ids, 'chain_name': chain_name.where(~unknown, 'unknown').values,
+                                     'uniprot_id': uniprot_id.where(~unknown, 'unknown').values, 'description': description.where(~unknown, 'unknown').values,
+                                     'sequence': sequences}, columns=fasta_ex_columns)
+    return fasta_ex_gene_df
 
 # we also define an empty df called combined_df so the code works in case there are no new fastas to be parsed at all
 combined_df = pd.DataFrame(columns=['gene_name', 'structure_id', 'chain_name', 'uniprot_id', 'description', 'species', 'description_ex', 'sequence'])
@@ -202,7 +263,12 @@ for index, row in folder_info.iterrows():
     
     # LOOP OVER FASTA FILES
     # -------------------------------------
-    # now we can loop over all fasta files in this folder to extract information and append it to the fasta_df
+    # now we can loop over all fasta files in this folder to extract information
+    # we collect the structure id, record id, description and sequence of all records in lists and create the fasta_df for this gene from them
+    structure_ids = []
+    record_ids = []
+    descriptions = []
+    sequences = []
     print(f'\n{len(fasta_files)} fasta file(s) have to be parsed for {gene} (gene {folder_counter} of {len(folder_info)})')
     for fasta in fasta_files:
         print(f'    >>> parsing {fasta}')
@@ -219,33 +285,27 @@ for index, row in folder_info.iterrows():
         # now that we've read in the sequence from the fasta file, we can delete it (don't use it anymore)
         if delete_files == True:
             os.remove(fasta)
-        # now we loop over all sequence records to extract the information associated with every sequence
-        record_id = 0
-        for record in fasta_records:
-            record_id += 1
-            # first we extract information from the record description: chain_name, description, species
-            # record.description comes in the following format:
-            # '6KJ2_1|Chain A|RNA-binding protein FUS|Homo sapiens (9606)'
-            chain_name = record.description.split('|')[1]
-            description = record.description.split('|')[2]
-            species = record.description.split('|')[3]
-            # adjust format of description and species if it's in all caps
-            if description.isupper() or description.islower():
-                description = description.capitalize()
-            if species.isupper() or species.islower():
-                species = species.capitalize()            
-            # we also want to extract the sequence for this record/chain
-            sequence = record.seq
-            
-            # now we append all the defined variables in a new row to the bottom of the fasta_df
-            #     the columns are:    ['gene_name', 'structure_id', 'record_id', 'chain_name', 'species', 'description', 'sequence'])
-            fasta_df.loc[len(fasta_df)] = [gene, fasta.replace('.fasta', ''), record_id, chain_name, species, description, sequence]
-        
+        # now we loop over all sequence records to collect the information associated with every sequence
+        # record.description comes in the following format:
+        # '6KJ2_1|Chain A|RNA-binding protein FUS|Homo sapiens (9606)'
+        for record_id, record in enumerate(fasta_records, start=1):
+            structure_ids.append(fasta.replace('.fasta', ''))
+            record_ids.append(record_id)
+            descriptions.append(record.description)
+            sequences.append(str(record.seq))
+    
+    # now we create the fasta_df for this gene: the columns are ['gene_name', 'structure_id', 'record_id', 'chain_name', 'species', 'description', 'sequence']
+    fasta_gene_df = create_fasta_df(gene, structure_ids, record_ids, descriptions, sequences)
+    fasta_gene_dfs.append(fasta_gene_df)
 
     # LOOP OVER FASTA_EX FILES
     # -------------------------------------
     # we do the sam for the fasta_ex files:
-    # we  loop over all fasta_ex files in this folder to extract information and append it to the fasta_ex_df
+    # we  loop over all fasta_ex files in this folder to extract information and create the fasta_ex_df for this gene
+    structure_ids = []
+    record_ids = []
+    descriptions = []
+    sequences = []
     print(f'{len(fasta_ex_files)} fasta_ex file(s) have to be parsed for {gene} (gene {folder_counter} of {len(folder_info)})')
     for fasta_ex in fasta_ex_files:
         print(f'    >>> parsing {fasta_ex}')
@@ -262,66 +322,40 @@ for index, row in folder_info.iterrows():
         # now that we've read in the sequence from the fasta_ex file, we can delete it (don't use it anymore)
         if delete_files == True:
             os.remove(fasta_ex)        
-        # now we loop over all sequence records to extract the information associated with every sequence
-        record_id = 0
-        for record in fasta_ex_records:
-            record_id += 1            
-            # first we want to extract the sequence for this record/chain
-            sequence = record.seq
-            # then we extract information from the record description: chain_name, description, uniprot_id
-            # record.description comes in the following format:
-            # '6KJ2:A UNP:P35637 FUS_HUMAN'
-            # sometimes the record.description in fasta_ex files is unknown and comes in the format
-            # A <unknown description>
-            # if this is the case, we set the following variables to unknown
-            if 'unknown' in record.description:
-                chain_name = 'unknown' #record.description.split(' ')[0] # this is not the actual chain name, but it just starts with 'A' for the first and then goes on alphabetically
-                uniprot_id = 'unknown'
-                description = 'unknown'
-            # also, sometimes the record.description in fasta_ex files is weird and has the following format:
-            # 6G99:A PDB:6G99 6G99
-            # if this is the case, record.description.split(' ')[1].split(':')[1].lower() should be equal to the current structure id:
-            elif record.description.split(' ')[1].split(':')[1].lower() == fasta_ex.replace('_ex.fasta', '').lower():
-                # in this case, we also want to set the same variables to unknown:
-                chain_name = 'unknown' #record.description.split(' ')[0] # this is not the actual chain name, but it just starts with 'A' for the first and then goes on alphabetically
-                uniprot_id = 'unknown'
-                description = 'unknown'                
-            # if the description is not unknow or in this weird format, we do the following instead to extract information:
-            # in case and record.description comes in another weird format which can't be parsed like this, we add a try except statement:
-            else:
-                try:
-                    chain_name = record.description.split(' ')[0].split(':')[1]
-                    uniprot_id = record.description.split(' ')[1].split(':')[1]
-                    description = record.description.split(' ')[2]
-                except:
-                    chain_name = 'unknown' 
-                    uniprot_id = 'unknown'
-                    description = 'unknown'                
-            
-            # now we append all the defined variables in a new row to the bottom of temporary df
-            #     the columns are:    ['gene_name', 'structure_id', 'record_id', 'chain_name', 'uniprot_id', 'description', 'sequence'])
-            # we create a small df for just this sequence /record and append it to the other df
-            temp_ex_df = pd.DataFrame.from_dict({'gene_name':[gene], 'structure_id':[fasta_ex.replace('_ex.fasta', '')], 'record_id':[record_id], 'chain_name':[chain_name], 'uniprot_id':[uniprot_id], 'description':[description], 'sequence':[sequence]})
-            
-            fasta_ex_df = fasta_ex_df.append(temp_ex_df, ignore_index=True)
+        # now we loop over all sequence records to collect the information associated with every sequence
+        # record.description comes in the following format:
+        # '6KJ2:A UNP:P35637 FUS_HUMAN'
+        for record_id, record in enumerate(fasta_ex_records, start=1):
+            structure_ids.append(fasta_ex.replace('_ex.fasta', ''))
+            record_ids.append(record_id)
+            descriptions.append(record.description)
+            sequences.append(str(record.seq))
+
+    # now we create the fasta_ex_df for this gene: the columns are ['gene_name', 'structure_id', 'record_id', 'chain_name', 'uniprot_id', 'description', 'sequence']
+    fasta_ex_gene_df = create_fasta_ex_df(gene, structure_ids, record_ids, descriptions, sequences)
+    fasta_ex_gene_dfs.append(fasta_ex_gene_df)
 
     # now that we have both dfs for this gene (fasta and fasta_ex), we can combine them
-    # for each row in fasta_df, we want to find the corresponding information in fasta_ex_df and append it
+    # for each row in fasta_gene_df, we want to find the corresponding information in fasta_ex_gene_df and append it
+    # instead of the (long) sequences themselves, we use a hash of each sequence to match the rows
+    fasta_gene_hashes = fasta_gene_df.assign(sequence_hash=pd.util.hash_pandas_object(fasta_gene_df.sequence, index=False))
+    fasta_ex_gene_hashes = fasta_ex_gene_df.assign(sequence_hash=pd.util.hash_pandas_object(fasta_ex_gene_df.sequence, index=False))
     
-    # in fasta_ex_df, each chain is listed in a separate row even if it has the same sequence as other chains in the same structure
+    # in fasta_ex_gene_df, each chain is listed in a separate row even if it has the same sequence as other chains in the same structure
     # in this case, all the information except for the record_id, and the chain_name are the same for all these rows.
     # we can thus drop all these rows and just keep the first one
-    # we save the result in a new df called fasta_ex_df_no_duplicates
-    fasta_ex_df_no_duplicates = fasta_ex_df.drop_duplicates(subset=['gene_name', 'structure_id', 'uniprot_id', 'description', 'sequence'])
+    # we save the result in a new df called fasta_ex_gene_df_no_duplicates
+    fasta_ex_gene_df_no_duplicates = fasta_ex_gene_hashes.drop_duplicates(subset=['structure_id', 'uniprot_id', 'description', 'sequence_hash'])
     
-    # now we merge the two dataframes
-    combined_df = pd.merge(fasta_df, fasta_ex_df_no_duplicates, how='left', on=['gene_name', 'structure_id', 'sequence'], suffixes=(None, '_ex'))
+    # now we merge the two dataframes (the gene name and sequence are the same in both, so we only keep them from fasta_gene_df)
+    combined_gene_df = pd.merge(fasta_gene_hashes, fasta_ex_gene_df_no_duplicates.drop(columns=['gene_name', 'sequence']), how='left', on=['structure_id', 'sequence_hash'], suffixes=(None, '_ex'))
     # we rearrange the columns of the combined dataframe to make the output easily readible
     # current cols = ['gene_name', 'structure_id', 'record_id', 'chain_name', 'species',
     #   'description', 'sequence', 'record_id_ex', 'chain_name_ex',
     #  'uniprot_id', 'description_ex']
     # we also drop the following columns as we don't need their info in the output: record_id, record_id_ex, chain_name_ex
-    combined_df = combined_df[['gene_name', 'structure_id', 'chain_name', 'uniprot_id', 'description', 'species', 'description_ex', 'sequence']]
+    combined_gene_df = combined_gene_df[['gene_name', 'structure_id', 'chain_name', 'uniprot_id', 'description', 'species', 'description_ex', 'sequence']]
+    combined_gene_dfs.append(combined_gene_df)
     
     if not web_run:         
         # before we change to the next folder, we write the gene-specific csv files with info on fasta and fasta ex into the current directory
@@ -332,15 +366,21 @@ for index, row in folder_info.iterrows():
 #         fasta_df[fasta_df['gene_name'] == gene].to_csv(f'{results_dir}/{gene}_04_fasta_info.csv', index = False)
 #         fasta_ex_df[fasta_ex_df['gene_name'] == gene].to_csv(f'{results_dir}/{gene}_04_fasta_ex_info.csv', index = False)
 #         combined_df[combined_df['gene_name'] == gene].to_csv(f'{results_dir}/{gene}_04_fasta_combined_info.csv', index = False)
-        fasta_df[fasta_df['gene_name'] == gene].to_csv(f'{gene}_04_fasta_info.csv', index = False)
-        fasta_ex_df[fasta_ex_df['gene_name'] == gene].to_csv(f'{gene}_04_fasta_ex_info.csv', index = False)
-        combined_df[combined_df['gene_name'] == gene].to_csv(f'{gene}_04_fasta_combined_info.csv', index = False)
+        fasta_gene_df.to_csv(f'{gene}_04_fasta_info.csv', index = False)
+        fasta_ex_gene_df.to_csv(f'{gene}_04_fasta_ex_info.csv', index = False)
+        combined_gene_df.to_csv(f'{gene}_04_fasta_combined_info.csv', index = False)
 
         print('\nComplete!\n        All gene-specific csv files have been stored in their respective folders\n')
 
 # change back to results dir and write output files with information on all fasta files from all genes
 os.chdir(results_dir)
 
+# now we create the dfs with the information from all genes
+fasta_df = pd.concat(fasta_gene_dfs, ignore_index=True) if fasta_gene_dfs else pd.DataFrame(columns=fasta_columns)
+fasta_ex_df = pd.concat(fasta_ex_gene_dfs, ignore_index=True) if fasta_ex_gene_dfs else pd.DataFrame(columns=fasta_ex_columns)
+if combined_gene_dfs:
+    combined_df = pd.concat(combined_gene_dfs, ignore_index=True)
+
 
 
 # now, if this is a webrun, we want to read in the data from previous mutafy runs and
@@ -598,6 +598,25 @@ try:
     mutafy_data = pd.read_csv(f'{mutafy_directory}/00_search_overview_PDBids_mutafy.csv', usecols=['gene_name', 'n_available_structures', 'available_structures'])
 except FileNotFoundError:
     mutafy_data = None
+
+# if script 01 only downloaded the best structures for every sequence (option --top_k), the other structures listed in
+# 00_search_overview_PDBids.csv have not been downloaded/parsed/blasted in this run, so we must not add them to the mutafy data
+# (otherwise they would never be downloaded in future webruns, e.g. when a structure with a better resolution is released)
+# skipped structures which have already been processed in an earlier webrun stay in the mutafy data
+if exists(f'{results_dir}/01_search_overview_top_k.csv'):
+    df_top_k = pd.read_csv(f'{results_dir}/01_search_overview_top_k.csv', usecols=['gene_name', 'structure_id', 'selected'])
+    for index, row in webrun_data.iterrows():
+        skipped_this_gene = df_top_k[(df_top_k.gene_name == row.gene_name) & (df_top_k.selected == False)].structure_id.to_list()
+        if len(skipped_this_gene) == 0:
+            continue
+        processed_before = []
+        if mutafy_data is not None and row.gene_name in mutafy_data.gene_name.to_list():
+            processed_before = ast.literal_eval(mutafy_data[mutafy_data.gene_name == row.gene_name].available_structures.values[0])
+        processed_structures = [pdb_id for pdb_id in ast.literal_eval(row.available_structures) if pdb_id not in skipped_this_gene or pdb_id in processed_before]
+        webrun_data.loc[index, 'n_available_structures'] = len(processed_structures)
+        webrun_data.loc[index, 'available_structures'] = str(processed_structures)
+
+if mutafy_data is None:
     webrun_data.to_csv(f'{mutafy_directory}/00_search_overview_PDBids_mutafy.csv', index=False)
 
 # we loop over the webrun_data and update the mutafy data
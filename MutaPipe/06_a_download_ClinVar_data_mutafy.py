@@ -18,6 +18,8 @@ from os.path import exists
 import sys
 import argparse
 from datetime import datetime
+# functions to cache responses from the APIs on disk (shared by all MutaPipe scripts which get data from an API)
+from mutapipe_cache import cached_request, evict_cache
 
 import xml.etree.ElementTree as ET
 
@@ -46,6 +48,9 @@ create_search_log = False     # will create a file called search_log.txt with co
 target_directory = os.getcwd()    # set target directory (where Results folder is located)
 web_run = True # specify if pdb mmcif and fasta files should be stored in separate directory
 mutafy_directory = f'{target_directory}/mutafy' # set path to folder where structures will be/are stored        
+use_cache = True # store responses from the APIs on disk and reuse them in later runs (True) or always get data from the network (False)
+cache_dir = f'{os.path.expanduser("~")}/.cache/MutaPipe' # set path to directory where responses from the APIs are cached
+max_cache_size = 1024 # maximum size of the cache directory in MB (least recently used responses are removed first)
                                                                                       
 # Now we create an argument parser called ap to which we can add the arguments we want to have in the terminal
 ap = argparse.ArgumentParser(description="""****   This script takes a csv file (00_search_overview_availability.csv) containing the gene names of all available genes and unavailable genes (with/without PDB data) as input and will:
@@ -59,6 +64,9 @@ ap.add_argument("-l", "--log", type=str2bool, required = False, help=f'write out
 ap.add_argument("-t", "--target", required = False, help=f'specify target directory, default = {target_directory}')
 ap.add_argument("-w", "--web_run", type=str2bool, required = False, help=f'Indicate whether MutaPipe is run via a webserver (True) or not (False), default = {str(mutafy_directory)}')
 ap.add_argument("-m", "--mutafy", required = False, help=f'set path to mutafy directory where information from previous runs is stored, default = {mutafy_directory}')
+ap.add_argument("-ca", "--cache", type=str2bool, required = False, help=f'Specify whether to cache responses from the APIs on disk (True) or not (False), default = {str(use_cache)}')
+ap.add_argument("-cd", "--cache_dir", required = False, help=f'Set path to directory where responses from the APIs are cached, default = {cache_dir}')
+ap.add_argument("-cs", "--cache_size", type=int, required = False, help=f'Specify maximum size of the cache directory in MB, default = {str(max_cache_size)}')
 
 args = vars(ap.parse_args())
 
@@ -66,6 +74,12 @@ args = vars(ap.parse_args())
 # So we update our variables whenever there is a user input via the terminal:
 create_search_log  = create_search_log  if args["log"]   == None else args["log"]
 target_directory  = target_directory if args["target"]   == None else args["target"]
+use_cache = use_cache if args["cache"] == None else args["cache"]
+cache_dir = cache_dir if args["cache_dir"] == None else os.path.abspath(args["cache_dir"])
+max_cache_size = max_cache_size if args["cache_size"] == None else args["cache_size"]
+# if responses should not be cached, we don't use a cache directory at all
+if not use_cache:
+    cache_dir = None
 
 
 # ----------------------------------------------------------------------------------------------------------------------------------
@@ -142,6 +156,7 @@ if not os.path.exists(clinvar_dir):
 # change to ClinVar_Annotations  folder
 os.chdir(clinvar_dir)
 
+# ----------------------------------------------------------------------------------------------------------------------------------
 # Set up edirect request to clinvar
 # ------------------------------------------
 # for any edirect requests
@@ -163,7 +178,7 @@ for gene in avail_genes.gene_name:
     print(f'\nUsing edirect to query ClinVar for gene {gene_counter} of {len(avail_genes)}: {gene}')
 
     # try to get ids for this gene from clinvar
-    response = requests.get(esearch_url)
+    response = cached_request(cache_dir, 'GET', esearch_url)
 
     if response.status_code == 200:
         print(f'    Downloading ClinVar ids for variants in {gene}')
@@ -208,7 +223,7 @@ for gene in avail_genes.gene_name:
         esummary_url = base_url + f'esummary.fcgi?db=clinvar&id={string_identifiers}'
 
         # and we get the data from clinvar
-        response = requests.get(esummary_url)
+        response = cached_request(cache_dir, 'GET', esummary_url)
 
         if response.status_code == 200:
             print(f'        Downloading ClinVar data for {gene} variants: Batch {batch_counter} of {math.ceil(len(identifiers)/250)}')
@@ -236,6 +251,9 @@ with open(f'{results_dir}/06_a_ClinVar_Annotations_genes_no_data_retrieved.txt',
     for element in genes_no_data_retrieved:
         file.write(element + '\n')
 
+# remove the least recently used responses from the cache if it has grown too large
+evict_cache(cache_dir, max_cache_size)
+
 # change back to target directory
 os.chdir(target_directory)
 
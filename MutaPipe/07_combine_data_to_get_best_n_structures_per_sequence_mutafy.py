@@ -46,6 +46,10 @@ import sys
 import argparse
 import requests
 from datetime import datetime
+# functions to cache responses from the APIs on disk (shared by all MutaPipe scripts which get data from an API)
+from mutapipe_cache import cached_request, evict_cache
+# one letter codes of the amino acids (shared with script 03)
+from mutapipe_structure_files import one_letter_codes
 
 # get this script's name:
 script_name = os.path.basename(__file__)
@@ -98,6 +102,9 @@ n_best_structures = 5 # number of top structures you want to include in the outp
 exclude_unsolved_mismatches = False # indicate if structures where the mismatch of interest is not solved in the crystal structure should be excluded (True) or not (False)
 web_run = True # specify if pdb mmcif and fasta files should be stored in separate directory
 mutafy_directory = f'{target_directory}/mutafy' # set path to folder where structures will be/are stored        
+use_cache = True # store responses from the APIs on disk and reuse them in later runs (True) or always get data from the network (False)
+cache_dir = f'{os.path.expanduser("~")}/.cache/MutaPipe' # set path to directory where responses from the APIs are cached
+max_cache_size = 1024 # maximum size of the cache directory in MB (least recently used responses are removed first)
                                                                                     
 # Now we create an argument parser called ap to which we can add the arguments we want to have in the terminal
 ap = argparse.ArgumentParser(description="""****     Script to get best n structures per mutation. This script takes the following csv files as input:
@@ -136,6 +143,9 @@ ap.add_argument("-n_best", "--n_best_structures", type=int , required = False, h
 ap.add_argument("-e", "--exclude_unsolved_mismatches", type=str2bool, required = False, help=f'indicate whether to exclude cases where the mismatch of interest is not solved in the crystal structure (True) or not (False), default = {str(exclude_unsolved_mismatches)}')
 ap.add_argument("-w", "--web_run", type=str2bool, required = False, help=f'Indicate whether MutaPipe is run via a webserver (True) or not (False), default = {str(mutafy_directory)}')
 ap.add_argument("-m", "--mutafy", required = False, help=f'set path to mutafy directory where information from previous runs is stored, default = {mutafy_directory}')
+ap.add_argument("-ca", "--cache", type=str2bool, required = False, help=f'Specify whether to cache responses from the APIs on disk (True) or not (False), default = {str(use_cache)}')
+ap.add_argument("-cd", "--cache_dir", required = False, help=f'Set path to directory where responses from the APIs are cached, default = {cache_dir}')
+ap.add_argument("-cs", "--cache_size", type=int, required = False, help=f'Specify maximum size of the cache directory in MB, default = {str(max_cache_size)}')
 
 args = vars(ap.parse_args())
 
@@ -149,6 +159,12 @@ n_best_structures = n_best_structures if args["n_best_structures"] == None else
 exclude_unsolved_mismatches = exclude_unsolved_mismatches if args["exclude_unsolved_mismatches"] == None else args["exclude_unsolved_mismatches"]
 web_run = web_run if args["web_run"] == None else args["web_run"]
 mutafy_directory = mutafy_directory if args["mutafy"] == None else args["mutafy"]
+use_cache = use_cache if args["cache"] == None else args["cache"]
+cache_dir = cache_dir if args["cache_dir"] == None else os.path.abspath(args["cache_dir"])
+max_cache_size = max_cache_size if args["cache_size"] == None else args["cache_size"]
+# if responses should not be cached, we don't use a cache directory at all
+if not use_cache:
+    cache_dir = None
 
 # ----------------------------------------------------------------------------------------------------------------------------------
 # We want to write all our Output into the Results directory
@@ -197,10 +213,8 @@ def add_empty_cols(df):
 
 # Define a function that can change one letter AA codes to three letter AA codes and vice versa
 def change_aa_code(one_or_three_letter_code):
-    d = {'CYS': 'C', 'ASP': 'D', 'SER': 'S', 'GLN': 'Q', 'LYS': 'K',
-     'ILE': 'I', 'PRO': 'P', 'THR': 'T', 'PHE': 'F', 'ASN': 'N', 
-     'GLY': 'G', 'HIS': 'H', 'LEU': 'L', 'ARG': 'R', 'TRP': 'W', 'TER':'*',
-     'ALA': 'A', 'VAL':'V', 'GLU': 'E', 'TYR': 'Y', 'MET': 'M','XAA':'X'}
+    # (the one letter codes are shared with script 03, which stores the unsolved residues with them)
+    d = one_letter_codes
       
     if len(one_or_three_letter_code) == 3:
         try:
@@ -219,6 +233,78 @@ def change_aa_code(one_or_three_letter_code):
         updated_code = one_or_three_letter_code
     return updated_code
 
+# Define a function to get a list of all chains from the chain_name in the blastp results
+def get_chains(chain_name):
+    # chain_name is in format 'Chain B' or for multiple chains in format 'Chains A, B, C, D, E, F, G, H'
+    # we first delete the word Chains and then Chain in case it's only a single chain
+    chains = chain_name.replace('Chains ', '')
+    chains = chains.replace('Chain ', '')
+    # now the format of chains is 'B' or 'A, B, C, D, E, F, G, H' if there are multiple chains
+    # in order to get this in a list format, we do
+    # for multiple chains:
+    if len(chains) > 1:
+        chains = chains.split(',')
+    # for one chain
+    else:
+        chains = list(chains)
+    # finally we make sure there are no spaces in the chain names,
+    # e.g. Chains A, B will be a list like ['A', ' B'] and we need to remove the space in ' B'
+    return [chain.strip() for chain in chains]
+
+# Define a function to check if a residue is unsolved in a chain
+# the unsolved residues of each chain are stored as sorted intervals of consecutive positions (see script 03),
+# so we find the last interval starting at or before the position with a binary search
+def is_unsolved(intervals, position, aa):
+    """
+    :param intervals: tuple of numpy arrays (start positions, end positions, index of the first residue of each interval in residues),
+                      a string with the one letter codes of all unsolved residues (residues) and a list with the names of the residues
+                      which are not amino acids (other_residues), as returned by read_unsolved_intervals
+    :param position: int, position of the residue (e.g. 162 for the mismatch T162A)
+    :param aa: str, one letter code of the residue (e.g. 'T' for the mismatch T162A)
+    :return: True if the residue is unsolved in this chain, otherwise False
+    """
+    starts, ends, offsets, residues, other_residues = intervals
+    i = np.searchsorted(starts, position, side='right') - 1
+    # residues with insertion codes have the same position as the residue before them, so several intervals can contain the position
+    # (these are always next to each other, as both the start and the end positions are sorted)
+    while i >= 0 and ends[i] >= position:
+        if residues[offsets[i] + position - starts[i]] == aa:
+            return True
+        i -= 1
+    return False
+
+# Define a function to read the unsolved residues (intervals) of all chains into a dictionary
+def read_unsolved_intervals(unsolved_per_chain):
+    """
+    :param unsolved_per_chain: df with the columns gene, structure_id, chain, unsolved_starts, unsolved_ends, unsolved_residues and unsolved_other_residues (see script 03)
+    :return: dictionary in the format {(gene, structure_id, chain): (starts, ends, offsets, residues, other_residues)}
+    """
+    unsolved_intervals = {}
+    for gene, structure_id, chain, unsolved_starts, unsolved_ends, unsolved_residues, unsolved_other_residues in zip(unsolved_per_chain.gene, unsolved_per_chain.structure_id, unsolved_per_chain.chain,
+                                                                                            unsolved_per_chain.unsolved_starts, unsolved_per_chain.unsolved_ends, unsolved_per_chain.unsolved_residues,
+                                                                                            unsolved_per_chain.unsolved_other_residues):
+        starts = np.array(unsolved_starts.split(), dtype=int)
+        ends = np.array(unsolved_ends.split(), dtype=int)
+        offsets = np.concatenate(([0], np.cumsum(ends - starts + 1)[:-1]))
+        # (if a chain is listed more than once, we use the first row like before)
+        unsolved_intervals.setdefault((gene, structure_id, chain), (starts, ends, offsets, unsolved_residues, unsolved_other_residues.split()))
+    return unsolved_intervals
+
+# Define a function to get the list of unsolved residues of a chain from the intervals, e.g. ['ASP1', 'ALA2', 'GLU3', ...]
+# (the same format as the unsolved residues per structure listed by script 03)
+def get_unsolved_residue_names(intervals):
+    starts, ends, offsets, residues, other_residues = intervals
+    # residues which are not amino acids are stored as '?' and their names are listed in other_residues (in the same order)
+    # (the names are missing in data from older versions of script 03, so we use UNK for unknown residues)
+    other_residues = iter(other_residues)
+    unsolved_residues = []
+    for start, end, offset in zip(starts, ends, offsets):
+        for i in range(end - start + 1):
+            code = residues[offset + i]
+            name = next(other_residues, 'UNK') if code == '?' else change_aa_code(code)
+            unsolved_residues.append(f'{name}{start + i}')
+    return unsolved_residues
+
 # Define a function to add clinvar data to dfs
 def add_clinvar_annotations(df):
     
@@ -276,9 +362,10 @@ def add_clinvar_annotations(df):
                                                                                 str(corresponding_clinvar_annotations.dbs_and_accessions.values)]
     return df
 
+# ----------------------------------------------------------------------------------------------------------------------------------
 # define function for GET request to PDB API
 def get_data(url):
-    response = requests.get(url)
+    response = cached_request(cache_dir, 'GET', url)
     if response.status_code == 200:
         data = response.json()
         return data
@@ -396,7 +483,11 @@ def get_validation_report(pdb_id):
 #       - 05_blastp_results.csv
 #       - 06_b_ClinVar_Annotations.csv
 structure_info = pd.read_csv(f'{results_dir}/02_structure_info.csv')
-unsolved_per_chain = pd.read_csv(f'{results_dir}/03_unsolved_residues_per_chain.csv')
+# (the unsolved residues are read as strings, otherwise e.g. the residues 'NA' would be read as a missing value)
+unsolved_per_chain = pd.read_csv(f'{results_dir}/03_unsolved_residues_per_chain.csv', converters={'unsolved_starts': str, 'unsolved_ends': str, 'unsolved_residues': str, 'unsolved_other_residues': str})
+# (data from older versions of script 03 doesn't list the names of unsolved residues which are not amino acids)
+if 'unsolved_other_residues' not in unsolved_per_chain.columns:
+    unsolved_per_chain['unsolved_other_residues'] = ''
 blastp_results = pd.read_csv(f'{results_dir}/05_blastp_results.csv')
 clinvar_annotations = pd.read_csv(f'{results_dir}/06_b_ClinVar_Annotations.csv')
 
@@ -411,25 +502,16 @@ blastp_results['unsolved_residues_in_structure'] = np.nan
 blastp_results['n_unsolved_residues'] = np.nan
 blastp_results['percent_unsolved_residues'] = np.nan
 
+# the unsolved residues of all chains are stored in a dictionary with the gene, structure id and chain as key, so we don't have to search
+# the unsolved_per_chain df for every chain
+unsolved_intervals = read_unsolved_intervals(unsolved_per_chain)
+
 for index, row in blastp_results.iterrows():
-    # chain_name is in format 'Chain B' or for multiple chains in format 'Chains A, B, C, D, E, F, G, H'
-    # we first delete the word Chains and then Chain in case it's only a single chain
-    chains = row.chain_name.replace('Chains ', '')
-    chains = chains.replace('Chain ', '')
-    # now the format of chains is 'B' or 'A, B, C, D, E, F, G, H' if there are multiple chains
-    # in order to get this in a list format, we do
-    # for multiple chains:
-    if len(chains) > 1:
-        chains = chains.split(',')
-    # for one chain
-    else:
-        chains = list(chains)
-    # finally we make sure there are no spaces in the chain names,
-    # e.g. Chains A, B will be a list like ['A', ' B'] and we need to remove the space in ' B'
-    chains = [chain.strip() for chain in chains]
+    # get a list of all chains with identical sequence in the given structure
+    chains = get_chains(row.chain_name)
         
     # now we have a list of all chains with identical sequence in the given structure
-    # we now loop over this list and retrieve missing residues from the other df (unsolved_per_chain) for each of them
+    # we now loop over this list and retrieve missing residues from unsolved_intervals for each of them
     # and attach this information to the blastp_results df
     # first we create an empty dictionary to populate with all chains (keys) and unsolved residues (values) in this structure
     # which have the same sequence and are thus in one and the same row in the blastp_results df
@@ -438,28 +520,22 @@ for index, row in blastp_results.iterrows():
     n_unsolved_res_per_chain = {}
     percent_unsolved_per_chain = {}
     for chain in chains:
-        # find the unsolved residues for this chain in the unsolved_per_chain df (if there are any)
-        # we use a try statement, because if there are no missing residues for this chain, the values will be empty and it will throw an IndexError
+        # find the unsolved residues for this chain (if there are any)
         # use structure_id and gene and chain name to identify correct value
-        try:
-            unsolved_residues = unsolved_per_chain[(unsolved_per_chain.gene == row.gene_name) &
-                                               (unsolved_per_chain.structure_id == row.structure_id) &
-                                               (unsolved_per_chain.chain == chain)].unsolved_residues_in_chain.values[0]
-            # currently this is a list in string format, so we convert it to a list:
-            unsolved_residues = ast.literal_eval(unsolved_residues)
-            # now we append this value and the chain name to the dictionary:
-            unsolved_dict[chain] = unsolved_residues
-            # we also get the length of the list unsolved_residues which corresponds to the number of unsolved res in the chain
+        intervals = unsolved_intervals.get((row.gene_name, row.structure_id, chain))
+        if intervals is not None:
+            # we add the list of unsolved residues of this chain to the dictionary (e.g. ['ASP1', 'ALA2', 'GLU3', ...]):
+            unsolved_dict[chain] = get_unsolved_residue_names(intervals)
+            # we also get the number of unsolved res in the chain (the number of residues in all intervals)
             # we add this to the n_unsolved_res_per_chain dict
-            n_unsolved_res_per_chain[chain] = len(unsolved_residues)
+            n_unsolved_res_per_chain[chain] = len(intervals[3])
             # we also get the percentage of unsolved residues in the chain (relative to the sequence length)
-            percent_unsolved_per_chain[chain] = round(len(unsolved_residues) / len(row.sequence), 3)
-        except IndexError:
-            # we append an empty list instead if there is no data on unsolved residues for this chain
+            percent_unsolved_per_chain[chain] = round(len(intervals[3]) / len(row.sequence), 3)
+        else:
+            # we add an empty list instead if there is no data on unsolved residues for this chain
             unsolved_dict[chain] = []
             n_unsolved_res_per_chain[chain] = np.nan
             percent_unsolved_per_chain[chain] = np.nan
-            continue
 
     # now that we've looped over all chains which have the same sequence in this structure, we add the unsolved_dict to the blastp_results df
     blastp_results.loc[index, 'unsolved_residues_in_structure'] = str(unsolved_dict)
@@ -514,6 +590,11 @@ df_wt = df_wt.sort_values(by=['gene_name', 'hsp_length', 'similarity', 'resoluti
 # we keep all the available wilttype structures in the df (don't drop any) 
 # write final df to file at the end of the script (see below)
 
+# if script 01 only downloaded the best structures for every sequence (option --top_k), the other wildtype structures
+# have not been parsed, so only the downloaded wildtype structures are listed
+if os.path.exists(f'{results_dir}/01_search_overview_top_k.csv'):
+    print('WARNING: script 01 only downloaded the best structures for every sequence (option --top_k), so 07_wildtype_structures.csv only lists the downloaded wildtype structures, not all available ones\n')
+
 
 # GET N BEST STRUCTURES FOR ALL SAVS
 #  =================================================================================
@@ -548,33 +629,20 @@ for index, row in single_mut_sorted.iterrows():
 single_mut_sorted.loc[:,'aa_index'] = single_mut_sorted.mismatch_of_interest.apply(lambda x: int(x[1:-1]))
 
 # Now we check if the mismatch of interest is solved in the crystal structure or not:
-# we get the mismatch of interest and check if it's in the unsolved residues
-# for this, we get the unsolved residues and change the amino acid code from 3 to 1 letter code
+# we get the mismatch of interest and check if its position is in the unsolved residues (intervals) of each chain
 for index, row in single_mut_sorted.iterrows():
     this_mismatch = row.mismatch_of_interest
-    # get a dict with all unsolved residues per chain
-    # in format {'A': ['LYS283', 'ARG184', ...], 'B' : [..., ...]}
-    unsolved_residues = ast.literal_eval(row.unsolved_residues_in_structure)
-    # create an empty dict to populate with transformed values, i.e. changed AA codes
-    one_letter_unsolved_residues = {}
-    for key, value in unsolved_residues.items():
-        one_letter_unsolved_residues[key] = [change_aa_code(res[:3])+res[3:] for res in value]
-    # now we can check if our mismatch_of_interest is listed in the one_letter_unsolved_residues
-    # mismatch of interest in format 'T162A', thus we take all but the last character of the string
     # we want to create a dictionary with keys = chains and a Boolean value indicating if the mismatch of interest
     # is solved in the crystal structure (True) or not (False)
+    # mismatch of interest in format 'T162A', thus the residue is the first character and the position all but the first and last character
     solved_or_not ={}
-    for key, value in one_letter_unsolved_residues.items():
-        if this_mismatch[:-1] in value:
-            # if this_mismatch is in the unsolved residue list, the mismatch of interest has NOT been solved in
-            # the crystal structure, so we output False
-            solved_or_not[key] = False
-        else:
-            # otherwise the mismatch of interest has been solved in the crystal structure,
-            # and we output True
-            solved_or_not[key] = True
-        # now we can add the solved_or_not dict to the df in the column 'mismatch_solved_in_crystal_structure'
-        single_mut_sorted.loc[index, 'mismatch_solved_in_crystal_structure'] = str(solved_or_not)
+    for chain in get_chains(row.chain_name):
+        intervals = unsolved_intervals.get((row.gene_name, row.structure_id, chain))
+        # if the residue is unsolved, the mismatch of interest has NOT been solved in the crystal structure, so we output False
+        # otherwise the mismatch of interest has been solved in the crystal structure, and we output True
+        solved_or_not[chain] = not (intervals is not None and is_unsolved(intervals, int(this_mismatch[1:-1]), this_mismatch[0]))
+    # now we can add the solved_or_not dict to the df in the column 'mismatch_solved_in_crystal_structure'
+    single_mut_sorted.loc[index, 'mismatch_solved_in_crystal_structure'] = str(solved_or_not)
         
 # Add option to be able to exclude structures where the mismatch of interest is unsolved in crystal structure
 # (missing atomic coordinates)     
@@ -713,33 +781,20 @@ for gene in unique_genes:
         this_mismatch_sorted['mismatch_of_interest'] = mismatch
         
         # Now we check if the mismatch of interest is solved in the crystal structure or not:
-        # we get the mismatch of interest and check if it's in the unsolved residues
-        # for this, we get the unsolved residues and change the amino acid code from 3 to 1 letter code
+        # we get the mismatch of interest and check if its position is in the unsolved residues (intervals) of each chain
         for index, row in this_mismatch_sorted.iterrows():
             this_mismatch = row.mismatch_of_interest
-            # get a dict with all unsolved residues per chain
-            # in format {'A': ['LYS283', 'ARG184', ...], 'B' : [..., ...]}
-            unsolved_residues = ast.literal_eval(row.unsolved_residues_in_structure)
-            # create an empty dict to populate with transformed values, i.e. changed AA codes
-            one_letter_unsolved_residues = {}
-            for key, value in unsolved_residues.items():
-                one_letter_unsolved_residues[key] = [change_aa_code(res[:3])+res[3:] for res in value]
-            # now we can check if our mismatch_of_interest is listed in the one_letter_unsolved_residues
-            # mismatch of interest in format 'T162A', thus we take all but the last character of the string
             # we want to create a dictionary with keys = chains and a Boolean value indicating if the mismatch of interest
             # is solved in the crystal structure (True) or not (False)
+            # mismatch of interest in format 'T162A', thus the residue is the first character and the position all but the first and last character
             solved_or_not ={}
-            for key, value in one_letter_unsolved_residues.items():
-                if this_mismatch[:-1] in value:
-                    # if this_mismatch is in the unsolved residue list, the mismatch of interest has NOT been solved in
-                    # the crystal structure, so we output False
-                    solved_or_not[key] = False
-                else:
-                    # otherwise the mismatch of interest has been solved in the crystal structure,
-                    # and we output True
-                    solved_or_not[key] = True
-                # now we can add the solved_or_not dict to the df in the column 'mismatch_solved_in_crystal_structure'
-                this_mismatch_sorted.loc[index, 'mismatch_solved_in_crystal_structure'] = str(solved_or_not)
+            for chain in get_chains(row.chain_name):
+                intervals = unsolved_intervals.get((row.gene_name, row.structure_id, chain))
+                # if the residue is unsolved, the mismatch of interest has NOT been solved in the crystal structure, so we output False
+                # otherwise the mismatch of interest has been solved in the crystal structure, and we output True
+                solved_or_not[chain] = not (intervals is not None and is_unsolved(intervals, int(this_mismatch[1:-1]), this_mismatch[0]))
+            # now we can add the solved_or_not dict to the df in the column 'mismatch_solved_in_crystal_structure'
+            this_mismatch_sorted.loc[index, 'mismatch_solved_in_crystal_structure'] = str(solved_or_not)
                 
         # Add option to be able to exclude structures where the mismatch of interest is unsolved in crystal structure
         # (missing atomic coordinates)     
@@ -924,6 +979,9 @@ if not web_run:
         output_slice_unique_combi.to_csv(f'{results_dir}/{gene_folder}/{gene}_07_best_structures_all_unique_combinations.csv', index=False)
         output_slice_any_mutation.to_csv(f'{results_dir}/{gene_folder}/{gene}_07_best_structures_any_mutation.csv', index=False)
 
+# remove the least recently used responses from the cache if it has grown too large
+evict_cache(cache_dir, max_cache_size)
+
 # change back to target directory
 os.chdir(target_directory)
 
@@ -10,6 +10,8 @@ import pandas as pd
 import argparse
 import os
 from datetime import datetime
+# functions to cache responses from the APIs on disk (shared by all MutaPipe scripts which get data from an API)
+from mutapipe_cache import cached_request, evict_cache, request_timeout
 import sys
 
 # get this script's name:
@@ -34,6 +36,9 @@ target_directory = os.getcwd()   # set directory to create Results folder with n
                                                 # Default: set to current working directory (where this script is saved)
 create_search_log = False      # will create a file called search_log.txt with console output if set to True,
                                             # prints to console if set to False.
+use_cache = True # store responses from the APIs on disk and reuse them in later runs (True) or always get data from the network (False)
+cache_dir = f'{os.path.expanduser("~")}/.cache/MutaPipe' # set path to directory where responses from the APIs are cached
+max_cache_size = 1024 # maximum size of the cache directory in MB (least recently used responses are removed first)
 
 # ----------------------------------------------------------------------------------------------------------------------------------
 
@@ -58,6 +63,9 @@ ap = argparse.ArgumentParser(description="""****   This script takes a list of g
 ap.add_argument('-g','--genes', nargs='+', required=False, help=f'Specify genes for which to download AlphaFold predicted structures, default = {genes}; to pass a file containing all genes use -g $(cat filename)')
 ap.add_argument("-l", "--log", type=str2bool, required = False, help=f'Write output to .log file in current directory if set to True, default = {str(create_search_log)}')
 ap.add_argument("-t", "--target", required = False, help=f'Specify target directory, default = {target_directory}')
+ap.add_argument("-ca", "--cache", type=str2bool, required = False, help=f'Specify whether to cache responses from the APIs on disk (True) or not (False), default = {str(use_cache)}')
+ap.add_argument("-cd", "--cache_dir", required = False, help=f'Set path to directory where responses from the APIs are cached, default = {cache_dir}')
+ap.add_argument("-cs", "--cache_size", type=int, required = False, help=f'Specify maximum size of the cache directory in MB, default = {str(max_cache_size)}')
 
 args = vars(ap.parse_args())
 
@@ -66,6 +74,12 @@ args = vars(ap.parse_args())
 genes = genes if args["genes"] == None else args["genes"]
 create_search_log  = create_search_log  if args["log"]   == None else args["log"]
 target_directory  = target_directory if args["target"]   == None else args["target"]
+use_cache = use_cache if args["cache"] == None else args["cache"]
+cache_dir = cache_dir if args["cache_dir"] == None else os.path.abspath(args["cache_dir"])
+max_cache_size = max_cache_size if args["cache_size"] == None else args["cache_size"]
+# if responses should not be cached, we don't use a cache directory at all
+if not use_cache:
+    cache_dir = None
 
 # ----------------------------------------------------------------------------------------------------------------------------------
 # We want to write all our Output into the Results directory
@@ -141,7 +155,7 @@ def get_UniProt_data(genes):
     # try this format instead:
     # 'https://rest.uniprot.org/uniprotkb/search?compressed=true&fields=accession%2Cid%2Cprotein_name%2Cgene_names%2Corganism_name%2Clength&format=tsv&query=organism_name%3A%22homo%20sapiens%22%20AND%20%28gene_exact%3Abraf%20OR%20gene_exact%3Abrca1%20OR%20gene_exact%3Abrca2%20OR%20gene_exact%3Abtk%20OR%20gene_exact%3Acasp10%20OR%20gene_exact%3Acasp8%29%20AND%20reviewed%3Atrue&size=500'
     # Now we get data from the API and save it as a txt file
-    response = requests.get(final_url)
+    response = cached_request(cache_dir, 'GET', final_url)
     if response.status_code == 200:
         with open ('uniprot_results.txt', 'w') as file:
             file.write(response.text)
@@ -160,7 +174,13 @@ def get_UniProt_data(genes):
 # Define a function which takes a uniprot ID as input and will download the corresponding mmCif structure from the AlphaFold Database
 def get_AlphaFold_structure(uniprot_id):
     mmCIF_url = f'https://alphafold.ebi.ac.uk/files/AF-{uniprot_id}-F1-model_v2.cif'
-    response = requests.get(mmCIF_url)
+    try:
+        response = requests.get(mmCIF_url, timeout=request_timeout)
+    except requests.exceptions.RequestException as error:
+        # connection problems / timeouts are treated like a download without data
+        print(f'request failed ({error})')
+        print(f'No data retrieved for UniProt ID {uniprot_id}\n')
+        return 0 # for failure
     if response.status_code == 200:
         data = response.text
         # save the data as mmCIF file
@@ -255,6 +275,9 @@ rel_cols = ['Gene', 'Entry', 'Protein names', 'Length', 'Link AlphaFold Database
 os.chdir(results_dir)
 output_df[rel_cols].to_csv('08_AlphaFold_structures.csv', index = False)
 
+# remove the least recently used responses from the cache if it has grown too large
+evict_cache(cache_dir, max_cache_size)
+
 # change back to target directory
 os.chdir(target_directory)
 
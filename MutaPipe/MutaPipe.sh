@@ -20,7 +20,7 @@ LOG="False"
 TARGET_DIRECTORY=$(pwd)
 ORGANISM="Homo sapiens"
 ALL_PDB_IDS="True"
-FORMAT="cif pdb fasta"
+FORMAT="cif fasta"
 POLYPEPTIDES="True"
 DELETE_FILES="True"
 BLASTp_PATH="blastp"
@@ -51,7 +51,7 @@ Help()
    echo "	-g	GENES				Specify genes of interest. To to pass a file containing all gene names use -g \"\$(cat filename)\". Default = $GENES"
    echo "	-o	ORGANISM			Set species for which to search pdb structures. Default = $ORGANISM"
    echo "	-a	ALL_PDB_IDS		    	Specify whether to retrieve all (True) or max. 10 PDB IDs (False) per gene. Default = $ALL_PDB_IDS"
-   echo "	-f	FORMAT			  	Specify file formats to download. Default = $FORMAT. Options = [cif pdb fasta]"
+   echo "	-f	FORMAT			  	Specify file formats to download. Default = $FORMAT. Options = [cif bcif pdb fasta]"
    echo "	-p	POLYPEPTIDES			Specify whether to extract polypeptide sequence (True) or not (False). Default = $POLYPEPTIDES"
    echo "        -d      DELETE_FILES                    Specify whether to delete mmCIF, pdb and fasta files after parsing (True) or not (False). Default = $DELETE_FILES"
    echo "	-b	BLASTp_PATH			Set path to blastp on your system. Default = $BLASTp_PATH"
@@ -171,20 +171,50 @@ cd "$TARGET_DIRECTORY"
 #   -l, --log 			               Write console output to log file in current directory if set to True, default = False
 #   -t, --target TARGET             Specify target directory, default = /Users/debs/OneDrive - King's College London/Pipeline/Pipeline_Git/MutaPipe
 
+# options for all scripts which get data from an API (00_search_pdb.py, 01_download_files.py (metadata from the PDB GraphQL API, not the downloaded files), 06_a_download_ClinVar_data.py, 07_combine_data_to_get_best_n_structures_per_sequence.py, 08_download_AlphaFold_structures.py)
+#   -ca, --cache                    Specify whether to cache responses from the APIs on disk (True) or not (False), default = True
+#   -cd, --cache_dir                Set path to directory where responses from the APIs are cached, default = ~/.cache/MutaPipe
+#   -cs, --cache_size               Specify maximum size of the cache directory in MB, default = 1024
+
 # additional options for script 00_search_pdb.py
 #   -g, --genes 		               Specify genes for which to search pdb structures, default = ['OPTN', 'ERBB4', 'DCTN1']; to pass a file containing all genes use -g $(cat filename)
 #   -o, --organism		            Specify species for which to search pdb structures, default = Homo sapiens
 #   -a, --all		                  Retrieve all (True) vs max. 10 pdb IDs per gene (False), default = True
+#   -wk, --workers                  Specify maximum number of search requests sent to the PDB at the same time, default = 8
+#   -rl, --rate_limit               Specify maximum number of requests per second sent to the PDB (0 = no limit), default = 5
+#   -rt, --retries                  Specify number of times a failed search request is retried, default = 3
+#   -bt, --batch                    Search the PDB for many genes with one request (True) or send one request per gene (False), default = False
+#   -bs, --batch_size               Specify number of genes per search request in batch mode, default = 100
+#   -co, --counts_only              Only get the number of available structures per gene and write 00_search_overview_availability.csv (True) or get all PDB IDs (False), default = False
+#   -i, --incremental               For webserver runs, only search for structures released since the last search for a gene (True) or always search for all structures (False), default = True
+#   -ma, --max_mark_age             Specify maximum number of days since the last search for all structures of a gene before all structures are searched again in an incremental search, so obsolete entries are removed (0 = no maximum), default = 28
 
 # additional options for script 01_download_files.py
-#   -f, --format			            Specify file format to be downloaded. For mmCif files (.cif) use 'cif' ; for pdb files (.pdb) use 'pdb' ; for fasta files (.fasta) use 'fasta' ; default = cif pdb fasta
+#   -f, --format			            Specify file format to be downloaded. For mmCif files (.cif) use 'cif' ; for BinaryCIF files (.bcif) use 'bcif' ; for pdb files (.pdb) use 'pdb' ; for fasta files (.fasta) use 'fasta' ; default = cif fasta
+#   -k, --top_k                     Specify number of structures with the best resolution to be downloaded for every distinct sequence of a gene (should be at least n_best_structures of script 07, larger if script 07 is run with -e True, as it can only list downloaded structures; the wildtype structures listed by script 07 are then also only the downloaded ones; 0 = download all structures), default = 0
+#   -pl, --plan                     Specify whether to only download the file formats needed by the following scripts (True) or all specified formats (False), default = False
+#   -st, --stages                   Specify which of the scripts parsing the downloaded files will be run after this one (used to plan the downloads), default = 02 03 04
+#   -wk, --workers                  Specify maximum number of files downloaded from the PDB at the same time, default = 8
+#   -rt, --retries                  Specify number of times a failed download is retried, default = 3
+#   -gz, --gzip                     Specify whether to store mmCIF and pdb files gzip compressed (True) or uncompressed (False), default = False
+#   -ss, --shared_store             Specify whether to store every file only once in a shared structure store and link it into the gene folders (True) or download it into every gene folder (False), default = False
+#   -sd, --store_dir                Set path to shared structure store (one folder per pdb id and revision), default = TARGET_DIRECTORY/structure_store
+#   -mr, --mirror                   Set path to a local wwPDB mirror with the standard divided layout (data/structures/divided/mmCIF/xy/1xyz.cif.gz); files which are not in the mirror are downloaded, default = None
+#   -lf, --local_fasta              Specify whether to generate fasta files from the downloaded mmCIF files (True) or download them from the PDB (False), default = False
 
 # additional options for script 02_parse_cif_files.py
 #   -pp, --polypeptides             Specify whether to extract polypeptide sequence (True) or not (False), default = True
 #   -del, --delete_files            Specify whether to delete mmCIF files after parsing (True) or not (False), default = True
+#   -wk, --workers                  Specify number of processes used to parse the mmCIF files at the same time, default = 1
+#   -ca, --cache                    Specify whether to cache the parsed data of every mmCIF file on disk and only parse new or changed files in later runs (True) or always parse all files (False), default = True if -w is False, otherwise False
+#   -cd, --cache_dir                Set path to directory where the parsed data is cached, default = ~/.cache/MutaPipe
+#   -cs, --cache_size               Specify maximum size of the cache directory in MB (least recently used files are removed first; to clear the cache, delete the cache directory), default = 1024
+#   -fp, --fast_polypeptides        Specify whether to build the polypeptides with a vectorised check of all peptide bonds of a chain (True) or with Biopython's PPBuilder (False), default = True
+#   -mem, --max_memory              Specify memory budget per worker in MB; structures which would need more memory to be parsed completely are parsed in low-memory mode, which only keeps the atoms needed for the polypeptides (0 = always use low-memory mode), default = 4096
 
 # additional options for script 03_parse_pdb_files_extract_unsolved_residues.py
 #   -del, --delete_files            Specify whether to delete pdbb files after parsing (True) or not (False), default = True
+#   -wk, --workers                  Specify number of processes used to extract the unsolved residues from the structure files at the same time, default = 1
 
 # additional options for script 04_parse_fasta_files.py
 #   -del, --delete_files            Specify whether to delete fasta files after parsing (True) or not (False), default = True
@@ -0,0 +1,141 @@
+# This module contains the functions used by the MutaPipe scripts to cache data on disk:
+#       - responses from the APIs (used by 00_search_pdb, 01_download_files, 06_a_download_ClinVar_data, 07_combine_data and 08_download_AlphaFold_structures)
+#       - removing the least recently used files if the cache directory has grown too large
+#         (also the parsed data of the mmCIF files which 02_parse_cif_files caches in the folder parsed_mmcif)
+# (the same cache directory can be used by all MutaPipe scripts; to clear the cache, simply delete the cache directory, by default ~/.cache/MutaPipe)
+# ----------------------------------------------------------------------------------------------------------------------------------
+import os
+import json
+import hashlib
+import threading
+import time
+from os.path import join
+from types import SimpleNamespace
+from urllib.parse import urlparse
+import requests
+
+# ----------------------------------------------------------------------------------------------------------------------------------
+
+# each response is stored in its own file and the filename is a hash of the request (method + url + body),
+# so identical requests from previous runs are answered from the cache without going to the network again
+# in all functions, the cache directory is None if nothing should be cached
+
+# define for how many hours cached responses are valid for each API (host)
+cache_ttls = {'search.rcsb.org': 24,              # PDB Search API (new structures are released every week)
+              'data.rcsb.org': 24 * 7,            # PDB Data API
+              'eutils.ncbi.nlm.nih.gov': 24 * 7,  # NCBI (ClinVar)
+              'rest.uniprot.org': 24 * 30}        # UniProt
+default_cache_ttl = 24
+
+# number of seconds we wait for a response from an API before the request is treated as failed
+request_timeout = 60
+
+# extensions of all files stored in the cache directory (responses from the APIs and parsed mmCIF files in the folder parsed_mmcif)
+cache_file_extensions = ('.json', '.json.gz')
+
+def get_cache_path(cache_dir, method, url, body=None):
+    request_string = f'{method.upper()} {url} {json.dumps(body, sort_keys=True) if body is not None else ""}'
+    return join(cache_dir, hashlib.sha256(request_string.encode('utf-8')).hexdigest() + '.json')
+
+def read_cache(cache_dir, method, url, body=None):
+    """
+    This function will return the cached response for a request
+    if it exists and is still valid, otherwise None
+
+    :param cache_dir: string or None
+    :param method: string
+    :param url: string
+    :param body: Dict or None
+    :return: Dict or None
+    """
+    if cache_dir is None:
+        return None
+    cache_path = get_cache_path(cache_dir, method, url, body)
+    try:
+        with open(cache_path, 'r') as f:
+            cached_response = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # check if the cached response is older than the ttl for this API
+    ttl = cache_ttls.get(urlparse(url).netloc, default_cache_ttl) * 3600
+    if time.time() - cached_response['time'] > ttl:
+        return None
+    # update the modification time of the file, so we know it has been used recently (needed to remove least recently used files)
+    try:
+        os.utime(cache_path)
+    except OSError:
+        pass
+    return cached_response
+
+def write_cache(cache_dir, method, url, body, status_code, text):
+    if cache_dir is None:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = get_cache_path(cache_dir, method, url, body)
+    # we write to a temporary file first and then rename it, so other processes never read a half written file
+    tmp_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'time': time.time(), 'method': method.upper(), 'url': url, 'status_code': status_code, 'text': text}, f)
+    os.replace(tmp_path, cache_path)
+
+def cached_request(cache_dir, method, url, body=None, session=None):
+    """
+    This function will make a request to an API (or get the response from the cache);
+    the returned object has the attributes status_code and text and the method json()
+    like a response from the requests package
+    (if the request fails or times out, status_code is None and text describes the error)
+
+    :param cache_dir: string or None
+    :param method: string
+    :param url: string
+    :param body: Dict or None (sent as json)
+    :param session: requests.Session or None
+    :return: response
+    """
+    cached_response = read_cache(cache_dir, method, url, body)
+    if cached_response is not None:
+        response = SimpleNamespace(status_code=cached_response['status_code'], text=cached_response['text'])
+        response.json = lambda: json.loads(response.text)
+        return response
+    try:
+        response = (session or requests).request(method, url, json=body, timeout=request_timeout)
+    except requests.exceptions.RequestException as error:
+        # connection problems / timeouts are treated like a request without data
+        return SimpleNamespace(status_code=None, text=f'request failed ({error})', json=lambda: None)
+    # we only store successful responses (204 = request was fine, but there are no results)
+    if response.status_code in [200, 204]:
+        write_cache(cache_dir, method, url, body, response.status_code, response.text)
+    return response
+
+def evict_cache(cache_dir, max_cache_size):
+    """
+    This function will remove the least recently used files from the cache directory
+    (including all subfolders, e.g. parsed_mmcif) until it is smaller than max_cache_size
+
+    :param cache_dir: string or None
+    :param max_cache_size: int, maximum size of the cache directory in MB
+    :return: None
+    """
+    if cache_dir is None or not os.path.exists(cache_dir):
+        return
+    cached_files = []
+    for folder, subfolders, filenames in os.walk(cache_dir):
+        for filename in filenames:
+            if filename.endswith(cache_file_extensions):
+                path = join(folder, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                cached_files.append((stat.st_mtime, stat.st_size, path))
+    cache_size = sum(size for mtime, size, path in cached_files)
+    # sort files by modification time (oldest first)
+    cached_files.sort()
+    for mtime, size, path in cached_files:
+        if cache_size <= max_cache_size * 1024 * 1024:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        cache_size -= size
@@ -0,0 +1,257 @@
+# This module contains the functions used by the MutaPipe scripts 01, 02 and 03 to read the downloaded structure files
+# (mmCIF, BinaryCIF and pdb files, which may be gzip compressed and linked from the shared structure store into several gene folders)
+# and the one letter codes of the amino acids (used by scripts 03 and 07)
+# ----------------------------------------------------------------------------------------------------------------------------------
+import os
+import io
+import gzip
+import numpy as np
+from Bio.PDB.MMCIF2Dict import MMCIF2Dict
+
+# BinaryCIF files (.bcif) are msgpack encoded, so we need msgpack to read them
+# (msgpack is only needed if BinaryCIF files have been downloaded with script 01, e.g. pip install msgpack)
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+bcif_supported = msgpack is not None
+
+# ----------------------------------------------------------------------------------------------------------------------------------
+
+# define a function to open a structure file for reading (gzip compressed files are decompressed while reading)
+def open_structure_file(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt')
+    return open(filename, 'r')
+
+# define a function to identify files which are linked from the shared structure store into several gene folders
+# (hardlinks and symlinks to the same file have the same device and inode number)
+def get_shared_file_key(filename):
+    try:
+        file_stats = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    if file_stats.st_nlink > 1 or os.path.islink(filename):
+        return (file_stats.st_dev, file_stats.st_ino)
+    return None
+
+# one letter codes of the amino acids (script 03 stores the unsolved residues with them and script 07 converts them back)
+one_letter_codes = {'CYS': 'C', 'ASP': 'D', 'SER': 'S', 'GLN': 'Q', 'LYS': 'K',
+     'ILE': 'I', 'PRO': 'P', 'THR': 'T', 'PHE': 'F', 'ASN': 'N', 
+     'GLY': 'G', 'HIS': 'H', 'LEU': 'L', 'ARG': 'R', 'TRP': 'W', 'TER':'*',
+     'ALA': 'A', 'VAL':'V', 'GLU': 'E', 'TYR': 'Y', 'MET': 'M','XAA':'X'}
+
+# file extensions of the structure files, in the order in which they are used if there are several files for the same structure
+# (script 02 only reads mmCIF and BinaryCIF files; script 03 uses the pdb file only if there is no mmCIF or BinaryCIF file,
+# as the mmCIF file exists for all structures, while structures which are too large for the pdb file format have no pdb file)
+cif_file_extensions = ['.cif.gz', '.cif', '.bcif.gz', '.bcif']
+structure_file_extensions = cif_file_extensions + ['.pdb.gz', '.pdb']
+
+# define a function to get the filename of the structure file to be read for a structure in a gene folder
+def get_structure_file(structure_folder, pdb_id, extensions=structure_file_extensions):
+    for extension in extensions:
+        if os.path.exists(os.path.join(structure_folder, f'{pdb_id}{extension}')):
+            return f'{pdb_id}{extension}'
+    return f'{pdb_id}.cif'
+
+# Reading single categories from mmCIF files
+# =====================================
+# to get only a few categories (e.g. the header information), we don't tokenise the complete file (in particular the _atom_site loop):
+# we extract the text of the categories we need and parse only this text with MMCIF2Dict (the same tokeniser used for complete files)
+
+# define a function to find the end of a category in the content of an mmCIF file
+def find_cif_category_end(data, category, category_start):
+    """
+    This function finds the end of a category, which ends at the next line starting with #, loop_, data_ or the item name of another category
+    (lines in multi-line text fields starting and ending with ; are skipped).
+    :param data: bytes or mmap, content of the mmCIF file (or the complete lines read so far)
+    :param category: str, name of the category (e.g. 'exptl')
+    :param category_start: int, position of the first item name of the category in data
+    :return: int, position of the first line after the category (-1 if data ends before the end of the category)
+    """
+    line_start = category_start
+    in_text_field = False
+    while line_start < len(data):
+        line_end = data.find(b'\n', line_start)
+        if line_end == -1:
+            line_end = len(data)
+        line = data[line_start:line_end]
+        if line.startswith(b';'):
+            in_text_field = not in_text_field
+        elif not in_text_field and (line.startswith(b'#') or line.startswith(b'loop_') or line.startswith(b'data_') or (line.startswith(b'_') and not line.startswith(f'_{category}.'.encode()))):
+            return line_start
+        line_start = line_end + 1
+    return -1
+
+# define a function to get the text of one category (incl. the loop_ line if it is stored as a loop) from an mmCIF file
+def get_cif_category(data, category, start, end):
+    """
+    This function finds a category in the (memory mapped) content of an mmCIF file and returns it as text.
+    :param data: bytes or mmap, content of the mmCIF file
+    :param category: str, name of the category (e.g. 'exptl')
+    :param start: int, position in data from where to search for the category
+    :param end: int, position in data up to where to search for the category
+    :return: str, text of the category (empty string if the category does not exist)
+    """
+    category_start = data.find(f'\n_{category}.'.encode(), start, end)
+    if category_start == -1:
+        return ''
+    category_start += 1
+    # categories stored as a loop start with a loop_ line directly before the first item name
+    previous_line_start = data.rfind(b'\n', 0, category_start - 1) + 1
+    is_loop = data[previous_line_start:category_start].strip() == b'loop_'
+    category_end = find_cif_category_end(data, category, category_start)
+    if category_end == -1:
+        category_end = len(data)
+    category_text = data[category_start:category_end].decode()
+    if is_loop:
+        category_text = 'loop_\n' + category_text
+    return category_text
+
+# define a function to parse the text of categories extracted with get_cif_category
+def parse_cif_categories(category_texts):
+    return MMCIF2Dict(io.StringIO('data_categories\n' + '#\n'.join(category_texts)))
+
+# define a function to read a single category from an mmCIF file without reading the rest of the file
+# the file is read in chunks of 1 MB, all chunks before the category are only searched for the first line of the category
+# and we stop reading at the end of the category (so the memory needed doesn't depend on the size of the file)
+def read_cif_category(cif_file, category, chunk_size=1024 * 1024):
+    """
+    This function reads one category from an mmCIF file (.cif or .cif.gz).
+    :param cif_file: str, filename of the mmCIF file
+    :param category: str, name of the category (e.g. 'pdbx_unobs_or_zero_occ_residues')
+    :param chunk_size: int, number of bytes read at once
+    :return: dict, same format as MMCIF2Dict (only the items of the category, empty if the category doesn't exist)
+    """
+    marker = f'\n_{category}.'.encode()
+    buffer = b''
+    with (gzip.open(cif_file, 'rb') if cif_file.endswith('.gz') else open(cif_file, 'rb')) as handle:
+        while True:
+            chunk = handle.read(chunk_size)
+            buffer += chunk
+            # we only look at complete lines, as the last line of the buffer can be continued in the next chunk
+            data = buffer if not chunk else buffer[:buffer.rfind(b'\n') + 1]
+            category_start = data.find(marker)
+            if category_start == -1:
+                if not chunk:
+                    return {}
+                # we keep the incomplete last line and the end of the buffer before it (which contains the loop_ line if the category starts in the next line)
+                buffer = buffer[max(len(data) - 256, 0):]
+                continue
+            if not chunk or find_cif_category_end(data, category, category_start + 1) != -1:
+                break
+    return parse_cif_categories([get_cif_category(data, category, 0, len(data))])
+
+# BinaryCIF files
+# =====================================
+# data types of the encoded data in BinaryCIF files (BinaryCIF always uses little endian)
+bcif_dtypes = {1: '<i1', 2: '<i2', 3: '<i4', 4: '<u1', 5: '<u2', 6: '<u4', 32: '<f4', 33: '<f8'}
+
+# define a function to decode the (binary) data of a column in a BinaryCIF file
+def decode_bcif_data(encoded_data):
+    """
+    This function decodes the data of a column in a BinaryCIF file (see https://github.com/molstar/BinaryCIF);
+    the encodings are applied in reverse order and every encoding is decoded for all values at once with numpy
+    :param encoded_data: dict, {'data': bytes, 'encoding': [...]}
+    :return: numpy array with the decoded values
+    """
+    data = encoded_data['data']
+    for encoding in reversed(encoded_data['encoding']):
+        kind = encoding['kind']
+        if kind == 'ByteArray':
+            data = np.frombuffer(data, dtype=bcif_dtypes[encoding['type']])
+        elif kind == 'FixedPoint':
+            # we round to the number of decimals given by the factor, so the values are the same as the numbers in the mmCIF file
+            data = np.divide(data, encoding['factor'], dtype=bcif_dtypes[encoding['srcType']])
+            data = np.round(data, int(np.ceil(np.log10(encoding['factor']))))
+        elif kind == 'IntervalQuantization':
+            step = (encoding['max'] - encoding['min']) / (encoding['numSteps'] - 1)
+            data = (encoding['min'] + step * data).astype(bcif_dtypes[encoding['srcType']])
+        elif kind == 'RunLength':
+            data = np.repeat(data[0::2], data[1::2]).astype(bcif_dtypes[encoding['srcType']])
+        elif kind == 'Delta':
+            data = (np.cumsum(data, dtype=np.int64) + encoding['origin']).astype(bcif_dtypes[encoding['srcType']])
+        elif kind == 'IntegerPacking':
+            # values which don't fit into the packed data type are split into several values at the limits of the data type,
+            # so each value ends at the first packed value which is not at one of the limits
+            bits = 8 * encoding['byteCount']
+            if encoding['isUnsigned']:
+                at_limit = data == 2 ** bits - 1
+            else:
+                at_limit = (data == 2 ** (bits - 1) - 1) | (data == -2 ** (bits - 1))
+            value_sums = np.cumsum(data, dtype=np.int64)[np.flatnonzero(~at_limit)]
+            data = np.diff(np.concatenate(([0], value_sums))).astype('<i4')
+        elif kind == 'StringArray':
+            offsets = decode_bcif_data({'data': encoding['offsets'], 'encoding': encoding['offsetEncoding']})
+            indices = decode_bcif_data({'data': data, 'encoding': encoding['dataEncoding']})
+            # the strings are looked up in the list of unique strings (index -1 is used for missing values)
+            strings = np.array([encoding['stringData'][offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)] + [''], dtype=object)
+            data = strings[indices]
+        else:
+            raise ValueError(f'Unknown BinaryCIF encoding: {kind}')
+    return data
+
+# define a function to read a BinaryCIF file into a dictionary in the same format as MMCIF2Dict
+# (all values are converted to strings and missing values are '.' or '?' like in the mmCIF file)
+def read_bcif_file(bcif_file, categories=None, low_memory=False):
+    """
+    This function reads a BinaryCIF file (.bcif or .bcif.gz) and decodes all columns (or the columns of the given categories).
+    :param bcif_file: str, filename of the BinaryCIF file
+    :param categories: list or None, names of the categories to be decoded (e.g. 'exptl'), None to decode all categories
+    :param low_memory: bool, only keep the rows of the _atom_site category which are needed for the polypeptides (see get_backbone_rows)
+    :return: dict, same format as MMCIF2Dict
+    """
+    with (gzip.open(bcif_file, 'rb') if bcif_file.endswith('.gz') else open(bcif_file, 'rb')) as handle:
+        bcif_data = msgpack.unpack(handle, raw=False)
+    data_block = bcif_data['dataBlocks'][0]
+    mmcif_dict = {'data_': data_block['header']}
+    for category in data_block['categories']:
+        if categories is not None and category['name'].lstrip('_') not in categories:
+            continue
+        # (anisotropic temperature factors are not needed for the polypeptides)
+        if low_memory == True and category['name'] == '_atom_site_anisotrop':
+            continue
+        rows = None
+        if low_memory == True and category['name'] == '_atom_site':
+            # the decoded (numeric) columns are small, only the conversion of all values to strings needs a lot of memory,
+            # so we select the rows we need before converting them
+            columns = {column['name']: decode_bcif_data(column['data']) for column in category['columns'] if column['name'] in atom_site_key_columns}
+            rows = get_backbone_rows(columns)
+        for column in category['columns']:
+            values = decode_bcif_data(column['data'])
+            mask = decode_bcif_data(column['mask']) if column.get('mask') is not None else None
+            if rows is not None:
+                values = values[rows]
+                mask = mask[rows] if mask is not None else None
+            values = values.tolist() if values.dtype == object else values.astype(str).tolist()
+            # the mask marks values which are missing in the mmCIF file (0 = value, 1 = '.', 2 = '?')
+            if mask is not None:
+                values = [value if m == 0 else ('.' if m == 1 else '?') for value, m in zip(values, mask)]
+            mmcif_dict[f"{category['name']}.{column['name']}"] = values
+    return mmcif_dict
+
+# in low-memory mode (script 02), we only keep the first row of every residue and the rows of all C and N atoms
+# in the _atom_site category of the first model, which is all we need to build the polypeptides
+backbone_atoms = ['C', 'N']
+# columns of the _atom_site category which identify a residue (a new residue starts when one of these values changes)
+atom_site_key_columns = ['pdbx_PDB_model_num', 'auth_asym_id', 'auth_seq_id', 'label_seq_id', 'pdbx_PDB_ins_code', 'label_comp_id', 'group_PDB', 'label_atom_id']
+
+# define a function to select the rows of the _atom_site category which are needed for the polypeptides
+def get_backbone_rows(columns):
+    """
+    This function selects the first row of every residue and the rows of all C and N atoms in the first model.
+    :param columns: dict, {column name: numpy array} for the columns in atom_site_key_columns
+    :return: numpy array (bool), True for all rows to be kept
+    """
+    atom_names = columns['label_atom_id']
+    n_rows = len(atom_names)
+    new_residue = np.zeros(n_rows, dtype=bool)
+    if n_rows > 0:
+        new_residue[0] = True
+    for column_name, values in columns.items():
+        if column_name != 'label_atom_id':
+            new_residue[1:] |= values[1:] != values[:-1]
+    rows = new_residue | np.isin(atom_names, backbone_atoms)
+    if 'pdbx_PDB_model_num' in columns and n_rows > 0:
+        rows &= columns['pdbx_PDB_model_num'] == columns['pdbx_PDB_model_num'][0]
+    return rows